@@ -201,6 +201,11 @@ def main():
     parser.add_argument("--norm_pix_loss", action="store_true", help="normalize before compute reconstruction loss")
     parser.add_argument("--redis_ports", nargs="+", type=int, help="redis ports")
     parser.add_argument("--redis_compression", type=str, default="lz4", help="compression method for redis.")
+    parser.add_argument(
+        "--cache_backend", type=str, default=None, help="redis or local, defaults to redis if redis_ports are set"
+    )
+    parser.add_argument("--cache_dir", default="/dev/shm/swinmm_cache", type=str, help="local cache directory")
+    parser.add_argument("--cache_compression", type=str, default=None, help="zlib or lz4 for local cache.")
     parser.add_argument("--use_normal_dataset", action="store_true", help="use monai Dataset class")
     parser.add_argument(
         "--nouse_multi_epochs_loader",
@@ -238,7 +243,7 @@ def main():
         print("Training with a single process on 1 GPUs.")
     assert args.rank >= 0
 
-    if args.redis_compression is not None:
+    if args.redis_compression is not None and args.redis_ports and args.cache_backend != "local":
         hijack_bagua_serialization(args.redis_compression)
 
     if args.rank == 0:
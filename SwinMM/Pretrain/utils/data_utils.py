@@ -26,6 +26,23 @@ from monai.transforms import (
 )
 
 
+def dataset_in_memory_kwargs(dataset_name: str, args):
+    """CachedDataset arguments, redis if redis ports are given, otherwise the local memory-mapped cache."""
+    backend = args.cache_backend or ("redis" if args.redis_ports else "local")
+    if backend == "redis":
+        return dict(
+            dataset_name=dataset_name,
+            backend="redis",
+            hosts=[{"host": "localhost", "port": str(port)} for port in args.redis_ports],
+            cluster_mode=True,
+            capacity_per_node=200 * 1024 * 1024 * 1024,
+            writer_buffer_size=0,  # Disable write buffer
+        )
+    return dict(
+        dataset_name=dataset_name, backend="local", cache_dir=args.cache_dir, compression=args.cache_compression
+    )
+
+
 def get_loader(args):
     splits0 = "/dataset00_BTCV.json"
     # splits1 = "/dataset01_BrainTumour.json"
@@ -150,11 +167,7 @@ def get_loader(args):
         train_ds = dataset_in_memory.CachedDataset(
             data=datalist,
             transform=train_transforms,
-            dataset_name="pretrain_train",
-            hosts=[{"host": "localhost", "port": str(port)} for port in args.redis_ports],
-            cluster_mode=True,
-            capacity_per_node=200 * 1024 * 1024 * 1024,
-            writer_buffer_size=0,  # Disable write buffer
+            **dataset_in_memory_kwargs("pretrain_train", args),
         )
 
     if args.distributed:
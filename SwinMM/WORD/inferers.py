@@ -23,6 +23,79 @@ from monai.utils import (
 tqdm, _ = optional_import("tqdm", name="tqdm")
 
 
+def _zoom_scale(
+    image_size: Sequence[int], out_roi_size: Sequence[int], in_roi_size: Sequence[int], ss: int
+) -> List[float]:
+    """Spatial zoom scale out_roi_size/in_roi_size of the ss-th output."""
+    zoom_scale = []
+    for axis, (img_s_i, out_w_i, in_w_i) in enumerate(zip(image_size, out_roi_size, in_roi_size)):
+        _scale = out_w_i / float(in_w_i)
+        if not (img_s_i * _scale).is_integer():
+            warnings.warn(
+                f"For spatial axis: {axis}, output[{ss}] will have non-integer shape. Spatial "
+                f"zoom_scale between output[{ss}] and input is {_scale}. Please pad inputs."
+            )
+        zoom_scale.append(_scale)
+    return zoom_scale
+
+
+def _spatial_strides(output_size: Sequence[int]) -> List[int]:
+    strides = [1] * len(output_size)
+    for d in range(len(output_size) - 2, -1, -1):
+        strides[d] = strides[d + 1] * int(output_size[d + 1])
+    return strides
+
+
+def _window_offsets(
+    slices: Sequence[Sequence[slice]],
+    zoom_scale: Sequence[float],
+    output_size: Sequence[int],
+    overlap: float,
+    roi_size: Sequence[int],
+    ss: int,
+    device: Union[torch.device, str],
+) -> torch.Tensor:
+    """Flattened offsets of the (zoomed) windows in the spatial output of the ss-th output."""
+    strides = _spatial_strides(output_size)
+    offsets = []
+    for original_idx in slices:
+        offset = 0
+        for axis, (sl, scale) in enumerate(zip(original_idx, zoom_scale)):
+            zoomed_start, zoomed_end = sl.start * scale, sl.stop * scale
+            if not zoomed_start.is_integer() or (not zoomed_end.is_integer()):
+                warnings.warn(
+                    f"For axis-{axis} of output[{ss}], the output roi range is not int. "
+                    f"Input roi range is ({sl.start}, {sl.stop}). "
+                    f"Spatial zoom_scale between output[{ss}] and input is {scale}. "
+                    f"Corresponding output roi range is ({zoomed_start}, {zoomed_end}).\n"
+                    f"Please change overlap ({overlap}) or roi_size ({roi_size[axis]}) for axis-{axis}. "
+                    "Tips: if overlap*roi_size*zoom_scale is an integer, it usually works."
+                )
+            offset += int(zoomed_start) * strides[axis]
+        offsets.append(offset)
+    return torch.tensor(offsets, dtype=torch.long, device=device)
+
+
+def _roi_index(roi_size: Sequence[int], output_size: Sequence[int], device: Union[torch.device, str]) -> torch.Tensor:
+    """Flattened offsets of the voxels of a window (of roi_size) in the spatial output."""
+    index = torch.zeros([1] * len(roi_size), dtype=torch.long, device=device)
+    for d, (roi_d, stride_d) in enumerate(zip(roi_size, _spatial_strides(output_size))):
+        shape = [1] * len(roi_size)
+        shape[d] = int(roi_d)
+        index = index + (torch.arange(int(roi_d), device=device) * stride_d).view(shape)
+    return index.flatten()
+
+
+def _count_map(
+    importance_map: torch.Tensor, win_offsets: torch.Tensor, roi_index: torch.Tensor, output_size: Sequence[int]
+) -> torch.Tensor:
+    """Sum of the importance maps of all windows, the same for every image of the batch."""
+    count_map = torch.zeros(int(torch.tensor(output_size).prod()), dtype=torch.float32, device=importance_map.device)
+    index = (win_offsets[:, None] + roi_index[None]).flatten()
+    count_map.index_add_(0, index, importance_map.to(torch.float32).flatten().repeat(len(win_offsets)))
+    return count_map.view(*output_size)
+
+
 def double_sliding_window_inference(
     inputs: torch.Tensor,
     view: int,
@@ -154,9 +227,11 @@ def double_sliding_window_inference(
     importance_map = torch.clamp(importance_map.to(torch.float32), min=min_non_zero).to(compute_dtype)
 
     # Perform predictions
-    dict_key, output_image_list_1, output_image_list_2, count_map_list = None, [], [], []
+    dict_key, output_image_list, count_map_list, scatter_list = None, [], [], []
     _initialized_ss = -1
     is_tensor_output = True  # whether the predictor's output is a tensor (instead of dict/tuple)
+    win_batch = torch.arange(total_slices, device=device) // num_win
+    win_index = torch.arange(total_slices, device=device) % num_win
 
     # for each patch
     for slice_g in tqdm(range(0, total_slices, sw_batch_size)) if progress else range(0, total_slices, sw_batch_size):
@@ -168,7 +243,6 @@ def double_sliding_window_inference(
         window_data = torch.cat([inputs[win_slice] for win_slice in unravel_slice]).to(sw_device)
         view_list = [view, (view + 1) % len(view_transforms.permutation_transforms)]
         window_data_list = [view_ops.get_permute_transform(0, dst)(window_data) for dst in view_list]
-        # window_data_2 = torch.cat([inputs2[win_slice] for win_slice in unravel_slice]).to(sw_device)
         seg_prob_out_1, seg_prob_out_2 = predictor(
             window_data_list[0], window_data_list[1], view_list, *args, **kwargs
         )  # batched patch segmentation
@@ -193,67 +267,47 @@ def double_sliding_window_inference(
 
         # for each output in multi-output list
         for ss in range(len(seg_prob_tuple_1)):
-            seg_prob_1 = seg_prob_tuple_1[ss].to(device)  # BxCxMxNxP or BxCxMxN
-            seg_prob_2 = seg_prob_tuple_2[ss].to(device)
-
-            # compute zoom scale: out_roi_size/in_roi_size
-            zoom_scale = []
-            for axis, (img_s_i, out_w_i, in_w_i) in enumerate(
-                zip(image_size, seg_prob_1.shape[2:], window_data.shape[2:])
-            ):
-                _scale = out_w_i / float(in_w_i)
-                if not (img_s_i * _scale).is_integer():
-                    warnings.warn(
-                        f"For spatial axis: {axis}, output[{ss}] will have non-integer shape. Spatial "
-                        f"zoom_scale between output[{ss}] and input is {_scale}. Please pad inputs."
-                    )
-                zoom_scale.append(_scale)
-
-            if _initialized_ss < ss:  # init. the ss-th buffer at the first iteration
-                # construct multi-resolution outputs
-                output_classes = seg_prob_1.shape[1]
-                output_shape = [batch_size, output_classes] + [
+            seg_prob = torch.stack([seg_prob_tuple_1[ss], seg_prob_tuple_2[ss]]).to(device)  # 2xBxCxMxNxP
+
+            if _initialized_ss < ss:  # init. the ss-th buffer, weights and scatter indices at the first iteration
+                zoom_scale = _zoom_scale(image_size, seg_prob.shape[3:], window_data.shape[2:], ss)
+                output_size = [
                     int(image_size_d * zoom_scale_d) for image_size_d, zoom_scale_d in zip(image_size, zoom_scale)
                 ]
-                # allocate memory to store the full output and the count for overlapping parts
-                output_image_list_1.append(torch.zeros(output_shape, dtype=compute_dtype, device=device))
-                output_image_list_2.append(torch.zeros(output_shape, dtype=compute_dtype, device=device))
-                count_map_list.append(torch.zeros([1, 1] + output_shape[2:], dtype=compute_dtype, device=device))
+                # the zoomed importance map is the same for all windows
+                resizer = Resize(spatial_size=seg_prob.shape[3:], mode="nearest", anti_aliasing=False)
+                importance_map_zoom = resizer(importance_map.unsqueeze(0))[0].to(device=device, dtype=compute_dtype)
+                win_offsets = _window_offsets(slices, zoom_scale, output_size, overlap, roi_size, ss, device)
+                roi_index = _roi_index(seg_prob.shape[3:], output_size, device)
+                count_map_list.append(
+                    _count_map(importance_map_zoom, win_offsets, roi_index, output_size).to(compute_dtype)
+                )
+                # allocate memory to store the full outputs of both views, channel first to scatter along one dim
+                output_classes = seg_prob.shape[2]
+                num_voxels = count_map_list[-1].numel()
+                output_image_list.append(
+                    torch.zeros([2, output_classes, batch_size * num_voxels], dtype=compute_dtype, device=device)
+                )
+                scatter_list.append((importance_map_zoom, win_offsets, roi_index, num_voxels, output_size))
                 _initialized_ss += 1
 
-            # resizing the importance_map
-            resizer = Resize(spatial_size=seg_prob_1.shape[2:], mode="nearest", anti_aliasing=False)
-
-            # store the result in the proper location of the full output. Apply weights from importance map.
-            for idx, original_idx in zip(slice_range, unravel_slice):
-                # zoom roi
-                original_idx_zoom = list(original_idx)  # 4D for 2D image, 5D for 3D image
-                for axis in range(2, len(original_idx_zoom)):
-                    zoomed_start = original_idx[axis].start * zoom_scale[axis - 2]
-                    zoomed_end = original_idx[axis].stop * zoom_scale[axis - 2]
-                    if not zoomed_start.is_integer() or (not zoomed_end.is_integer()):
-                        warnings.warn(
-                            f"For axis-{axis-2} of output[{ss}], the output roi range is not int. "
-                            f"Input roi range is ({original_idx[axis].start}, {original_idx[axis].stop}). "
-                            f"Spatial zoom_scale between output[{ss}] and input is {zoom_scale[axis - 2]}. "
-                            f"Corresponding output roi range is ({zoomed_start}, {zoomed_end}).\n"
-                            f"Please change overlap ({overlap}) or roi_size ({roi_size[axis-2]}) for axis-{axis-2}. "
-                            "Tips: if overlap*roi_size*zoom_scale is an integer, it usually works."
-                        )
-                    original_idx_zoom[axis] = slice(int(zoomed_start), int(zoomed_end), None)
-                importance_map_zoom = resizer(importance_map.unsqueeze(0))[0].to(compute_dtype)
-                # store results and weights
-                output_image_list_1[ss][original_idx_zoom] += importance_map_zoom * seg_prob_1[idx - slice_g]
-                output_image_list_2[ss][original_idx_zoom] += importance_map_zoom * seg_prob_2[idx - slice_g]
-                count_map_list[ss][original_idx_zoom] += (
-                    importance_map_zoom.unsqueeze(0).unsqueeze(0).expand(count_map_list[ss][original_idx_zoom].shape)
-                )
+            # store the weighted results of the window batch in the full outputs with a single scatter-add
+            importance_map_zoom, win_offsets, roi_index, num_voxels, _ = scatter_list[ss]
+            batch_range = slice(slice_range.start, slice_range.stop)
+            index = win_batch[batch_range] * num_voxels + win_offsets[win_index[batch_range]]
+            index = (index[:, None] + roi_index[None]).flatten()
+            weighted = (seg_prob * importance_map_zoom).to(compute_dtype).transpose(1, 2)  # 2xCxBxMxNxP
+            output_image_list[ss].index_add_(2, index, weighted.reshape(2, weighted.shape[1], -1))
 
     # account for any overlapping sections
-    for ss in range(len(output_image_list_1)):
-        count_map_pop = count_map_list.pop(0)
-        output_image_list_1[ss] = (output_image_list_1[ss] / count_map_pop).to(compute_dtype)
-        output_image_list_2[ss] = (output_image_list_2[ss] / count_map_pop).to(compute_dtype)
+    output_image_list_1, output_image_list_2 = [], []
+    for ss in range(len(output_image_list)):
+        output_size = scatter_list[ss][-1]
+        output_image = output_image_list[ss].view(2, -1, batch_size, *output_size) / count_map_list[ss]
+        output_image = output_image.transpose(1, 2).to(compute_dtype)  # 2xBxCxMxNxP
+        output_image_list_1.append(output_image[0])
+        output_image_list_2.append(output_image[1])
+    del output_image_list, count_map_list
 
     # remove padding if image_size smaller than roi_size
     for ss in range(len(output_image_list_1)):
@@ -290,3 +344,144 @@ def double_sliding_window_inference(
     final_output_1 = final_output_1[0] if is_tensor_output else final_output_1  # type: ignore
     final_output_2 = final_output_2[0] if is_tensor_output else final_output_2  # type: ignore
     return final_output_1, final_output_2
+
+
+def multiview_sliding_window_inference(
+    inputs: torch.Tensor,
+    view_pairs: Sequence[Tuple[int, int]],
+    roi_size: Union[Sequence[int], int],
+    sw_batch_size: int,
+    model: torch.nn.Module,
+    overlap: float = 0.25,
+    mode: Union[BlendMode, str] = BlendMode.CONSTANT,
+    sigma_scale: Union[Sequence[float], float] = 0.125,
+    padding_mode: Union[PytorchPadMode, str] = PytorchPadMode.CONSTANT,
+    cval: float = 0.0,
+    sw_device: Union[torch.device, str, None] = None,
+    device: Union[torch.device, str, None] = None,
+    progress: bool = False,
+    softmax: bool = True,
+) -> Tuple[List[torch.Tensor], torch.Tensor]:
+    """
+    Sliding window inference of all the `view_pairs` of a multiview `model` in a single pass.
+
+    Equivalent to calling `double_sliding_window_inference` once per view pair, but each window is cropped once
+    and each permuted view of it is encoded once (``model.forward_view_encoder``). The cross attention
+    (``model.forward_view_cross_attention``) of every pair runs on the cached encodings, and the decoded outputs of
+    all pairs are stitched together, sharing the importance and count maps.
+
+    Args:
+        inputs: input image to be processed (assuming NCHWD).
+        view_pairs: the pairs of views to fuse, e.g. ``((0, 1), (1, 2), (2, 0))``.
+        roi_size: the spatial window size for inferences.
+        sw_batch_size: the batch size to run window slices.
+        model: the multiview SwinUNETR (or a DistributedDataParallel wrapping it).
+            Its outputs must have the spatial size of the window.
+        overlap: Amount of overlap between scans.
+        mode: {``"constant"``, ``"gaussian"``}
+            How to blend output of overlapping windows. Defaults to ``"constant"``.
+        sigma_scale: the standard deviation coefficient of the Gaussian window when `mode` is ``"gaussian"``.
+        padding_mode: {``"constant"``, ``"reflect"``, ``"replicate"``, ``"circular"``}
+            Padding mode for ``inputs``, when ``roi_size`` is larger than inputs. Defaults to ``"constant"``
+        cval: fill value for 'constant' padding mode. Default: 0
+        sw_device: device for the window data. By default the device of the `inputs` is used.
+        device: device for the stitched output prediction. By default the device of the `inputs` is used.
+        progress: whether to print a `tqdm` progress bar.
+        softmax: whether to apply softmax to the stitched outputs.
+
+    Returns:
+        The stitched outputs in the original view, two per view pair (in the order of `view_pairs`), and their sum
+        (the fused prediction).
+    """
+    net = getattr(model, "module", model)
+    compute_dtype = inputs.dtype
+    num_spatial_dims = len(inputs.shape) - 2
+    if overlap < 0 or overlap >= 1:
+        raise ValueError("overlap must be >= 0 and < 1.")
+
+    batch_size, _, *image_size_ = inputs.shape
+    if device is None:
+        device = inputs.device
+    if sw_device is None:
+        sw_device = inputs.device
+
+    roi_size = fall_back_tuple(roi_size, image_size_)
+    image_size = tuple(max(image_size_[i], roi_size[i]) for i in range(num_spatial_dims))
+    pad_size = []
+    for k in range(len(inputs.shape) - 1, 1, -1):
+        diff = max(roi_size[k - 2] - inputs.shape[k], 0)
+        half = diff // 2
+        pad_size.extend([half, diff - half])
+    inputs = F.pad(inputs, pad=pad_size, mode=look_up_option(padding_mode, PytorchPadMode).value, value=cval)
+
+    scan_interval = _get_scan_interval(image_size, roi_size, num_spatial_dims, overlap)
+    slices = dense_patch_slices(image_size, roi_size, scan_interval)
+    num_win = len(slices)
+    total_slices = num_win * batch_size
+
+    valid_patch_size = get_valid_patch_size(image_size, roi_size)
+    try:
+        importance_map = compute_importance_map(valid_patch_size, mode=mode, sigma_scale=sigma_scale, device=device)
+    except BaseException as e:
+        raise RuntimeError(
+            "Seems to be OOM. Please try smaller patch size or mode='constant' instead of mode='gaussian'."
+        ) from e
+    importance_map = convert_data_type(importance_map, torch.Tensor, device, compute_dtype)[0]  # type: ignore
+    min_non_zero = max(importance_map[importance_map != 0].min().item(), 1e-3)
+    importance_map = torch.clamp(importance_map.to(torch.float32), min=min_non_zero).to(compute_dtype)
+
+    views = sorted({v for pair in view_pairs for v in pair})
+    win_offsets = _window_offsets(slices, [1.0] * num_spatial_dims, image_size, overlap, roi_size, 0, device)
+    roi_index = _roi_index(roi_size, image_size, device)
+    count_map = _count_map(importance_map, win_offsets, roi_index, image_size).to(compute_dtype)
+    num_voxels = count_map.numel()
+    win_batch = torch.arange(total_slices, device=device) // num_win
+    win_index = torch.arange(total_slices, device=device) % num_win
+    output_image = None
+
+    for slice_g in tqdm(range(0, total_slices, sw_batch_size)) if progress else range(0, total_slices, sw_batch_size):
+        slice_range = range(slice_g, min(slice_g + sw_batch_size, total_slices))
+        unravel_slice = [
+            [slice(int(idx / num_win), int(idx / num_win) + 1), slice(None)] + list(slices[idx % num_win])
+            for idx in slice_range
+        ]
+        window_data = torch.cat([inputs[win_slice] for win_slice in unravel_slice]).to(sw_device)
+
+        # each view is encoded once, the cross attention replaces the "dec4" features of (shallow) copies
+        encoded = {v: net.forward_view_encoder(view_ops.get_permute_transform(0, v)(window_data)) for v in views}
+        seg_prob_list = []
+        for view_pair in view_pairs:
+            xa_encoded, xb_encoded = net.forward_view_cross_attention(
+                dict(encoded[view_pair[0]]), dict(encoded[view_pair[1]]), list(view_pair)
+            )
+            seg_prob_pair = [net.forward_view_decoder(x) for x in (xa_encoded, xb_encoded)]
+            seg_prob_list += view_ops.permute_inverse(seg_prob_pair, view_pair)
+        del encoded
+
+        # all the view outputs of the window batch are stored with a single scatter-add
+        seg_prob = torch.stack(seg_prob_list).to(device)  # VxBxCxMxNxP
+        if output_image is None:
+            output_image = torch.zeros(
+                [len(seg_prob_list), seg_prob.shape[2], batch_size * num_voxels], dtype=compute_dtype, device=device
+            )
+        batch_range = slice(slice_range.start, slice_range.stop)
+        index = win_batch[batch_range] * num_voxels + win_offsets[win_index[batch_range]]
+        index = (index[:, None] + roi_index[None]).flatten()
+        weighted = (seg_prob * importance_map).to(compute_dtype).transpose(1, 2)  # VxCxBxMxNxP
+        output_image.index_add_(2, index, weighted.reshape(*weighted.shape[:2], -1))
+        del seg_prob_list, seg_prob, weighted
+
+    final_slicing: List[slice] = [slice(None), slice(None), slice(None)]
+    for sp in range(num_spatial_dims):
+        start = pad_size[(num_spatial_dims - sp - 1) * 2]
+        final_slicing.append(slice(start, start + image_size_[sp]))
+    # in place, per view: the buffer of all the views is the largest allocation of the inference
+    output_image = output_image.view(*output_image.shape[:2], batch_size, *image_size).div_(count_map)  # type: ignore
+    output_image = output_image.transpose(1, 2)[tuple(final_slicing)]  # VxBxCxMxNxP
+    for output_view in output_image:
+        if not torch.isfinite(output_view).all():
+            warnings.warn("Sliding window inference results contain NaN or Inf.")
+        if softmax:  # softmax over the classes
+            output_view.sub_(output_view.amax(dim=1, keepdim=True)).exp_()
+            output_view.div_(output_view.sum(dim=1, keepdim=True))
+    return list(output_image.unbind(0)), output_image.sum(0)
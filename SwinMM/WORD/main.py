@@ -107,6 +107,11 @@ parser.add_argument(
 )
 parser.add_argument("--redis_ports", nargs="+", type=int, help="redis ports")
 parser.add_argument("--redis_compression", type=str, default=None, help="compression method for redis.")
+parser.add_argument(
+    "--cache_backend", type=str, default=None, help="redis or local, defaults to redis if redis_ports are set"
+)
+parser.add_argument("--cache_dir", default="/dev/shm/swinmm_cache", type=str, help="local cache directory")
+parser.add_argument("--cache_compression", type=str, default=None, help="zlib or lz4 for local cache.")
 
 
 def main():
@@ -123,7 +128,7 @@ def main():
 
 
 def main_worker(gpu, args):
-    if args.redis_compression is not None:
+    if args.redis_compression is not None and args.redis_ports and args.cache_backend != "local":
         hijack_bagua_serialization(args.redis_compression)
 
     if args.distributed:
@@ -15,7 +15,7 @@ import os
 import nibabel as nib
 import numpy as np
 import torch
-from inferers import double_sliding_window_inference
+from inferers import multiview_sliding_window_inference
 from models import SwinUNETR
 from utils.data_utils import get_loader
 from utils.misc import resample_3d
@@ -101,30 +101,22 @@ def main():
             img_name = batch["image_meta_dict"]["filename_or_obj"][0].split("/")[-1]
             print("Inference on case {}".format(img_name))
             torch.cuda.empty_cache()
-            output_list = []
-            val_fuse = 0
 
             val_labels = spacing(val_labels, original_affine)[0]
             val_labels = np.expand_dims(val_labels, axis=0)
             val_labels = one_hot(torch.from_numpy(val_labels), num_classes=args.out_channels, dim=1)
 
-            for i in range(3):
-                val_outputs_1, val_outputs_2 = double_sliding_window_inference(
-                    val_inputs,
-                    i,
-                    (args.roi_x, args.roi_y, args.roi_z),
-                    16,
-                    model,
-                    overlap=args.infer_overlap,
-                    mode="gaussian",
-                )
-
-                val_outputs_1 = torch.softmax(val_outputs_1, 1).cpu().numpy()[0]
-                val_outputs_2 = torch.softmax(val_outputs_2, 1).cpu().numpy()[0]
-                val_fuse = val_fuse + val_outputs_1 + val_outputs_2
-                output_list.append(val_outputs_1)
-                output_list.append(val_outputs_2)
-            output_list.append(val_fuse)
+            outputs, val_fuse = multiview_sliding_window_inference(
+                val_inputs,
+                ((0, 1), (1, 2), (2, 0)),
+                (args.roi_x, args.roi_y, args.roi_z),
+                16,
+                model,
+                overlap=args.infer_overlap,
+                mode="gaussian",
+            )
+            output_list = [val_outputs.cpu().numpy()[0] for val_outputs in outputs + [val_fuse]]
+            del outputs, val_fuse
 
             for i, output in enumerate(output_list):
                 output = np.argmax(output, axis=0, keepdims=False)
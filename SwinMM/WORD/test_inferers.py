@@ -0,0 +1,52 @@
+"""Unit test for the stitching of the multiview sliding window inference."""
+
+import itertools
+import unittest
+
+import inferers
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from monai.inferers import sliding_window_inference
+
+
+def _stub(x, zoom=1):
+    """Window dependent (by its mean) and view equivariant, so that both views match the single view inference."""
+    y = 2 * x + x.mean(dim=tuple(range(1, x.ndim)), keepdim=True)
+    y = torch.cat([y, -y], dim=1)
+    if zoom != 1:
+        y = F.interpolate(y, scale_factor=zoom, mode="nearest")
+    return y
+
+
+class DoubleSlidingWindowInferenceTest(unittest.TestCase):
+    def test_same_as_sliding_window_inference(self):
+        # (batch, image size, roi size, zoom): batch > 1, a padded axis (image smaller than the window), zoomed output
+        cases = [
+            (1, (20, 18, 16), (8, 8, 8), 1),
+            (3, (20, 18, 16), (8, 8, 8), 1),
+            (2, (20, 6, 16), (8, 8, 8), 1),
+            (2, (16, 12, 16), (8, 8, 8), 2),
+        ]
+        for (batch, size, roi, zoom), mode in itertools.product(cases, ("constant", "gaussian")):
+            with self.subTest(batch=batch, size=size, zoom=zoom, mode=mode):
+                torch.manual_seed(0)
+                inputs = torch.rand(batch, 1, *size)
+                expected = sliding_window_inference(inputs, roi, 3, lambda x: _stub(x, zoom), overlap=0.5, mode=mode)
+                outputs = inferers.double_sliding_window_inference(
+                    inputs,
+                    0,
+                    roi,
+                    3,
+                    lambda x1, x2, views: (_stub(x1, zoom), _stub(x2, zoom)),
+                    overlap=0.5,
+                    mode=mode,
+                )
+                for output in outputs:
+                    self.assertEqual(output.shape, expected.shape)
+                    np.testing.assert_allclose(output.numpy(), expected.numpy(), rtol=1e-5, atol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
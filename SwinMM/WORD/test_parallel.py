@@ -2,20 +2,16 @@ import argparse
 import logging
 import os
 
-import nibabel as nib
 import numpy as np
 import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
-from inferers import double_sliding_window_inference
+from inferers import multiview_sliding_window_inference
 from models import SwinUNETR
 from timm.utils import setup_default_logging
 from utils.data_utils import get_loader
-from utils.misc import dice, distributed_all_gather, resample_3d
-
-from monai.metrics import compute_average_surface_distance, compute_hausdorff_distance, compute_meandice
-from monai.networks.utils import one_hot
-from monai.transforms import Spacing
+from utils.evaluation import EvaluationEngine
+from utils.misc import dice, distributed_all_gather
 
 parser = argparse.ArgumentParser(description="Swin UNETR segmentation pipeline")
 parser.add_argument(
@@ -61,8 +57,8 @@ parser.add_argument("--use_checkpoint", action="store_true", help="use gradient
 parser.add_argument(
     "--cross_attention_in_origin_view", action="store_true", help="Whether compute cross attention in original view"
 )
+parser.add_argument("--eval_workers", default=4, type=int, help="number of CPU processes computing the metrics")
 
-spacing = Spacing(pixdim=(1, 1, 1), mode="nearest")
 hd_per = 95
 view = ["Cor1", "Sag2", "Sag1", "Axi2", "Axi1", "Cor2", "Fuse"]
 
@@ -128,80 +124,56 @@ def main_worker(gpu, args):
             model, device_ids=[args.gpu], output_device=args.gpu, broadcast_buffers=False, find_unused_parameters=True
         )
 
-    dice_all = []  # np.zeros((len(val_loader), len(view), args.out_channels - 1))
-    hd_all = []  # np.zeros((len(val_loader), len(view), args.out_channels - 1))
-    asd_all = []  # np.zeros((len(val_loader), len(view), args.out_channels - 1))
+    evaluation = EvaluationEngine(
+        output_directory,
+        view,
+        args.out_channels,
+        rank=args.rank,
+        num_workers=args.eval_workers,
+        percentile=hd_per,
+    )
+    img_names = []
 
     with torch.no_grad():
         for id, batch in enumerate(val_loader):
+            img_name = batch["image_meta_dict"]["filename_or_obj"][0].split("/")[-1]
+            img_names.append(img_name)
+            if evaluation.done(img_name):
+                print("Skipping evaluated case {}".format(img_name))
+                continue
             val_inputs, val_labels = (batch["image"].cuda(args.gpu), batch["label"].cpu())
             original_affine = batch["label_meta_dict"]["affine"][0].numpy()
             _, _, h, w, d = val_labels.shape
             target_shape = (h, w, d)
             val_labels = val_labels.numpy()[0, :, :, :, :]
-            img_name = batch["image_meta_dict"]["filename_or_obj"][0].split("/")[-1]
             print("Inference on case {}".format(img_name))
             torch.cuda.empty_cache()
-            output_list = []
-            val_fuse = 0
-
-            val_labels = spacing(val_labels, original_affine)[0]
-            val_labels = np.expand_dims(val_labels, axis=0)
-            val_labels = one_hot(torch.from_numpy(val_labels), num_classes=args.out_channels, dim=1)
-
-            for i in range(3):
-                # j = i + 3
-                val_outputs_1, val_outputs_2 = double_sliding_window_inference(
-                    val_inputs,
-                    i,
-                    (args.roi_x, args.roi_y, args.roi_z),
-                    16,
-                    model,
-                    overlap=args.infer_overlap,
-                    mode="gaussian",
-                )
-
-                val_outputs_1 = torch.softmax(val_outputs_1, 1).cpu().numpy()[0]
-                val_outputs_2 = torch.softmax(val_outputs_2, 1).cpu().numpy()[0]
-                val_fuse = val_fuse + val_outputs_1 + val_outputs_2
-                output_list.append(val_outputs_1)
-                output_list.append(val_outputs_2)
-            output_list.append(val_fuse)
+
+            outputs, val_fuse = multiview_sliding_window_inference(
+                val_inputs,
+                ((0, 1), (1, 2), (2, 0)),
+                (args.roi_x, args.roi_y, args.roi_z),
+                16,
+                model,
+                overlap=args.infer_overlap,
+                mode="gaussian",
+            )
+            # only the label maps leave the GPU, postprocessing and metrics overlap with the next case
+            output_list = [
+                torch.argmax(val_outputs[0], dim=0).to(torch.uint8).cpu().numpy()
+                for val_outputs in outputs + [val_fuse]
+            ]
+            del outputs, val_fuse
             print("Inference finished on case {}".format(img_name))
+            evaluation.submit(img_name, output_list, val_labels, original_affine, target_shape)
+
+    evaluation.close()
+    metrics = evaluation.metrics(img_names)
+    dice_all, hd_all, asd_all = metrics["dice"], metrics["hd"], metrics["asd"]
 
-            dice = np.zeros((len(view), args.out_channels - 1))
-            hd = np.zeros((len(view), args.out_channels - 1))
-            asd = np.zeros((len(view), args.out_channels - 1))
-            for i, output in enumerate(output_list):
-                output = np.argmax(output, axis=0, keepdims=False)
-                output = resample_3d(output, target_shape)
-                target_ornt = nib.orientations.axcodes2ornt(tuple(nib.aff2axcodes(original_affine)))
-                out_ornt = [[0, 1], [1, 1], [2, 1]]
-                ornt_transf = nib.orientations.ornt_transform(out_ornt, target_ornt)
-                output = nib.orientations.apply_orientation(output, ornt_transf)
-                nib.save(
-                    nib.Nifti1Image(output.astype(np.uint8), affine=original_affine),
-                    os.path.join(output_directory, view[i] + "_" + img_name),
-                )
-                output = np.expand_dims(spacing(np.expand_dims(output, axis=(0)), original_affine)[0], axis=0)
-                output = one_hot(torch.from_numpy(output), num_classes=args.out_channels, dim=1)
-                # print(output.shape, val_labels.shape)
-                dice_ = compute_meandice(output, val_labels, include_background=False).numpy()[0]
-                hd_ = compute_hausdorff_distance(output, val_labels, percentile=hd_per).numpy()[0]
-                asd_ = compute_average_surface_distance(output, val_labels).numpy()[0]
-                print("{} {} View Mean Dice: {}".format(img_name, view[i], np.mean(dice_)))
-                print("{} {} View Mean HD: {}".format(img_name, view[i], np.mean(hd_)))
-                print("{} {} View Mean ASD: {}".format(img_name, view[i], np.mean(asd_)))
-                dice[i, :] = dice_
-                hd[i, :] = hd_
-                asd[i, :] = asd_
-            dice_all.append(dice)
-            hd_all.append(hd)
-            asd_all.append(asd)
-
-    dice_all = torch.tensor(np.stack(dice_all, axis=0)).cuda(args.gpu)
-    hd_all = torch.tensor(np.stack(hd_all, axis=0)).cuda(args.gpu)
-    asd_all = torch.tensor(np.stack(asd_all, axis=0)).cuda(args.gpu)
+    dice_all = torch.tensor(dice_all).cuda(args.gpu)
+    hd_all = torch.tensor(hd_all).cuda(args.gpu)
+    asd_all = torch.tensor(asd_all).cuda(args.gpu)
     dice_list = distributed_all_gather([dice_all], out_numpy=False, is_valid=True)
     hd_list = distributed_all_gather([hd_all], out_numpy=False, is_valid=True)
     asd_list = distributed_all_gather([asd_all], out_numpy=False, is_valid=True)
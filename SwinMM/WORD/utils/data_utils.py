@@ -22,16 +22,27 @@ from monai.data import load_decathlon_datalist
 from monai.data.utils import list_data_collate
 
 
-def get_dataset_kwargs(dataset_name: str, stage: str, use_normal_dataset: bool, args) -> MutableMapping[str, Any]:
-    dataset_kwargs = {}
-    if not use_normal_dataset:
-        dataset_kwargs = dict(
-            dataset_name=f"{stage}_{dataset_name}",
+def dataset_in_memory_kwargs(dataset_name: str, args) -> MutableMapping[str, Any]:
+    """CachedDataset arguments, redis if redis ports are given, otherwise the local memory-mapped cache."""
+    backend = args.cache_backend or ("redis" if args.redis_ports else "local")
+    if backend == "redis":
+        return dict(
+            dataset_name=dataset_name,
+            backend="redis",
             hosts=[{"host": "localhost", "port": str(port)} for port in args.redis_ports],
             cluster_mode=True,
             capacity_per_node=200 * 1024 * 1024 * 1024,
             writer_buffer_size=0,  # Disable write buffer
         )
+    return dict(
+        dataset_name=dataset_name, backend="local", cache_dir=args.cache_dir, compression=args.cache_compression
+    )
+
+
+def get_dataset_kwargs(dataset_name: str, stage: str, use_normal_dataset: bool, args) -> MutableMapping[str, Any]:
+    dataset_kwargs = {}
+    if not use_normal_dataset:
+        dataset_kwargs = dataset_in_memory_kwargs(f"{stage}_{dataset_name}", args)
     return dataset_kwargs
 
 
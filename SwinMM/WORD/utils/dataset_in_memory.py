@@ -1,11 +1,23 @@
-"""Cache the data using redis.
+"""Cache the output of the deterministic transforms.
+
+Backends:
+    - "local": memory-mapped files (e.g. in /dev/shm), shared by all the DataLoader workers and ranks of a node.
+    - "redis": bagua's CacheLoader, needs manually launched redis servers.
 
 TODO(meijieru): zeromp may be better.
 """
 
-from typing import Callable, MutableMapping, Optional, Sequence, Union
+import abc
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import zlib
+from typing import Any, Callable, Dict, List, MutableMapping, Optional, Sequence, Tuple, Union
 
-import bagua.torch_api.contrib.cache_loader as bagua_cache_loader
+import numpy as np
 import torch
 import torch.utils.data.dataset as torch_dataset
 
@@ -24,6 +36,8 @@ def hijack_bagua_serialization(method: str):
 
     import pickle
 
+    import bagua.torch_api.contrib.cache_loader as bagua_cache_loader
+
     if method == "lz4":
         import lz4
 
@@ -50,23 +64,217 @@ def is_deterministic_transform(transform) -> bool:
     )
 
 
+class CacheBackend(abc.ABC):
+    """Key-value cache of the dataset items."""
+
+    @abc.abstractmethod
+    def get(self, key: int, load_fn: Callable[[int], Any]) -> Any:
+        """Returns the cached item of `key`, calls and caches `load_fn(key)` if it is missing."""
+
+
+class RedisCacheBackend(CacheBackend):
+    """Cache in redis servers through bagua's CacheLoader."""
+
+    def __init__(
+        self,
+        dataset_name: str,
+        hosts: Optional[Sequence[MutableMapping[str, str]]] = None,
+        writer_buffer_size: int = 20,
+        **kwargs,
+    ):
+        if hosts is None:
+            raise ValueError("We don't init bagua, have to manually launch redis")
+        import bagua.torch_api.contrib.cache_loader as bagua_cache_loader
+
+        self._cache_loader = bagua_cache_loader.CacheLoader(
+            "redis", dataset_name, writer_buffer_size, hosts=hosts, **kwargs
+        )
+
+    def get(self, key: int, load_fn: Callable[[int], Any]) -> Any:
+        return self._cache_loader.get(key, load_fn)
+
+
+class _ArrayRef:
+    """Placeholder of an array stored in the data file."""
+
+    def __init__(self, chunks: List[Tuple[int, int]], dtype: str, shape: Tuple[int, ...], kind: str, meta=None):
+        self.chunks = chunks  # (offset, nbytes) of the (compressed) chunks
+        self.dtype = dtype
+        self.shape = shape
+        self.kind = kind  # "numpy", "torch" or "meta"
+        self.meta = meta  # meta dict and applied operations of MetaTensors
+
+
+_COMPRESSORS: Dict[str, Tuple[Callable, Callable]] = {"zlib": (lambda b: zlib.compress(b, 1), zlib.decompress)}
+
+
+def _get_compressor(method: str) -> Tuple[Callable, Callable]:
+    if method == "lz4" and method not in _COMPRESSORS:
+        import lz4.frame
+
+        _COMPRESSORS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    if method not in _COMPRESSORS:
+        raise ValueError(f"Unknown compress method: {method}")
+    return _COMPRESSORS[method]
+
+
+class LocalCacheBackend(CacheBackend):
+    """
+    Cache in an append-only data file and an index file of `cache_dir`, shared by the processes of a node.
+
+    Arrays and tensors are written raw (or compressed by chunks if `compression` is given), the rest of the item is
+    pickled without them. The data file is memory-mapped read-only (one mapping per process, in the page cache), and
+    each read maps the raw arrays again copy-on-write (zero-copy, the pages are only copied when written), so that
+    the random transforms can modify the returned item in place without changing later reads of the same key.
+    Writers append under a file lock, the index line of an item is written after its data, readers reload the
+    index when a key is missing. The cache is not invalidated when the transforms change, remove `cache_dir` then.
+    """
+
+    def __init__(
+        self, cache_dir: str, compression: Optional[str] = None, chunk_size: int = 1 << 22, min_array_bytes: int = 1024
+    ):
+        self.cache_dir = cache_dir
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.min_array_bytes = min_array_bytes
+        if compression is not None:
+            _get_compressor(compression)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._data_path = os.path.join(cache_dir, "data.bin")
+        self._index_path = os.path.join(cache_dir, "index.txt")
+        self._lock_path = os.path.join(cache_dir, "lock")
+        for path in (self._data_path, self._index_path, self._lock_path):
+            open(path, "ab").close()
+        self._reset()
+
+    def _reset(self):
+        self._index: Dict[int, Tuple[int, int]] = {}  # key -> (offset, nbytes) of the pickled item
+        self._index_offset = 0
+        self._mmap: Optional[mmap.mmap] = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_index={}, _index_offset=0, _mmap=None)  # reopened by each process
+        return state
+
+    def _read_index(self) -> None:
+        with open(self._index_path, "rb") as f:
+            f.seek(self._index_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # being written
+                key, offset, nbytes = (int(v) for v in line.split())
+                self._index[key] = (offset, nbytes)
+                self._index_offset += len(line)
+
+    def _buffer(self, end: int) -> mmap.mmap:
+        if self._mmap is None or len(self._mmap) < end:
+            with open(self._data_path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def _encode(self, item: Any, data: bytearray, base: int) -> Any:
+        """Replaces the arrays of the item by _ArrayRef, appending their bytes to data."""
+        if isinstance(item, (torch.Tensor, np.ndarray)) and item.nbytes >= self.min_array_bytes:
+            kind, meta = "torch", None
+            if isinstance(item, np.ndarray):
+                kind = "numpy"
+            elif isinstance(item, monai_data.MetaTensor):
+                kind, meta = "meta", (item.meta, item.applied_operations)
+            array = item if isinstance(item, np.ndarray) else item.detach().cpu().numpy()
+            raw = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+            pieces = [raw]
+            if self.compression:
+                compress = _get_compressor(self.compression)[0]
+                pieces = [compress(raw[s : s + self.chunk_size].tobytes()) for s in range(0, len(raw), self.chunk_size)]
+            chunks = []
+            for piece in pieces:
+                data.extend(b"\0" * (-(base + len(data)) % 64))  # aligned arrays
+                chunks.append((base + len(data), len(piece)))
+                data.extend(piece)
+            return _ArrayRef(chunks, array.dtype.str, array.shape, kind, meta)
+        if isinstance(item, dict):
+            return type(item)((k, self._encode(v, data, base)) for k, v in item.items())
+        if isinstance(item, (list, tuple)) and not hasattr(item, "_fields"):
+            return type(item)(self._encode(v, data, base) for v in item)
+        return item
+
+    def _decode(self, item: Any, buffer: mmap.mmap) -> Any:
+        if isinstance(item, _ArrayRef):
+            dtype = np.dtype(item.dtype)
+            if self.compression:
+                decompress = _get_compressor(self.compression)[1]
+                raw = b"".join(decompress(buffer[offset : offset + nbytes]) for offset, nbytes in item.chunks)
+                array = np.frombuffer(bytearray(raw), dtype=dtype).reshape(item.shape)
+            else:
+                offset, _ = item.chunks[0]
+                # a private (copy-on-write) mapping per read, the shared read-only mapping is not writable
+                array = np.memmap(self._data_path, dtype=dtype, mode="c", offset=offset, shape=item.shape)
+                array = array.view(np.ndarray)
+            if item.kind == "numpy":
+                return array
+            tensor = torch.from_numpy(array)
+            if item.kind == "meta":
+                meta, applied_operations = item.meta
+                tensor = monai_data.MetaTensor(tensor, meta=meta, applied_operations=applied_operations)
+            return tensor
+        if isinstance(item, dict):
+            return type(item)((k, self._decode(v, buffer)) for k, v in item.items())
+        if isinstance(item, (list, tuple)) and not hasattr(item, "_fields"):
+            return type(item)(self._decode(v, buffer) for v in item)
+        return item
+
+    def _put(self, key: int, item: Any) -> None:
+        with open(self._lock_path, "rb") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._read_index()
+                if key in self._index:
+                    return  # written by another process meanwhile
+                with open(self._data_path, "ab") as f:
+                    base = f.tell()
+                    data = bytearray()
+                    skeleton = pickle.dumps(self._encode(item, data, base), protocol=pickle.HIGHEST_PROTOCOL)
+                    f.write(data)
+                    f.write(skeleton)
+                offset = base + len(data)
+                with open(self._index_path, "ab") as f:
+                    f.write(f"{key} {offset} {len(skeleton)}\n".encode())
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def get(self, key: int, load_fn: Callable[[int], Any]) -> Any:
+        if key not in self._index:
+            self._read_index()
+        if key not in self._index:
+            item = load_fn(key)
+            self._put(key, item)
+            return item
+        offset, nbytes = self._index[key]
+        buffer = self._buffer(offset + nbytes)
+        return self._decode(pickle.loads(buffer[offset : offset + nbytes]), buffer)
+
+
+def _data_fingerprint(data: Sequence) -> str:
+    return hashlib.sha256(json.dumps(list(data), sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+
 class CachedDataset(torch_dataset.Dataset):
     def __init__(
         self,
         data: Sequence,
         transform: Optional[Union[Sequence[Callable], Callable]] = None,
         as_contiguous: bool = True,
-        backend: str = "redis",
+        backend: Union[str, CacheBackend] = "redis",
         hosts: Optional[Sequence[MutableMapping[str, str]]] = None,
         dataset_name: str = "",
         writer_buffer_size: int = 20,
+        cache_dir: str = "/dev/shm/swinmm_cache",
+        compression: Optional[str] = None,
         **kwargs,
     ) -> None:
         super().__init__()
 
-        if hosts is None:
-            raise ValueError("We don't init bagua, have to manually launch redis")
-
         # NOTE(meijieru): check if the dataset name is unique, to avoid
         # potential confliction.
         if not dataset_name or dataset_name in _ALL_DATASET_NAMES:
@@ -74,9 +282,16 @@ class CachedDataset(torch_dataset.Dataset):
         _ALL_DATASET_NAMES.add(dataset_name)
 
         self._dataset = monai_data.Dataset(data=data)
-        self._cache_loader = bagua_cache_loader.CacheLoader(
-            backend, dataset_name, writer_buffer_size, hosts=hosts, **kwargs
-        )
+        if isinstance(backend, CacheBackend):
+            self._cache_loader = backend
+        elif backend == "redis":
+            self._cache_loader = RedisCacheBackend(dataset_name, hosts, writer_buffer_size, **kwargs)
+        elif backend == "local":
+            # the same dataset name with another data list does not reuse the cache
+            cache_dir = os.path.join(cache_dir, f"{dataset_name}_{_data_fingerprint(data)}")
+            self._cache_loader = LocalCacheBackend(cache_dir, compression=compression)
+        else:
+            raise ValueError(f"Unknown cache backend: {backend}")
         self.transform = transform
         self.as_contiguous = as_contiguous
 
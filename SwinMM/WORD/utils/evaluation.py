@@ -0,0 +1,210 @@
+"""Evaluation of the segmentations in a CPU process pool.
+
+The GPU-owning process only submits the argmax of the predictions, the postprocessing (resampling, orientation,
+saving) and the metrics of a case run in a worker process while the next case is inferred.
+Dice, Hausdorff distance and average surface distance are computed from label maps (no one-hot volumes), the
+distances from the boundary voxels only, with a distance transform of the surface of the other segmentation
+restricted to the bounding box of both segmentations.
+The results of each case are appended to a JSON lines file as soon as they are available, so that an
+interrupted run can be resumed without inferring the finished cases again.
+"""
+
+import collections
+import glob
+import json
+import multiprocessing
+import os
+from concurrent import futures
+from typing import Any, Dict, List, Optional, Sequence
+
+import nibabel as nib
+import numpy as np
+import scipy.ndimage as ndimage
+from utils.misc import resample_3d
+
+from monai.transforms import Spacing
+
+METRIC_NAMES = ("dice", "hd", "asd")
+
+
+def _bounding_box(mask: np.ndarray) -> tuple:
+    """Bounding box of a non-empty mask, with a margin of one voxel (inside the image)."""
+    box = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=other_axes))
+        box.append(slice(max(nonzero[0] - 1, 0), min(nonzero[-1] + 2, mask.shape[axis])))
+    return tuple(box)
+
+
+def _edges(mask: np.ndarray) -> np.ndarray:
+    """Boundary voxels of a mask (same definition as monai.metrics.utils.get_mask_edges)."""
+    return ndimage.binary_erosion(mask) ^ mask
+
+
+def surface_metrics(pred: np.ndarray, label: np.ndarray, num_classes: int, percentile: float = 95) -> np.ndarray:
+    """
+    Dice, percentile Hausdorff distance and average surface distance of the foreground classes.
+
+    The values follow `compute_meandice`, `compute_hausdorff_distance` and `compute_average_surface_distance`
+    of monai (without background): the dice is NaN if the class is not in `label`, the distances are inf if
+    the class is in only one of `pred` and `label`, and NaN if it is in neither.
+
+    Returns:
+        array of shape (3, num_classes - 1), the rows are METRIC_NAMES.
+    """
+    metrics = np.full((len(METRIC_NAMES), num_classes - 1), np.nan)
+    for c in range(1, num_classes):
+        seg_pred, seg_gt = pred == c, label == c
+        gt_sum, pred_sum = seg_gt.sum(), seg_pred.sum()
+        if gt_sum > 0:
+            metrics[0, c - 1] = 2.0 * np.logical_and(seg_pred, seg_gt).sum() / (gt_sum + pred_sum)
+        if gt_sum == 0 or pred_sum == 0:
+            if gt_sum > 0 or pred_sum > 0:
+                metrics[1:, c - 1] = np.inf
+            continue
+
+        box = _bounding_box(seg_pred | seg_gt)
+        edges_pred, edges_gt = _edges(seg_pred[box]), _edges(seg_gt[box])
+        # distances of the boundary voxels of one segmentation to the boundary of the other
+        pred_to_gt = ndimage.distance_transform_edt(~edges_gt)[edges_pred]
+        gt_to_pred = ndimage.distance_transform_edt(~edges_pred)[edges_gt]
+        metrics[1, c - 1] = max(np.percentile(pred_to_gt, percentile), np.percentile(gt_to_pred, percentile))
+        metrics[2, c - 1] = pred_to_gt.mean()
+    return metrics
+
+
+def _resample_1mm(spacing: Spacing, img: np.ndarray, affine: np.ndarray) -> np.ndarray:
+    """Resamples a channel-first (single channel) volume to 1 mm, returns the spatial volume."""
+    output = spacing(img, affine)
+    if isinstance(output, tuple):  # (data, old affine, new affine)
+        output = output[0]
+    output = np.asarray(output)
+    return output.reshape(output.shape[-3:])
+
+
+def evaluate_case(
+    img_name: str,
+    outputs: Sequence[np.ndarray],
+    label: np.ndarray,
+    original_affine: np.ndarray,
+    target_shape: Sequence[int],
+    output_directory: str,
+    view_names: Sequence[str],
+    num_classes: int,
+    percentile: float = 95,
+    save_outputs: bool = True,
+) -> Dict[str, Any]:
+    """
+    Postprocesses and evaluates the argmax `outputs` (one per view) of a case, runs in a worker process.
+    """
+    spacing = Spacing(pixdim=(1, 1, 1), mode="nearest")
+    label = _resample_1mm(spacing, label, original_affine)
+    target_ornt = nib.orientations.axcodes2ornt(tuple(nib.aff2axcodes(original_affine)))
+    ornt_transf = nib.orientations.ornt_transform([[0, 1], [1, 1], [2, 1]], target_ornt)
+
+    metrics = []
+    for view_name, output in zip(view_names, outputs):
+        output = resample_3d(output, target_shape)
+        output = nib.orientations.apply_orientation(output, ornt_transf)
+        if save_outputs:
+            nib.save(
+                nib.Nifti1Image(output.astype(np.uint8), affine=original_affine),
+                os.path.join(output_directory, view_name + "_" + img_name),
+            )
+        output = _resample_1mm(spacing, np.expand_dims(output, axis=0), original_affine)
+        metrics.append(surface_metrics(output, label, num_classes, percentile))
+    metrics = np.stack(metrics, axis=1)  # metric x view x class
+    return {"case": img_name, **{name: metrics[i].tolist() for i, name in enumerate(METRIC_NAMES)}}
+
+
+class EvaluationEngine:
+    """
+    Evaluates the cases submitted by the inference loop in a pool of CPU processes.
+
+    At most `max_pending` cases are in flight, `submit` waits for the oldest one beyond that.
+    The finished cases are appended to `<output_directory>/metrics_rank<rank>.jsonl`, and all the metrics files
+    of the directory are read at start, so that `done` skips the cases evaluated by a previous (interrupted) run,
+    even with a different number of ranks.
+    """
+
+    def __init__(
+        self,
+        output_directory: str,
+        view_names: Sequence[str],
+        num_classes: int,
+        rank: int = 0,
+        num_workers: int = 4,
+        max_pending: Optional[int] = None,
+        percentile: float = 95,
+        save_outputs: bool = True,
+    ):
+        self.output_directory = output_directory
+        self.view_names = list(view_names)
+        self.num_classes = num_classes
+        self.percentile = percentile
+        self.save_outputs = save_outputs
+        self.max_pending = max_pending or 2 * num_workers
+        self.results: Dict[str, Dict[str, Any]] = {}
+        for filename in sorted(glob.glob(os.path.join(output_directory, "metrics_rank*.jsonl"))):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # incomplete line of an interrupted run
+                    self.results[result["case"]] = result
+        self.results_file = open(os.path.join(output_directory, f"metrics_rank{rank}.jsonl"), "a+")
+        if self.results_file.tell() > 0:
+            self.results_file.seek(self.results_file.tell() - 1)
+            if self.results_file.read(1) != "\n":
+                self.results_file.write("\n")  # terminates an incomplete line
+        # spawn, the inference process has initialized CUDA
+        self.pool = futures.ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"))
+        self.pending: collections.deque = collections.deque()
+
+    def done(self, img_name: str) -> bool:
+        return img_name in self.results
+
+    def submit(self, img_name: str, outputs, label, original_affine, target_shape) -> None:
+        while len(self.pending) >= self.max_pending:
+            self._collect(self.pending.popleft())
+        future = self.pool.submit(
+            evaluate_case,
+            img_name,
+            outputs,
+            label,
+            original_affine,
+            target_shape,
+            self.output_directory,
+            self.view_names,
+            self.num_classes,
+            self.percentile,
+            self.save_outputs,
+        )
+        self.pending.append(future)
+        while self.pending and self.pending[0].done():
+            self._collect(self.pending.popleft())
+
+    def _collect(self, future: futures.Future) -> None:
+        result = future.result()
+        self.results[result["case"]] = result
+        self.results_file.write(json.dumps(result) + "\n")
+        self.results_file.flush()
+        for i, view_name in enumerate(self.view_names):
+            print("{} {} View Mean Dice: {}".format(result["case"], view_name, np.mean(result["dice"][i])))
+            print("{} {} View Mean HD: {}".format(result["case"], view_name, np.mean(result["hd"][i])))
+            print("{} {} View Mean ASD: {}".format(result["case"], view_name, np.mean(result["asd"][i])))
+
+    def close(self) -> None:
+        while self.pending:
+            self._collect(self.pending.popleft())
+        self.pool.shutdown()
+        self.results_file.close()
+
+    def metrics(self, img_names: List[str]) -> Dict[str, np.ndarray]:
+        """Metrics of the cases, arrays of shape (num_cases, num_views, num_classes - 1)."""
+        return {
+            name: np.array([self.results[img_name][name] for img_name in img_names], dtype=np.float64)
+            for name in METRIC_NAMES
+        }
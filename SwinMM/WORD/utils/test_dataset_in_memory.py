@@ -0,0 +1,53 @@
+"""Unit test for the local cache backend of the in-memory dataset."""
+
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+from utils import dataset_in_memory
+
+import monai.data as monai_data
+
+
+def _load(key):
+    return {
+        "image": monai_data.MetaTensor(torch.full((1, 16, 16, 8), float(key)), meta={"key": key}),
+        "label": np.full((1, 16, 16, 8), key, dtype=np.uint8),
+        "name": f"case_{key}",
+    }
+
+
+class LocalCacheBackendTest(unittest.TestCase):
+    def _check_round_trip(self, compression):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            backend = dataset_in_memory.LocalCacheBackend(cache_dir, compression=compression)
+            for key in range(3):
+                backend.get(key, _load)  # miss, written to the cache
+
+            reader = dataset_in_memory.LocalCacheBackend(cache_dir, compression=compression)
+            for key in range(3):
+                item = reader.get(key, lambda k: self.fail("cached item reloaded"))
+                self.assertEqual(item["name"], f"case_{key}")
+                self.assertEqual(item["image"].meta["key"], key)
+                np.testing.assert_array_equal(item["image"].numpy(), _load(key)["image"].numpy())
+                np.testing.assert_array_equal(item["label"], _load(key)["label"])
+                if compression is None:
+                    self.assertFalse(item["label"].flags.owndata)  # mapped, not copied
+
+                # in place changes (e.g. random transforms) do not reach later reads of the same key
+                item["image"].add_(100)
+                item["label"][:] = 255
+                again = reader.get(key, lambda k: self.fail("cached item reloaded"))
+                np.testing.assert_array_equal(again["image"].numpy(), _load(key)["image"].numpy())
+                np.testing.assert_array_equal(again["label"], _load(key)["label"])
+
+    def test_round_trip(self):
+        self._check_round_trip(compression=None)
+
+    def test_round_trip_compressed(self):
+        self._check_round_trip(compression="zlib")
+
+
+if __name__ == "__main__":
+    unittest.main()
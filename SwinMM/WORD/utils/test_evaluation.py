@@ -0,0 +1,64 @@
+"""Unit test for the evaluation metrics, against the metrics of monai."""
+
+import unittest
+
+import numpy as np
+import torch
+from utils import evaluation
+
+from monai.metrics import compute_average_surface_distance, compute_dice, compute_hausdorff_distance
+from monai.networks.utils import one_hot
+
+
+def _random_boxes(rng, shape, num_classes, num_boxes=3):
+    """Label map of random (overlapping) boxes of the foreground classes."""
+    label = np.zeros(shape, dtype=np.int64)
+    for c in range(1, num_classes):
+        for _ in range(num_boxes):
+            start = [rng.integers(0, s - 2) for s in shape]
+            stop = [rng.integers(b + 1, s + 1) for b, s in zip(start, shape)]
+            label[tuple(slice(b, e) for b, e in zip(start, stop))] = c
+    return label
+
+
+def _monai_metrics(pred, label, num_classes, percentile):
+    y_pred = one_hot(torch.as_tensor(pred)[None, None], num_classes)
+    y = one_hot(torch.as_tensor(label)[None, None], num_classes)
+    dice = compute_dice(y_pred, y, include_background=False)
+    hd = compute_hausdorff_distance(y_pred, y, include_background=False, percentile=percentile)
+    asd = compute_average_surface_distance(y_pred, y, include_background=False)
+    return np.stack([m[0].numpy() for m in (dice, hd, asd)])
+
+
+class SurfaceMetricsTest(unittest.TestCase):
+    def _check(self, pred, label, num_classes, percentile=95):
+        expected = _monai_metrics(pred, label, num_classes, percentile)
+        metrics = evaluation.surface_metrics(pred, label, num_classes, percentile)
+        np.testing.assert_allclose(metrics, expected, rtol=1e-5, atol=1e-5)
+
+    def test_random_masks(self):
+        rng = np.random.default_rng(0)
+        for _ in range(10):
+            label = _random_boxes(rng, (12, 10, 8), num_classes=4)
+            pred = _random_boxes(rng, (12, 10, 8), num_classes=4)
+            pred = np.where(rng.uniform(size=pred.shape) < 0.5, label, pred)  # partially overlapping
+            self._check(pred, label, num_classes=4)
+
+    def test_missing_classes(self):
+        label = np.zeros((12, 10, 8), dtype=np.int64)
+        label[1:5, 1:5, 1:4] = 1
+        label[6:10, 2:8, 3:7] = 3
+        pred = np.zeros_like(label)
+        pred[2:6, 5:9, 2:6] = 2  # class 1 missing in the prediction, class 2 missing in the label
+        pred[7:11, 2:7, 3:6] = 3
+        metrics = evaluation.surface_metrics(pred, label, num_classes=5)  # class 4 missing in both
+        self.assertEqual(metrics[0, 0], 0)
+        self.assertTrue(np.isnan(metrics[0, 1]))
+        self.assertTrue(np.all(np.isinf(metrics[1:, :2])))
+        self.assertTrue(np.all(np.isfinite(metrics[:, 2])))
+        self.assertTrue(np.all(np.isnan(metrics[:, 3])))
+        self._check(pred, label, num_classes=5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -188,6 +188,7 @@ def main():
     parser.add_argument("--dist-url", default="env://", help="url used to set up distributed training")
     parser.add_argument("--smartcache_dataset", action="store_true", help="use monai smartcache Dataset")
     parser.add_argument("--cache_dataset", action="store_true", help="use monai cache Dataset")
+    parser.add_argument("--seed", default=None, type=int, help="seed of the rotation and drop augmentations")
 
     args = parser.parse_args()
     logdir = "./runs/" + args.logdir
@@ -214,6 +215,9 @@ def main():
     else:
         print("Training with a single process on 1 GPUs.")
     assert args.rank >= 0
+    if args.seed is not None:
+        args.aug_rng = np.random.default_rng([args.seed, args.rank])
+        args.aug_generator = torch.Generator(device=args.device).manual_seed(args.seed * 1000 + args.rank)
 
     if args.rank == 0:
         os.makedirs(logdir, exist_ok=True)
@@ -11,65 +11,168 @@
 
 import numpy as np
 import torch
-from numpy.random import randint
 
 
-def patch_rand_drop(args, x, x_rep=None, max_drop=0.3, max_block_sz=0.25, tolr=0.05):
-    c, h, w, z = x.size()
-    n_drop_pix = np.random.uniform(0, max_drop) * h * w * z
+def get_rng(args):
+    """
+    Host random generator of the augmentations, args.aug_rng if set (e.g. seeded by --seed),
+    otherwise one derived from the global numpy random state.
+    """
+    rng = getattr(args, "aug_rng", None)
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(0, 2**31 - 1))
+    return rng
+
+
+def sample_drop_boxes(rng, size, max_drop=0.3, max_block_sz=0.25, tolr=0.05):
+    """
+    Samples the blocks (r0, c0, s0, r1, c1, s1) to drop in a volume of spatial size (h, w, z), until their total
+    size reaches a random fraction (up to max_drop) of the volume. The blocks may overlap, later blocks are on top.
+    """
+    h, w, z = size
+    n_drop_pix = rng.uniform(0, max_drop) * h * w * z
     mx_blk_height = int(h * max_block_sz)
     mx_blk_width = int(w * max_block_sz)
     mx_blk_slices = int(z * max_block_sz)
     tolr = (int(tolr * h), int(tolr * w), int(tolr * z))
+    boxes = []
     total_pix = 0
     while total_pix < n_drop_pix:
-        rnd_r = randint(0, h - tolr[0])
-        rnd_c = randint(0, w - tolr[1])
-        rnd_s = randint(0, z - tolr[2])
-        rnd_h = min(randint(tolr[0], mx_blk_height) + rnd_r, h)
-        rnd_w = min(randint(tolr[1], mx_blk_width) + rnd_c, w)
-        rnd_z = min(randint(tolr[2], mx_blk_slices) + rnd_s, z)
-        if x_rep is None:
-            x_uninitialized = torch.empty(
-                (c, rnd_h - rnd_r, rnd_w - rnd_c, rnd_z - rnd_s), dtype=x.dtype, device=args.local_rank
-            ).normal_()
-            x_uninitialized = (x_uninitialized - torch.min(x_uninitialized)) / (
-                torch.max(x_uninitialized) - torch.min(x_uninitialized)
-            )
-            x[:, rnd_r:rnd_h, rnd_c:rnd_w, rnd_s:rnd_z] = x_uninitialized
-        else:
-            x[:, rnd_r:rnd_h, rnd_c:rnd_w, rnd_s:rnd_z] = x_rep[:, rnd_r:rnd_h, rnd_c:rnd_w, rnd_s:rnd_z]
+        rnd_r = rng.integers(0, h - tolr[0])
+        rnd_c = rng.integers(0, w - tolr[1])
+        rnd_s = rng.integers(0, z - tolr[2])
+        rnd_h = min(rng.integers(tolr[0], mx_blk_height) + rnd_r, h)
+        rnd_w = min(rng.integers(tolr[1], mx_blk_width) + rnd_c, w)
+        rnd_z = min(rng.integers(tolr[2], mx_blk_slices) + rnd_s, z)
+        boxes.append((rnd_r, rnd_c, rnd_s, rnd_h, rnd_w, rnd_z))
         total_pix = total_pix + (rnd_h - rnd_r) * (rnd_w - rnd_c) * (rnd_z - rnd_s)
+    return np.asarray(boxes, dtype=np.int64).reshape(-1, 6)
+
+
+def _pad_boxes(boxes, device):
+    """Blocks of all the images as a tensor of shape (len(boxes), max number of blocks, 6), padded with empty blocks."""
+    num_boxes = max([len(b) for b in boxes] + [1])
+    padded = np.zeros((len(boxes), num_boxes, 6), dtype=np.int64)  # empty blocks
+    for i, b in enumerate(boxes):
+        padded[i, : len(b)] = b
+    return torch.as_tensor(padded, device=device)
+
+
+def _box_masks(padded, size, chunk_size=8):
+    """Yields (k, inside), the masks (B x K x h x w x z) of the blocks k to k + K of each image, K <= chunk_size."""
+    for k in range(0, padded.shape[1], chunk_size):
+        box = padded[:, k : k + chunk_size]  # B x K x 6
+        inside = []
+        for d in range(3):
+            coords = torch.arange(size[d], device=padded.device)
+            inside.append((coords >= box[..., d, None]) & (coords < box[..., d + 3, None]))  # B x K x size[d]
+        yield k, inside[0][..., :, None, None] & inside[1][..., None, :, None] & inside[2][..., None, None, :]
+
+
+def box_label_map(boxes, size, device, chunk_size=8):
+    """
+    Index (starting at 1) of the last block covering each voxel, 0 if none.
+
+    Args:
+        boxes: list (one per image) of arrays of blocks, as returned by sample_drop_boxes.
+        size: spatial size (h, w, z).
+
+    Returns:
+        tensor of shape (len(boxes), h, w, z).
+    """
+    padded = _pad_boxes(boxes, device)
+    labels = torch.zeros((len(boxes), *size), dtype=torch.int32, device=device)
+    for k, inside in _box_masks(padded, size, chunk_size):
+        index = torch.arange(k + 1, k + 1 + inside.shape[1], dtype=torch.int32, device=device)
+        labels = torch.maximum(labels, (inside * index[None, :, None, None, None]).amax(dim=1))
+    return labels
+
+
+def block_noise(boxes, labels, channels, dtype, generator=None, chunk_size=8):
+    """
+    Gaussian noise of shape (B, channels, h, w, z), min-max normalized to [0, 1] over the full extent of each block
+    (as if each block was filled in turn), taking the values of the last block covering each voxel (labels,
+    as returned by box_label_map for the same boxes).
+    """
+    n, *size = labels.shape
+    noise = torch.empty((n, channels, *size), dtype=torch.float32, device=labels.device).normal_(generator=generator)
+    padded = _pad_boxes(boxes, labels.device)
+    # per (image, channel, block) range, column 0 (outside the blocks) is left as is
+    box_min = noise.new_zeros((n, channels, padded.shape[1] + 1))
+    box_max = noise.new_ones((n, channels, padded.shape[1] + 1))
+    for k, inside in _box_masks(padded, size, chunk_size):
+        inside = inside[:, None].flatten(3)  # B x 1 x K x (h * w * z)
+        values = noise[:, :, None].flatten(3)  # B x C x 1 x (h * w * z)
+        chunk = slice(k + 1, k + 1 + inside.shape[2])
+        box_min[..., chunk] = torch.where(inside, values, values.new_tensor(float("inf"))).amin(dim=-1)
+        box_max[..., chunk] = torch.where(inside, values, values.new_tensor(float("-inf"))).amax(dim=-1)
+    index = labels.long().view(n, 1, -1).expand(n, channels, -1)
+    voxel_min, voxel_max = box_min.gather(2, index), box_max.gather(2, index)
+    scale = torch.where(voxel_max > voxel_min, voxel_max - voxel_min, torch.ones_like(voxel_max))
+    return ((noise.flatten(2) - voxel_min) / scale).view_as(noise).to(dtype)
+
+
+def patch_rand_drop(args, x, x_rep=None, max_drop=0.3, max_block_sz=0.25, tolr=0.05):
+    c, h, w, z = x.size()
+    boxes = sample_drop_boxes(get_rng(args), (h, w, z), max_drop, max_block_sz, tolr)
+    labels = box_label_map([boxes], (h, w, z), x.device)
+    if x_rep is None:
+        x_rep = block_noise([boxes], labels, c, x.dtype, getattr(args, "aug_generator", None))[0]
+    x[:] = torch.where(labels > 0, x_rep, x)
     return x
 
 
 def rot_rand(args, x_s):
-    img_n = x_s.size()[0]
-    x_aug = x_s.detach().clone()
-    device = torch.device(f"cuda:{args.local_rank}")
-    x_rot = torch.zeros(img_n).long().to(device)
-    for i in range(img_n):
-        x = x_s[i]
-        orientation = np.random.randint(0, 4)
-        if orientation == 0:
-            pass
-        elif orientation == 1:
-            x = x.rot90(1, (2, 3))
-        elif orientation == 2:
-            x = x.rot90(2, (2, 3))
-        elif orientation == 3:
-            x = x.rot90(3, (2, 3))
-        x_aug[i] = x
-        x_rot[i] = orientation
-    return x_aug, x_rot
+    """
+    Rotates each image of the batch by a random multiple of 90 degrees in the (w, z) plane, i.e. as
+    x.rot90(k, (2, 3)) of each image x of shape (c, h, w, z), with a single gather.
+    """
+    img_n, c, h, w, z = x_s.size()
+    if w != z:
+        raise ValueError(f"rotations need square (w, z) planes, got {w} x {z}.")
+    device = x_s.device
+    orientation = torch.as_tensor(get_rng(args).integers(0, 4, img_n), dtype=torch.long, device=device)
+    # source (w, z) position of each output voxel of the plane, for the rotations k = 0..3
+    i = torch.arange(w, device=device).view(w, 1).expand(w, z)
+    j = torch.arange(z, device=device).view(1, z).expand(w, z)
+    rows = torch.stack([i, j, w - 1 - i, w - 1 - j])
+    cols = torch.stack([j, z - 1 - i, z - 1 - j, i])
+    index = (rows * z + cols).view(4, w * z)[orientation]  # B x (w * z)
+    index = index.view(img_n, 1, 1, w * z).expand(img_n, c, h, w * z)
+    x_aug = torch.gather(x_s.detach().reshape(img_n, c, h, w * z), 3, index).view_as(x_s)
+    return x_aug, orientation
 
 
 def aug_rand(args, samples):
-    img_n = samples.size()[0]
-    x_aug = samples.detach().clone()
+    """
+    Drops random blocks of each image, filled with noise, then replaces random blocks with the same blocks of a
+    random image of the batch (as augmented so far, i.e. original for the later images), with a mask composite
+    per stage instead of a loop over blocks and images.
+    """
+    img_n, c, h, w, z = samples.size()
+    rng = get_rng(args)
+    noise_boxes, rep_boxes, sources = [], [], []
     for i in range(img_n):
-        x_aug[i] = patch_rand_drop(args, x_aug[i])
-        idx_rnd = randint(0, img_n)
-        if idx_rnd != i:
-            x_aug[i] = patch_rand_drop(args, x_aug[i], x_aug[idx_rnd])
+        noise_boxes.append(sample_drop_boxes(rng, (h, w, z)))
+        sources.append(int(rng.integers(0, img_n)))
+        rep_boxes.append(sample_drop_boxes(rng, (h, w, z)) if sources[i] != i else np.zeros((0, 6), dtype=np.int64))
+
+    samples = samples.detach()
+    labels = box_label_map(noise_boxes, (h, w, z), samples.device)
+    noise = block_noise(noise_boxes, labels, c, samples.dtype, getattr(args, "aug_generator", None))
+    x_aug = torch.where(labels[:, None] > 0, noise, samples)
+    del noise
+
+    # images replaced from an earlier image wait for its final result
+    rep_mask = box_label_map(rep_boxes, (h, w, z), samples.device)[:, None] > 0
+    levels = [0] * img_n
+    for i, src in enumerate(sources):
+        levels[i] = levels[src] + 1 if src < i else 0
+    for level in range(max(levels) + 1):
+        selected = [i for i in range(img_n) if levels[i] == level and sources[i] != i]
+        if not selected:
+            continue
+        src = [sources[i] for i in selected]
+        x_src = samples[src] if level == 0 else x_aug[src]
+        x_aug[selected] = torch.where(rep_mask[selected], x_src, x_aug[selected])
     return x_aug
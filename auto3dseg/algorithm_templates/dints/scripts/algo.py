@@ -10,7 +10,6 @@
 # limitations under the License.
 
 import os
-import subprocess
 import sys
 import warnings
 from copy import deepcopy
@@ -308,89 +307,73 @@ class DintsAlgo(BundleAlgo):
         return fill_records
 
     def customize_param_for_gpu(self, output_path, data_stats_file, fill_records, gpu_customization_specs):
-        # optimize batch size for model training
-        import optuna
+        # optimize batch size for model training, with an in-process memory-fit search (the network is built once)
+        if __package__ in (None, ""):
+            from dummy_runner import DummyRunnerDiNTS
+        else:
+            from .dummy_runner import DummyRunnerDiNTS
 
         # default range
-        num_trials = 60
         range_num_images_per_batch = [1, 20]
         range_num_sw_batch_size = [1, 40]
+        dry_run = not torch.cuda.is_available()
+        memory_gb = 16
 
         # load customized range
         if "dints" in gpu_customization_specs or "universal" in gpu_customization_specs:
             specs_section = "dints" if "dints" in gpu_customization_specs else "universal"
             specs = gpu_customization_specs[specs_section]
 
-            if "num_trials" in specs:
-                num_trials = specs["num_trials"]
-
             if "range_num_images_per_batch" in specs:
                 range_num_images_per_batch = specs["range_num_images_per_batch"]
 
             if "range_num_sw_batch_size" in specs:
                 range_num_sw_batch_size = specs["range_num_sw_batch_size"]
 
-        mem = get_mem_from_visible_gpus()
-        device_id = np.argmin(mem)
-        print(f"[info] device {device_id} in visible GPU list has the minimum memory.")
+            # estimate the memory usage without running on GPU
+            dry_run = specs.get("dry_run", dry_run)
+            memory_gb = specs.get("memory_gb", memory_gb)
 
-        mem = min(mem) if isinstance(mem, list) else mem
-        mem = round(float(mem) / 1024.0)
+        device_id = 0
+        if not dry_run:
+            mem = get_mem_from_visible_gpus()
+            device_id = int(np.argmin(mem))
+            print(f"[info] device {device_id} in visible GPU list has the minimum memory.")
+            memory_gb = float(min(mem)) / 1024**3
 
-        def objective(trial):
-            num_images_per_batch = trial.suggest_int(
-                "num_images_per_batch", range_num_images_per_batch[0], range_num_images_per_batch[1]
-            )
-            num_sw_batch_size = trial.suggest_int(
-                "num_sw_batch_size", range_num_sw_batch_size[0], range_num_sw_batch_size[1]
-            )
-            validation_data_device = trial.suggest_categorical("validation_data_device", ["cpu", "gpu"])
-            device_factor = 2.0 if validation_data_device == "gpu" else 1.0
+        runner = DummyRunnerDiNTS(
+            output_path=output_path, data_stats_file=data_stats_file, device_id=device_id, dry_run=dry_run
+        )
 
-            try:
-                cmd = "python {0:s}dummy_runner.py ".format(os.path.join(output_path, "scripts") + os.sep)
-                cmd += "--output_path {0:s} ".format(output_path)
-                cmd += "--data_stats_file {0:s} ".format(data_stats_file)
-                cmd += "--device_id {0:d} ".format(device_id)
-                cmd += "run "
-                cmd += f"--num_images_per_batch {num_images_per_batch} "
-                cmd += f"--num_sw_batch_size {num_sw_batch_size} "
-                cmd += f"--validation_data_device {validation_data_device}"
-                _ = subprocess.run(cmd.split(), check=True)
-            except RuntimeError as e:
-                if not any(x in str(e).lower() for x in ("memory", "cuda", "cudnn")):
-                    raise e
-                print("[error] OOM")
-                return float(num_images_per_batch) * float(num_sw_batch_size) * device_factor
-
-            value = -1.0 * float(num_images_per_batch) * float(num_sw_batch_size) * device_factor
-
-            return value
-
-        opt_result_file = os.path.join(output_path, "..", f"gpu_opt_{mem}gb.yaml")
+        opt_result_file = os.path.join(output_path, "..", f"gpu_opt_{round(memory_gb)}gb.yaml")
+        opt_results = {}
         if os.path.exists(opt_result_file):
             with open(opt_result_file) as in_file:
-                best_trial = yaml.full_load(in_file)
-
-        if not os.path.exists(opt_result_file) or "dints" not in best_trial:
-            study = optuna.create_study()
-            study.optimize(objective, n_trials=num_trials)
-            trial = study.best_trial
+                opt_results = yaml.full_load(in_file) or {}
+
+        best_trial = opt_results.get("dints", {}).get("training", None)
+        if best_trial is None or opt_results["dints"].get("config_hash", None) != runner.config_hash:
+            trial = runner.search(
+                memory_gb=memory_gb,
+                range_num_images_per_batch=range_num_images_per_batch,
+                range_num_sw_batch_size=range_num_sw_batch_size,
+            )
             best_trial = {}
-            best_trial["num_images_per_batch"] = max(int(trial.params["num_images_per_batch"]) - 1, 1)
-            best_trial["num_sw_batch_size"] = max(int(trial.params["num_sw_batch_size"]) - 1, 1)
-            best_trial["validation_data_device"] = trial.params["validation_data_device"]
-            best_trial["value"] = int(trial.value)
-            with open(opt_result_file, "a") as out_file:
-                yaml.dump({"dints": {"training": best_trial}}, stream=out_file)
+            best_trial["num_images_per_batch"] = max(int(trial["num_images_per_batch"]) - 1, 1)
+            best_trial["num_sw_batch_size"] = max(int(trial["num_sw_batch_size"]) - 1, 1)
+            best_trial["validation_data_device"] = trial["validation_data_device"]
+            best_trial["value"] = int(trial["value"])
+
+            opt_results["dints"] = {"training": best_trial, "config_hash": runner.config_hash}
+            with open(opt_result_file, "w") as out_file:
+                yaml.dump(opt_results, stream=out_file)
 
             print("\n-----  Finished Optimization  -----")
             print("Optimal value: {}".format(best_trial["value"]))
             print("Best hyperparameters: {}".format(best_trial))
-        else:
-            with open(opt_result_file) as in_file:
-                best_trial = yaml.full_load(in_file)
-            best_trial = best_trial["dints"]["training"]
+
+        runner = None
+        torch.cuda.empty_cache()
 
         if best_trial["value"] < 0:
             fill_records["hyper_parameters.yaml"].update(
@@ -0,0 +1,95 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from monai.data import DataLoader
+
+
+class IncrementalValidation:
+    """
+    Validation of a rotating subset of the (local) validation cases at each round, instead of all of them.
+    The metric values of every case are cached with the epoch at which they were computed, and the reported
+    metric is computed from the cache, so each round only refreshes the oldest cases. The number of cases per round
+    is chosen so that the validation time is about time_fraction of the training time of the round.
+    If the cached metric is within best_margin of the best metric (the model may become the best),
+    the remaining (stale) cases are validated as well, so that a best checkpoint is always selected by a full pass.
+
+    Each rank keeps the cache of its own validation cases, the caller all-reduces the metric and the stale counts.
+    The cases are the items dataset_indices of the validation dataset (by default all of them, i.e. a dataset of
+    the cases of this rank). The cached values may hold any per case sums (e.g. the loss as well as the metric).
+    """
+
+    def __init__(
+        self,
+        num_cases: int,
+        time_fraction: float = 0.25,
+        best_margin: float = 0.01,
+        min_cases: int = 1,
+        dataset_indices: Optional[Sequence[int]] = None,
+    ) -> None:
+        self.dataset_indices = list(range(num_cases) if dataset_indices is None else dataset_indices)
+        if len(self.dataset_indices) != num_cases:
+            raise ValueError(f"dataset_indices has {len(self.dataset_indices)} items, expected {num_cases}.")
+        self.num_cases = num_cases
+        self.time_fraction = time_fraction
+        self.best_margin = best_margin
+        self.min_cases = max(1, min_cases)
+        self.cache: Dict[int, Tuple[torch.Tensor, int]] = {}  # case index -> (metric value, epoch)
+        self.time_per_case: Optional[float] = None
+
+    def select(self, train_time: float) -> List[int]:
+        """
+        The oldest cases (never validated ones first) fitting into time_fraction of train_time
+        """
+        if self.time_per_case is None or len(self.cache) < self.num_cases:
+            num = self.num_cases
+        else:
+            num = int(self.time_fraction * train_time / max(self.time_per_case, 1e-6))
+            num = min(max(num, self.min_cases), self.num_cases)
+        order = sorted(range(self.num_cases), key=lambda i: (self.cache[i][1] if i in self.cache else -1, i))
+        return order[:num]
+
+    def stale(self, epoch: int) -> List[int]:
+        return [i for i in range(self.num_cases) if i not in self.cache or self.cache[i][1] != epoch]
+
+    def loader(self, val_loader: DataLoader, indices: List[int]) -> DataLoader:
+        return DataLoader(
+            val_loader.dataset,
+            batch_size=1,
+            sampler=[self.dataset_indices[i] for i in indices],
+            num_workers=val_loader.num_workers,
+            collate_fn=val_loader.collate_fn,
+        )
+
+    def update(self, index: int, value: torch.Tensor, epoch: int) -> None:
+        self.cache[index] = (value.detach().float().cpu(), epoch)
+
+    def update_time(self, num_cases: int, elapsed: float) -> None:
+        if num_cases > 0:
+            self.time_per_case = elapsed / num_cases
+
+    def metric(self, like: torch.Tensor) -> torch.Tensor:
+        """
+        The sum of the cached values of all cases (zeros like `like` if there are none)
+        """
+        values = [v for v, _ in self.cache.values()]
+        if len(values) == 0:
+            return torch.zeros_like(like)
+        return torch.stack(values).sum(dim=0).to(device=like.device, dtype=like.dtype)
+
+    def may_become_best(self, avg_metric: float, best_metric: float) -> bool:
+        return avg_metric >= best_metric - self.best_margin
+
+    def ages(self, epoch: int) -> List[int]:
+        return [epoch - e for _, e in self.cache.values()]
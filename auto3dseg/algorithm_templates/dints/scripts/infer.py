@@ -31,6 +31,12 @@ from monai.data import ThreadDataLoader, decollate_batch, list_data_collate
 from monai.inferers import sliding_window_inference
 from monai.utils.misc import ensure_tuple
 
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+if __package__ in (None, ""):
+    from sharded_inference import CompletedCases, partition_by_voxels
+else:
+    from .sharded_inference import CompletedCases, partition_by_voxels
+
 CONFIG = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -142,6 +148,128 @@ def pre_operation(config_file, **override):
     return parser
 
 
+def is_out_of_memory(e: BaseException) -> bool:
+    """Out of memory errors of the device, including the RuntimeErrors raised by the CUDA and cuDNN kernels"""
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and any(x in str(e).lower() for x in ("memory", "cuda", "cudnn"))
+
+
+class InferencePlanner:
+    """
+    Chooses the device placement of the input image and of the output (stitching) buffer of the sliding window
+    inference up front, from the estimated buffer sizes (volume shape, number of output channels, dtype) and the
+    available device memory, instead of retrying the whole inference on out-of-memory errors.
+    The peak memory of a window forward pass is measured once, on the first case. A placement whose measurement
+    runs out of memory does not fit, the next one is tried.
+    Device memory is reused across cases by the caching allocator (no per-case cache flush).
+    """
+
+    def __init__(
+        self,
+        device,
+        roi_size,
+        num_sw_batch_size=None,
+        num_patches_per_iter=1,
+        sw_input_on_cpu=False,
+        amp=True,
+        memory_fraction=0.9,
+    ):
+        self.device = torch.device(device)
+        self.roi_size = roi_size
+        self.num_sw_batch_size = num_sw_batch_size
+        self.num_patches_per_iter = num_patches_per_iter
+        self.sw_input_on_cpu = sw_input_on_cpu
+        self.amp = amp
+        self.memory_fraction = memory_fraction
+        self.window_bytes = {}
+        self.num_output_channels = None
+
+    def sw_batch_size(self, device_out):
+        if self.num_sw_batch_size is None:
+            return self.num_patches_per_iter * 8 if device_out == "cpu" else 1
+        return self.num_sw_batch_size
+
+    def available_bytes(self):
+        free = torch.cuda.mem_get_info(self.device)[0]
+        cached = torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        return int(self.memory_fraction * (free + cached))
+
+    def measure_window(self, model, image, sw_batch_size):
+        """
+        Measures the peak memory of a window forward pass (and the number of output channels), once per batch size
+        """
+        if sw_batch_size not in self.window_bytes:
+            window = torch.zeros((sw_batch_size, image.shape[1], *self.roi_size), dtype=image.dtype, device=self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            start_bytes = torch.cuda.memory_allocated(self.device)
+            with torch.cuda.amp.autocast(enabled=self.amp):
+                output = model(window)
+            output = output[0] if isinstance(output, (list, tuple)) else output
+            self.num_output_channels = output.shape[1]
+            self.window_bytes[sw_batch_size] = torch.cuda.max_memory_allocated(self.device) - start_bytes
+            del window, output
+        return self.window_bytes[sw_batch_size]
+
+    def plan(self, model, image):
+        """
+        Returns the (input device, output device, sw_batch_size) of the sliding window inference of image
+        """
+        if self.device.type != "cuda":
+            return "cpu", "cpu", self.sw_batch_size("cpu")
+        if self.sw_input_on_cpu:
+            return "cpu", "cpu", self.sw_batch_size("cpu")
+
+        num_voxels = int(np.prod(image.shape[2:]))
+        input_bytes = image.numel() * image.element_size()
+        available = self.available_bytes()
+
+        # with the output on the device: output and count map buffers (float32), otherwise streamed to cpu
+        for device_in, device_out in ((self.device, self.device), (self.device, "cpu")):
+            sw_batch_size = self.sw_batch_size(device_out)
+            try:
+                window_bytes = self.measure_window(model, image, sw_batch_size)
+            except RuntimeError as e:
+                if not is_out_of_memory(e):
+                    raise e
+                logger.debug(f"sliding window batch {sw_batch_size} out of memory, output on {device_out} does not fit")
+                window_bytes = None
+            if window_bytes is None:
+                torch.cuda.empty_cache()  # after the except block, which keeps the failed buffers referenced
+                continue
+            output_bytes = (self.num_output_channels + 1) * num_voxels * 4 if device_out != "cpu" else 0
+            if input_bytes + output_bytes + window_bytes <= available:
+                return device_in, device_out, sw_batch_size
+
+        return "cpu", "cpu", self.sw_batch_size("cpu")
+
+    def run(self, model, image, device_in, device_out, sw_batch_size, **kwargs):
+        with torch.cuda.amp.autocast(enabled=self.amp):
+            return sliding_window_inference(
+                inputs=image.to(device_in),
+                roi_size=self.roi_size,
+                sw_batch_size=sw_batch_size,
+                predictor=model,
+                sw_device=self.device,
+                device=device_out,
+                **kwargs,
+            )
+
+    def __call__(self, model, image, **kwargs):
+        device_in, device_out, sw_batch_size = self.plan(model, image)
+        logger.debug(f"sliding window input on {device_in}, output on {device_out}, sw_batch_size {sw_batch_size}")
+        try:
+            return self.run(model, image, device_in, device_out, sw_batch_size, **kwargs)
+        except RuntimeError as e:
+            if not is_out_of_memory(e) or (device_in == "cpu" and device_out == "cpu"):
+                raise e
+            # under-estimated (e.g. due to fragmentation), keep a larger margin for the next cases
+            logger.debug("sliding window out of memory, falling back to the input and output on cpu")
+            self.memory_fraction *= 0.8
+            torch.cuda.empty_cache()
+            return self.run(model, image, "cpu", "cpu", self.sw_batch_size("cpu"), **kwargs)
+
+
 class InferClass:
     def __init__(self, config_file: Optional[Union[str, Sequence[str]]] = None, **override):
         logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -174,6 +302,8 @@ class InferClass:
         ckpt_name = parser.get_parsed_content("infer")["ckpt_name"]
         data_list_key = parser.get_parsed_content("infer")["data_list_key"]
         output_path = parser.get_parsed_content("infer")["output_path"]
+        self.output_path = output_path
+        self.completed_cases = CompletedCases(output_path)
         save_prob = parser.get_parsed_content("infer#save_prob")
 
         if not os.path.exists(output_path):
@@ -189,16 +319,13 @@ class InferClass:
         )
         self.infer_files = testing_files
 
-        self.infer_loader = None
-        if self.fast:
-            infer_ds = monai.data.Dataset(data=self.infer_files, transform=self.infer_transforms)
-            self.infer_loader = ThreadDataLoader(infer_ds, num_workers=8, batch_size=1, shuffle=False)
+        self.infer_loader = self.get_infer_loader(self.infer_files) if self.fast else None
 
-        try:
-            device = f"cuda:{dist.get_rank()}"
-        except BaseException:
-            device = f"cuda:0"
-        self.device = device
+        if torch.cuda.is_available():
+            local_rank = int(os.environ.get("LOCAL_RANK", dist.get_rank() if dist.is_initialized() else 0))
+            self.device = f"cuda:{local_rank % torch.cuda.device_count()}"
+        else:
+            self.device = "cpu"
 
         self.model = parser.get_parsed_content("training_network#network")
         self.model = self.model.to(self.device)
@@ -207,6 +334,15 @@ class InferClass:
         self.model.load_state_dict(pretrained_ckpt)
         logger.debug(f"checkpoint {ckpt_name:s} loaded")
 
+        self.planner = InferencePlanner(
+            device=self.device,
+            roi_size=self.patch_size_valid,
+            num_sw_batch_size=self.num_sw_batch_size,
+            num_patches_per_iter=self.num_patches_per_iter,
+            sw_input_on_cpu=self.sw_input_on_cpu,
+            amp=self.amp,
+        )
+
         post_transforms = [
             transforms.Invertd(
                 keys="pred",
@@ -259,6 +395,30 @@ class InferClass:
 
         return
 
+    def get_infer_loader(self, infer_files):
+        infer_ds = monai.data.Dataset(data=infer_files, transform=self.infer_transforms)
+        return ThreadDataLoader(infer_ds, num_workers=8, batch_size=1, shuffle=False)
+
+    def shard(self, shard_id=0, num_shards=1, resume=False):
+        """
+        Restricts the inference to the shard_id-th of num_shards partitions of the testing datalist (balanced by
+        the estimated number of voxels), and with resume, to the cases without a completely saved prediction
+        (recorded in the manifest of the completed cases, see CompletedCases).
+        """
+        infer_files = (
+            partition_by_voxels(self.infer_files, num_shards)[shard_id] if num_shards > 1 else self.infer_files
+        )
+        self.completed_cases = CompletedCases(self.output_path, shard_id)
+        if resume:
+            infer_files = self.completed_cases.pending(infer_files)
+        logger.debug(
+            f"shard {shard_id} of {num_shards}: {len(infer_files)} cases to infer"
+            f" ({len(self.infer_files) - len(infer_files)} in other shards or already saved)"
+        )
+        self.infer_files = infer_files
+        if self.fast:
+            self.infer_loader = self.get_infer_loader(self.infer_files)
+
     @torch.no_grad()
     def infer(self, image_file, save_mask=False):
         self.model.eval()
@@ -266,50 +426,9 @@ class InferClass:
         batch_data = self.infer_transforms(image_file)
         batch_data = list_data_collate([batch_data])
 
-        finished = None
-        device_list_input = None
-        device_list_output = None
-
-        if self.sw_input_on_cpu:
-            device_list_input = ["cpu"]
-            device_list_output = ["cpu"]
-        else:
-            device_list_input = [self.device, self.device, "cpu"]
-            device_list_output = [self.device, "cpu", "cpu"]
-
-        for _device_in, _device_out in zip(device_list_input, device_list_output):
-            try:
-                infer_images = batch_data["image"].to(_device_in)
-
-                if self.num_sw_batch_size is None:
-                    sw_batch_size = self.num_patches_per_iter * 8 if _device_out == "cpu" else 1
-                else:
-                    sw_batch_size = self.num_sw_batch_size
-
-                with torch.cuda.amp.autocast(enabled=self.amp):
-                    batch_data["pred"] = sliding_window_inference(
-                        inputs=infer_images,
-                        roi_size=self.patch_size_valid,
-                        sw_batch_size=sw_batch_size,
-                        predictor=self.model,
-                        mode="gaussian",
-                        overlap=self.overlap_ratio,
-                        sw_device=self.device,
-                        device=_device_out,
-                    )
-
-                finished = True
-
-            except BaseException:
-                finished = False
-
-            if finished:
-                break
-
-        del infer_images
+        batch_data["pred"] = self.planner(self.model, batch_data["image"], mode="gaussian", overlap=self.overlap_ratio)
         batch_data["image"] = batch_data["image"].cpu()
         batch_data["pred"] = batch_data["pred"].cpu()
-        torch.cuda.empty_cache()
 
         if save_mask:
             batch_data = [self.post_transforms(i) for i in decollate_batch(batch_data)]
@@ -322,6 +441,7 @@ class InferClass:
         for _i in range(len(self.infer_files)):
             infer_filename = self.infer_files[_i]
             _ = self.infer(infer_filename, save_mask=True)
+            self.completed_cases.add(infer_filename)
 
         return
 
@@ -329,61 +449,23 @@ class InferClass:
     def batch_infer(self):
         self.model.eval()
         with torch.no_grad():
-            for infer_data in self.infer_loader:
-                torch.cuda.empty_cache()
-
-                finished = None
-                device_list_input = None
-                device_list_output = None
-
-                if self.sw_input_on_cpu:
-                    device_list_input = ["cpu"]
-                    device_list_output = ["cpu"]
-                else:
-                    device_list_input = [self.device, self.device, "cpu"]
-                    device_list_output = [self.device, "cpu", "cpu"]
-
-                for _device_in, _device_out in zip(device_list_input, device_list_output):
-                    try:
-                        infer_images = infer_data["image"].to(_device_in)
-
-                        if self.num_sw_batch_size is None:
-                            sw_batch_size = self.num_patches_per_iter * 8 if _device_out == "cpu" else 1
-                        else:
-                            sw_batch_size = self.num_sw_batch_size
-
-                        with torch.cuda.amp.autocast(enabled=self.amp):
-                            infer_data["pred"] = sliding_window_inference(
-                                inputs=infer_images,
-                                roi_size=self.patch_size_valid,
-                                sw_batch_size=sw_batch_size,
-                                predictor=self.model,
-                                mode="gaussian",
-                                overlap=self.overlap_ratio,
-                                sw_device=self.device,
-                                device=_device_out,
-                            )
-
-                        finished = True
-
-                    except BaseException:
-                        finished = False
-
-                    if finished:
-                        break
-
-                del infer_images
+            # batch_size 1 and no shuffling, the batches follow infer_files
+            for infer_filename, infer_data in zip(self.infer_files, self.infer_loader):
+                infer_data["pred"] = self.planner(
+                    self.model, infer_data["image"], mode="gaussian", overlap=self.overlap_ratio
+                )
                 infer_data["image"] = infer_data["image"].cpu()
                 infer_data["pred"] = infer_data["pred"].cpu()
-                torch.cuda.empty_cache()
 
                 infer_data = [self.post_transforms(i) for i in decollate_batch(infer_data)]
+                self.completed_cases.add(infer_filename)
 
         return
 
 
-def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
+def run_shard(shard_id, num_shards, config_file, resume, override):
     infer_instance = InferClass(config_file, **override)
+    infer_instance.shard(shard_id, num_shards, resume)
     if infer_instance.fast:
         logger.debug("fast mode")
         infer_instance.batch_infer()
@@ -394,6 +476,34 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
     return
 
 
+def run_worker(rank, num_shards, config_file, resume, override):
+    # same environment as torchrun, for the device selection and the rank 0 only configuration update
+    os.environ.update({"RANK": str(rank), "LOCAL_RANK": str(rank), "WORLD_SIZE": str(num_shards)})
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+    run_shard(rank, num_shards, config_file, resume, override)
+
+
+def run(config_file: Optional[Union[str, Sequence[str]]] = None, num_shards: int = 1, resume: bool = False, **override):
+    """
+    Args:
+        num_shards: number of local inference processes (one per GPU round-robin, or sharing the CPU threads).
+            The testing datalist is partitioned into shards balanced by the estimated number of voxels.
+            When launched with torchrun, each of the WORLD_SIZE processes infers its own shard instead.
+        resume: skip the cases whose predictions are completely saved (recorded in the completed cases manifest
+            of the output path, see CompletedCases).
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 or num_shards <= 1:
+        run_shard(int(os.environ.get("RANK", 0)), world_size, config_file, resume, override)
+    else:
+        torch.multiprocessing.spawn(
+            run_worker, nprocs=num_shards, args=(num_shards, config_file, resume, override), join=True
+        )
+
+    return
+
+
 if __name__ == "__main__":
     from monai.utils import optional_import
 
@@ -45,6 +45,12 @@ try:
 except ModuleNotFoundError:
     from torch.nn.utils import clip_grad_norm_
 
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+if __package__ in (None, ""):
+    from decoded_store import shared_decoded_transform
+else:
+    from .decoded_store import shared_decoded_transform
+
 
 CONFIG = {
     "version": 1,
@@ -80,6 +86,102 @@ def try_except(func, default=None, expected_exc=(Exception,)):
         return default
 
 
+class ArchCostTables:
+    """
+    Memoized and vectorized versions of the TopologySearch computations of the architecture step
+    (get_prob_a, get_topology_entropy and get_ram_cost_usage). The static tables (child paths, node incidence,
+    RAM cost per cell operation and feature map size per path for each input shape) are built once, and the
+    per-block python loops become tensor products. The result for each new input shape is compared once with
+    the dints_space reference, and the reference is used from then on if they differ.
+    """
+
+    def __init__(self, dints_space):
+        self.dints_space = dints_space
+        self.device = dints_space.log_alpha_a.device
+        self.child = torch.as_tensor(np.asarray(dints_space.child_list), dtype=torch.float32, device=self.device)
+        self.ram_cost = torch.as_tensor(np.asarray(dints_space.ram_cost), dtype=torch.float32, device=self.device)
+        self.code2out = torch.as_tensor(np.asarray(dints_space.code2out), dtype=torch.long, device=self.device)
+        self.path_sizes = {}
+        self.node_in = self.node_out = None
+        self.use_reference = False
+
+    def get_prob_a(self):
+        prob_a = torch.sigmoid(self.dints_space.log_alpha_a)
+        # remove the case where all paths are zero, and re-normalize
+        norm = (1 - (1 - prob_a).prod(-1)).unsqueeze(1)
+        prob_a = prob_a.unsqueeze(1)
+        probs_a = (self.child * prob_a + (1 - self.child) * (1 - prob_a)).prod(-1) / norm
+        return probs_a, prob_a.squeeze(1) / norm
+
+    def get_topology_entropy(self, probs_a):
+        if self.node_in is None:
+            # node2in and node2out are memoized by the first call of the reference
+            self.dints_space.get_topology_entropy(probs_a.detach())
+            num_nodes = len(self.dints_space.node_act_list)
+            self.node_in = torch.zeros(num_nodes, len(self.child), device=self.device)
+            self.node_out = torch.zeros_like(self.node_in)
+            for node_idx in range(num_nodes):
+                for child_idx in self.dints_space.node2in[node_idx]:
+                    self.node_in[node_idx, child_idx] += 1
+                for child_idx in self.dints_space.node2out[node_idx]:
+                    self.node_out[node_idx, child_idx] += 1
+        node_p = probs_a[:-1] @ self.node_in.t()
+        out_p = probs_a[1:] @ self.node_out.t()
+        return -(node_p * torch.log(out_p + 1e-5) + (1 - node_p) * torch.log(1 - out_p + 1e-5)).sum()
+
+    def get_ram_cost_usage(self, in_size, arch_code_prob_a, full=False):
+        in_size = tuple(in_size)
+        if in_size not in self.path_sizes:
+            image_size = np.array(in_size[2:])
+            sizes = [
+                in_size[0] * self.dints_space.filter_nums[res_idx] * (image_size // (2**res_idx)).prod()
+                for res_idx in range(self.dints_space.num_depths)
+            ]
+            sizes = torch.tensor(sizes, dtype=torch.float32, device=self.device)
+            sizes = sizes / (2 ** int(self.dints_space.use_downsample)) * 32 / 8 / 1024**2
+            self.path_sizes[in_size] = sizes[self.code2out]
+        cell_prob = F.softmax(self.dints_space.log_alpha_c, dim=-1)
+        usage = (1 + (self.ram_cost * cell_prob).sum(-1)) * self.path_sizes[in_size]
+        return usage.sum() if full else (arch_code_prob_a * usage).sum()
+
+    def get_reference_losses(self, in_size):
+        dints_space = self.dints_space
+        probs_a, _ = dints_space.get_prob_a(child=True)
+        topology_loss = dints_space.get_topology_entropy(probs_a)
+        ram_cost_ratio = dints_space.get_ram_cost_usage(in_size) / dints_space.get_ram_cost_usage(in_size, full=True)
+        return probs_a, topology_loss, ram_cost_ratio
+
+    def get_losses(self, in_size):
+        """
+        Returns the child path probabilities, the topology entropy and the ratio of the RAM cost usage to the full
+        RAM cost usage, for the input shape in_size
+        """
+        if self.use_reference:
+            return self.get_reference_losses(in_size)
+        verify = tuple(in_size) not in self.path_sizes
+        try:
+            probs_a, arch_code_prob_a = self.get_prob_a()
+            topology_loss = self.get_topology_entropy(probs_a)
+            ram_cost_ratio = self.get_ram_cost_usage(in_size, arch_code_prob_a) / self.get_ram_cost_usage(
+                in_size, arch_code_prob_a, full=True
+            )
+        except (AttributeError, IndexError, RuntimeError, TypeError) as e:
+            logger.debug(f"architecture cost tables not available ({e}), using the dints_space reference")
+            self.use_reference = True
+            return self.get_reference_losses(in_size)
+        if verify:
+            with torch.no_grad():
+                reference = self.get_reference_losses(in_size)
+            if not all(
+                torch.allclose(x.detach().float(), torch.as_tensor(y, device=self.device).float(), rtol=1e-3, atol=1e-5)
+                for x, y in zip((probs_a, topology_loss, ram_cost_ratio), reference)
+            ):
+                logger.debug("architecture cost tables differ from the dints_space reference, using the reference")
+                self.use_reference = True
+                return self.get_reference_losses(in_size)
+        return probs_a, topology_loss, ram_cost_ratio
+
+
 def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
@@ -121,8 +223,11 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
         ):
             parser["transforms_train"]["transforms"][_i]["num_samples"] = num_crops_per_image
 
+    shared_cache_dir = parser.get_parsed_content("training#shared_cache_dir", default=None)
     train_transforms = parser.get_parsed_content("transforms_train")
+    train_transforms = shared_decoded_transform(parser, "transforms_train", train_transforms, shared_cache_dir)
     val_transforms = parser.get_parsed_content("transforms_validate")
+    val_transforms = shared_decoded_transform(parser, "transforms_validate", val_transforms, shared_cache_dir)
 
     if not os.path.exists(arch_path):
         os.makedirs(arch_path, exist_ok=True)
@@ -302,6 +407,18 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
 
     dataloader_a_iterator = iter(train_loader_a)
 
+    arch_cost_tables = ArchCostTables(dints_space)
+    weight_parameters = list(model.weight_parameters() if world_size == 1 else model.module.weight_parameters())
+    arch_parameters = [dints_space.log_alpha_a, dints_space.log_alpha_c]
+
+    # one forward of the weight and search batches, with the weight loss and the architecture loss back-propagated
+    # to their own parameters (first-order, the architecture gradient uses the weights before their update).
+    # It requires instance normalization (no statistics across the batch) and a single process.
+    fused_step = parser.get_parsed_content("searching#fused_step", default=False)
+    if fused_step and world_size > 1:
+        logger.debug("fused_step is not supported with DistributedDataParallel, using alternating steps")
+        fused_step = False
+
     start_time = time.time()
     for epoch in range(num_epochs):
         lr = lr_scheduler.get_last_lr()[0]
@@ -316,134 +433,201 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
         epoch_loss_arch = 0
         loss_torch_arch = torch.zeros(2, dtype=torch.float, device=device)
         step = 0
+        epoch_time = {"data": 0.0, "weight_step": 0.0, "arch_step": 0.0}
+        iter_end_time = time.time()
 
         for batch_data in train_loader_w:
             step += 1
             inputs, labels = batch_data["image"].to(device), batch_data["label"].to(device)
 
-            if world_size == 1:
-                for _ in model.weight_parameters():
+            search_step = epoch >= num_epochs_warmup
+            if search_step:
+                try:
+                    sample_a = next(dataloader_a_iterator)
+                except StopIteration:
+                    dataloader_a_iterator = iter(train_loader_a)
+                    sample_a = next(dataloader_a_iterator)
+
+                inputs_search, labels_search = (sample_a["image"].to(device), sample_a["label"].to(device))
+                combination_weights = (epoch - num_epochs_warmup) / (num_epochs - num_epochs_warmup)
+
+            step_start_time = time.time()
+            epoch_time["data"] += step_start_time - iter_end_time
+
+            if search_step and fused_step:
+                for _ in weight_parameters + arch_parameters:
                     _.requires_grad = True
+                for param in model.parameters():
+                    param.grad = None
+                arch_optimizer_a.zero_grad()
+                arch_optimizer_c.zero_grad()
+
+                probs_a, topology_loss, ram_cost_ratio = arch_cost_tables.get_losses(inputs.shape)
+                entropy_alpha_a = -((probs_a) * torch.log(probs_a + 1e-5)).mean()
+                entropy_alpha_c = -(
+                    F.softmax(dints_space.log_alpha_c, dim=-1) * F.log_softmax(dints_space.log_alpha_c, dim=-1)
+                ).mean()
+                ram_cost_loss = torch.abs(ram_cost_factor - ram_cost_ratio)
+
+                with torch.cuda.amp.autocast(enabled=amp):
+                    outputs = model(torch.cat([inputs, inputs_search]))
+                    loss = loss_function(outputs[: inputs.shape[0]].float(), labels)
+                    loss_arch = loss_function(outputs[inputs.shape[0] :].float(), labels_search)
+                    loss_arch += combination_weights * (
+                        (entropy_alpha_a + entropy_alpha_c) + ram_cost_loss + 0.001 * topology_loss
+                    )
+
+                if amp:
+                    scaler.scale(loss).backward(inputs=weight_parameters, retain_graph=True)
+                    scaler.scale(loss_arch).backward(inputs=arch_parameters)
+                else:
+                    loss.backward(inputs=weight_parameters, retain_graph=True)
+                    loss_arch.backward(inputs=arch_parameters)
+
+                # the architecture parameters are also model parameters, hide their gradients from the weight optimizer
+                arch_grads = [_.grad for _ in arch_parameters]
+                for _ in arch_parameters:
+                    _.grad = None
+
+                if amp:
+                    scaler.unscale_(optimizer)
+                    clip_grad_norm_(weight_parameters, 0.5)
+                    scaler.step(optimizer)
+                    for _, grad in zip(arch_parameters, arch_grads):
+                        _.grad = grad
+                    scaler.unscale_(arch_optimizer_a)
+                    scaler.unscale_(arch_optimizer_c)
+                    clip_grad_norm_([dints_space.log_alpha_a], 0.5)
+                    clip_grad_norm_([dints_space.log_alpha_c], 0.5)
+                    scaler.step(arch_optimizer_a)
+                    scaler.step(arch_optimizer_c)
+                    scaler.update()
+                else:
+                    torch.nn.utils.clip_grad_norm_(weight_parameters, 0.5)
+                    optimizer.step()
+                    for _, grad in zip(arch_parameters, arch_grads):
+                        _.grad = grad
+                    torch.nn.utils.clip_grad_norm_([dints_space.log_alpha_a], 0.5)
+                    torch.nn.utils.clip_grad_norm_([dints_space.log_alpha_c], 0.5)
+                    arch_optimizer_a.step()
+                    arch_optimizer_c.step()
+
+                loss = loss.detach()
+                loss_arch_value = loss_arch.item()
             else:
-                for _ in model.module.weight_parameters():
+                for _ in weight_parameters:
                     _.requires_grad = True
 
-            dints_space.log_alpha_a.requires_grad = False
-            dints_space.log_alpha_c.requires_grad = False
+                dints_space.log_alpha_a.requires_grad = False
+                dints_space.log_alpha_c.requires_grad = False
+
+                for param in model.parameters():
+                    param.grad = None
 
-            for param in model.parameters():
-                param.grad = None
+                if amp:
+                    with autocast():
+                        outputs = model(inputs)
+                        loss = loss_function(outputs.float(), labels)
 
-            if amp:
-                with autocast():
+                    scaler.scale(loss).backward()
+                    scaler.unscale_(optimizer)
+                    clip_grad_norm_(model.parameters(), 0.5)
+                    scaler.step(optimizer)
+                    scaler.update()
+                else:
                     outputs = model(inputs)
                     loss = loss_function(outputs.float(), labels)
-
-                scaler.scale(loss).backward()
-                scaler.unscale_(optimizer)
-                clip_grad_norm_(model.parameters(), 0.5)
-                scaler.step(optimizer)
-                scaler.update()
-            else:
-                outputs = model(inputs)
-                loss = loss_function(outputs.float(), labels)
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
-                optimizer.step()
+                    loss.backward()
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 0.5)
+                    optimizer.step()
 
             epoch_loss += loss.item()
             loss_torch[0] += loss.item()
             loss_torch[1] += 1.0
             epoch_len = len(train_loader_w)
             idx_iter += 1
+            # the fused step (a single forward and backward) is accounted as a weight step
+            epoch_time["weight_step"] += time.time() - step_start_time
 
             if torch.cuda.device_count() == 1 or dist.get_rank() == 0:
                 logger.debug(f"[{str(datetime.now())[:19]}] " + f"{step}/{epoch_len}, train_loss: {loss.item():.4f}")
                 writer.add_scalar("Loss/train", loss.item(), epoch_len * epoch + step)
                 mlflow.log_metric("Loss/train", loss.item(), step=epoch_len * epoch + step)
 
-            if epoch < num_epochs_warmup:
+            iter_end_time = time.time()
+            if not search_step:
                 continue
 
-            try:
-                sample_a = next(dataloader_a_iterator)
-            except StopIteration:
-                dataloader_a_iterator = iter(train_loader_a)
-                sample_a = next(dataloader_a_iterator)
-
-            inputs_search, labels_search = (sample_a["image"].to(device), sample_a["label"].to(device))
-            if world_size == 1:
-                for _ in model.weight_parameters():
-                    _.requires_grad = False
-            else:
-                for _ in model.module.weight_parameters():
+            if not fused_step:
+                for _ in weight_parameters:
                     _.requires_grad = False
 
-            dints_space.log_alpha_a.requires_grad = True
-            dints_space.log_alpha_c.requires_grad = True
-
-            entropy_alpha_c = torch.tensor(0.0).to(device)
-            entropy_alpha_a = torch.tensor(0.0).to(device)
-            ram_cost_full = torch.tensor(0.0).to(device)
-            ram_cost_usage = torch.tensor(0.0).to(device)
-            ram_cost_loss = torch.tensor(0.0).to(device)
-            topology_loss = torch.tensor(0.0).to(device)
-
-            probs_a, arch_code_prob_a = dints_space.get_prob_a(child=True)
-            entropy_alpha_a = -((probs_a) * torch.log(probs_a + 1e-5)).mean()
-            entropy_alpha_c = -(
-                F.softmax(dints_space.log_alpha_c, dim=-1) * F.log_softmax(dints_space.log_alpha_c, dim=-1)
-            ).mean()
-            topology_loss = dints_space.get_topology_entropy(probs_a)
-
-            ram_cost_full = dints_space.get_ram_cost_usage(inputs.shape, full=True)
-            ram_cost_usage = dints_space.get_ram_cost_usage(inputs.shape)
-            ram_cost_loss = torch.abs(ram_cost_factor - ram_cost_usage / ram_cost_full)
-
-            arch_optimizer_a.zero_grad()
-            arch_optimizer_c.zero_grad()
-
-            combination_weights = (epoch - num_epochs_warmup) / (num_epochs - num_epochs_warmup)
+                dints_space.log_alpha_a.requires_grad = True
+                dints_space.log_alpha_c.requires_grad = True
+
+                probs_a, topology_loss, ram_cost_ratio = arch_cost_tables.get_losses(inputs.shape)
+                entropy_alpha_a = -((probs_a) * torch.log(probs_a + 1e-5)).mean()
+                entropy_alpha_c = -(
+                    F.softmax(dints_space.log_alpha_c, dim=-1) * F.log_softmax(dints_space.log_alpha_c, dim=-1)
+                ).mean()
+                ram_cost_loss = torch.abs(ram_cost_factor - ram_cost_ratio)
+
+                arch_optimizer_a.zero_grad()
+                arch_optimizer_c.zero_grad()
+
+                if amp:
+                    with autocast():
+                        outputs_search = model(inputs_search)
+                        loss = loss_function(outputs_search.float(), labels_search)
+                        loss += combination_weights * (
+                            (entropy_alpha_a + entropy_alpha_c) + ram_cost_loss + 0.001 * topology_loss
+                        )
 
-            if amp:
-                with autocast():
+                    scaler.scale(loss).backward()
+                    scaler.unscale_(arch_optimizer_a)
+                    scaler.unscale_(arch_optimizer_c)
+                    clip_grad_norm_([dints_space.log_alpha_a], 0.5)
+                    clip_grad_norm_([dints_space.log_alpha_c], 0.5)
+                    scaler.step(arch_optimizer_a)
+                    scaler.step(arch_optimizer_c)
+                    scaler.update()
+                else:
                     outputs_search = model(inputs_search)
                     loss = loss_function(outputs_search.float(), labels_search)
                     loss += combination_weights * (
                         (entropy_alpha_a + entropy_alpha_c) + ram_cost_loss + 0.001 * topology_loss
                     )
 
-                scaler.scale(loss).backward()
-                scaler.unscale_(arch_optimizer_a)
-                scaler.unscale_(arch_optimizer_c)
-                clip_grad_norm_([dints_space.log_alpha_a], 0.5)
-                clip_grad_norm_([dints_space.log_alpha_c], 0.5)
-                scaler.step(arch_optimizer_a)
-                scaler.step(arch_optimizer_c)
-                scaler.update()
-            else:
-                outputs_search = model(inputs_search)
-                loss = loss_function(outputs_search.float(), labels_search)
-                loss += combination_weights * (
-                    (entropy_alpha_a + entropy_alpha_c) + ram_cost_loss + 0.001 * topology_loss
-                )
+                    loss.backward()
+                    torch.nn.utils.clip_grad_norm_([dints_space.log_alpha_a], 0.5)
+                    torch.nn.utils.clip_grad_norm_([dints_space.log_alpha_c], 0.5)
+                    arch_optimizer_a.step()
+                    arch_optimizer_c.step()
 
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_([dints_space.log_alpha_a], 0.5)
-                torch.nn.utils.clip_grad_norm_([dints_space.log_alpha_c], 0.5)
-                arch_optimizer_a.step()
-                arch_optimizer_c.step()
+                loss_arch_value = loss.item()
+                epoch_time["arch_step"] += time.time() - iter_end_time
 
-            epoch_loss_arch += loss.item()
-            loss_torch_arch[0] += loss.item()
+            epoch_loss_arch += loss_arch_value
+            loss_torch_arch[0] += loss_arch_value
             loss_torch_arch[1] += 1.0
 
             if torch.cuda.device_count() == 1 or dist.get_rank() == 0:
                 logger.debug(
-                    f"[{str(datetime.now())[:19]}] " + f"{step}/{epoch_len}, train_loss_arch: {loss.item():.4f}"
+                    f"[{str(datetime.now())[:19]}] " + f"{step}/{epoch_len}, train_loss_arch: {loss_arch_value:.4f}"
                 )
-                writer.add_scalar("train_loss_arch", loss.item(), epoch_len * epoch + step)
-                mlflow.log_metric("train_loss_arch", loss.item(), step=epoch_len * epoch + step)
+                writer.add_scalar("train_loss_arch", loss_arch_value, epoch_len * epoch + step)
+                mlflow.log_metric("train_loss_arch", loss_arch_value, step=epoch_len * epoch + step)
+
+            iter_end_time = time.time()
+
+        if torch.cuda.device_count() == 1 or dist.get_rank() == 0:
+            logger.debug(
+                f"epoch {epoch + 1} time data loading: {epoch_time['data']:.2f}s, "
+                f"weight step: {epoch_time['weight_step']:.2f}s, architecture step: {epoch_time['arch_step']:.2f}s"
+            )
+            for key, value in epoch_time.items():
+                writer.add_scalar(f"time/{key}", value, epoch)
+                mlflow.log_metric(f"time/{key}", value, step=epoch)
 
         lr_scheduler.step()
 
@@ -26,9 +26,9 @@ from monai.bundle import ConfigParser
 print = logger.debug
 
 if __package__ in (None, ""):
-    from utils import auto_adjust_network_settings, logger_configure
+    from utils import auto_adjust_network_settings, blocks_down_for_levels, logger_configure
 else:
-    from .utils import auto_adjust_network_settings, logger_configure
+    from .utils import auto_adjust_network_settings, blocks_down_for_levels, logger_configure
 
 
 class SegresnetAlgo(BundleAlgo):
@@ -226,6 +226,10 @@ class SegresnetAlgo(BundleAlgo):
                 spacing=config["resample_resolution"],
                 anisotropic_scales=config["anisotropic_scales"],
                 output_classes=config["output_classes"],
+                input_channels=config["input_channels"],
+                amp=input_config.get("amp", True),
+                channels_last=input_config.get("channels_last", True),
+                memory_model=input_config.get("memory_model", False),
             )
 
             if input_config.get("roi_size", None):
@@ -240,17 +244,7 @@ class SegresnetAlgo(BundleAlgo):
 
             ###########################################
             # update network config
-            blocks_down = [1, 2, 2, 4, 4]
-            if levels >= 5:  # default
-                blocks_down = [1, 2, 2, 4, 4]
-            elif levels == 4:
-                blocks_down = [1, 2, 2, 4]
-            elif levels == 3:
-                blocks_down = [1, 2, 4]
-            elif levels == 2:
-                blocks_down = [1, 3]
-            elif levels == 1:
-                blocks_down = [2]
+            blocks_down = blocks_down_for_levels(levels)
 
             config["network#blocks_down"] = blocks_down
             config["network#init_filters"] = init_filters
@@ -40,8 +40,14 @@ class InferClass:
         return pred
 
 
-def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
+def run(config_file: Optional[Union[str, Sequence[str]]] = None, resume: bool = False, **override):
+    """
+    With multiple GPUs (spawned or torchrun), each rank infers its own shard of the testing datalist,
+    balanced by the estimated number of voxels. With resume, the cases completely saved in the output path
+    (recorded in its completed cases manifest, see CompletedCases) are skipped.
+    """
     override["infer#enabled"] = True
+    override["infer#resume"] = resume
     run_segmenter(config_file=config_file, **override)
 
 
@@ -13,14 +13,27 @@ from __future__ import annotations
 
 import copy
 import csv
+import fcntl
 import gc
+import hashlib
+import inspect
+import json
 import logging
+import math
 import multiprocessing as mp
 import os
+import pickle
 import shutil
 import sys
+import tempfile
+import threading
 import time
+import uuid
 import warnings
+import weakref
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Any, Callable, Dict, Hashable, List, Mapping, Optional, Sequence, Tuple, Union
@@ -30,9 +43,11 @@ import psutil
 import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
+import torch.nn.functional as F
 import yaml
 from torch.cuda.amp import GradScaler, autocast
 from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import IterableDataset, get_worker_info
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 
@@ -41,10 +56,20 @@ from monai.apps.auto3dseg.transforms import EnsureSameShaped
 from monai.auto3dseg.utils import datafold_read
 from monai.bundle.config_parser import ConfigParser
 from monai.config import KeysCollection
-from monai.data import CacheDataset, DataLoader, Dataset, DistributedSampler, decollate_batch, list_data_collate
+from monai.data import (
+    CacheDataset,
+    DataLoader,
+    Dataset,
+    DistributedSampler,
+    MetaTensor,
+    PersistentDataset,
+    decollate_batch,
+    list_data_collate,
+)
+from monai.data.utils import compute_importance_map, dense_patch_slices
 from monai.inferers import SlidingWindowInfererAdapt
 from monai.losses import DeepSupervisionLoss
-from monai.metrics import CumulativeAverage, DiceHelper
+from monai.metrics import DiceHelper
 from monai.networks.layers.factories import split_args
 from monai.optimizers.lr_scheduler import WarmupCosineSchedule
 from monai.transforms import (
@@ -72,6 +97,7 @@ from monai.transforms import (
     RandGaussianSmoothd,
     RandHistogramShiftd,
     RandIdentity,
+    RandomizableTrait,
     RandRotate90d,
     RandScaleIntensityd,
     RandScaleIntensityFixedMeand,
@@ -84,7 +110,7 @@ from monai.transforms import (
     SpatialPadd,
     ToDeviced,
 )
-from monai.transforms.transform import MapTransform
+from monai.transforms.transform import MapTransform, Transform
 from monai.utils import ImageMetaKey, convert_to_dst_type, optional_import, set_determinism
 
 mlflow, mlflow_is_imported = optional_import("mlflow")
@@ -95,8 +121,12 @@ print = logger.debug
 tqdm, has_tqdm = optional_import("tqdm", name="tqdm")
 
 if __package__ in (None, ""):
+    from incremental_validation import IncrementalValidation
+    from sharded_inference import CompletedCases, partition_by_voxels
     from utils import auto_adjust_network_settings, logger_configure
 else:
+    from .incremental_validation import IncrementalValidation
+    from .sharded_inference import CompletedCases, partition_by_voxels
     from .utils import auto_adjust_network_settings, logger_configure
 
 
@@ -129,6 +159,821 @@ class LabelEmbedClassIndex(MapTransform):
         return d
 
 
+_file_hash_memo: Dict[Tuple, str] = {}
+
+
+def file_content_hashing(item, chunk_size: int = 1 << 24) -> bytes:
+    """
+    Hash a datalist item by the content of the files it references (rather than by file names only),
+    so that a cache entry is invalidated whenever a source image changes on disk.
+    The per-file digests are memoized by (path, size, mtime) to read each file at most once per process.
+    """
+
+    def _hash_value(v):
+        if isinstance(v, (list, tuple)):
+            return [_hash_value(x) for x in v]
+        if isinstance(v, dict):
+            return {k: _hash_value(x) for k, x in sorted(v.items())}
+        if isinstance(v, str) and os.path.isfile(v):
+            st = os.stat(v)
+            memo_key = (os.path.abspath(v), st.st_size, st.st_mtime_ns)
+            if memo_key not in _file_hash_memo:
+                h = hashlib.sha256()
+                with open(v, "rb") as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b""):
+                        h.update(chunk)
+                _file_hash_memo[memo_key] = h.hexdigest()
+            return _file_hash_memo[memo_key]
+        return v
+
+    item = {k: v for k, v in item.items() if k != "fold"} if isinstance(item, dict) else item
+    content = json.dumps(_hash_value(item), sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest().encode("utf-8")
+
+
+def transform_cache_key(x) -> Dict:
+    """
+    JSON serializable description of a transform object for the cache keys: its class name and public attributes
+    (e.g. the constructor arguments), the nested objects are described by their class name only
+    """
+    attrs = {k: v for k, v in getattr(x, "__dict__", {}).items() if not k.startswith("_")}
+    attrs = json.loads(json.dumps(attrs, sort_keys=True, skipkeys=True, default=lambda y: y.__class__.__name__))
+    return {"class": x.__class__.__name__, "attrs": attrs}
+
+
+class DiskCacheDataset(PersistentDataset):
+    """
+    PersistentDataset variant used as a content-addressed disk cache of the deterministic part of the
+    transform pipeline (everything before the first random transform).
+    The cache key is the hash of the source files content plus the provided transform_key (e.g. from
+    DataTransformBuilder.get_cache_key), hence the same cache_dir can be shared across folds, validation
+    and inference runs and restarts. The entries are not shared with the other templates (segresnet2d, and the
+    shared_cache_dir of dints and swinunetr), which resample and normalize differently.
+    Cached items are stored as uncompressed torch files, and loaded memory-mapped (if supported by the torch version)
+    to avoid copying whole volumes on read.
+    """
+
+    def __init__(self, data: Sequence, transform: Callable, cache_dir: str, transform_key: str = "", **kwargs):
+        kwargs.setdefault("hash_func", file_content_hashing)
+        if "track_meta" in inspect.signature(PersistentDataset.__init__).parameters:
+            # keep MetaTensors with the applied operations, required to invert predictions
+            kwargs.setdefault("track_meta", True)
+            kwargs.setdefault("weights_only", False)
+        super().__init__(data=data, transform=transform, cache_dir=cache_dir, **kwargs)
+        self.transform_hash = transform_key
+
+    def _cachecheck(self, item_transformed):
+        hashfile = Path(self.cache_dir) / f"{self.hash_func(item_transformed).decode('utf-8')}{self.transform_hash}.pt"
+        if hashfile.is_file():
+            try:
+                return torch.load(hashfile, mmap=True, weights_only=False)
+            except (TypeError, RuntimeError):
+                pass  # mmap is not supported by the torch version or by the file, use the default loading
+        return super()._cachecheck(item_transformed)
+
+
+class CropReservoirDataset(IterableDataset):
+    """
+    Training dataset keeping a rotating pool (reservoir) of pre-processed volumes resident per worker, where
+    pre-processing is the deterministic part of the transform pipeline (everything before the first random
+    transform, e.g. loading, resampling, normalization, class indices). Each item draws a random volume
+    from the pool and applies the random part of the pipeline (e.g. RandCropByLabelClassesd crops and augmentations).
+    Every volume is used num_reuse times before being replaced by the next one (similar to SmartCacheDataset,
+    but local to each worker), which reduces the decoding cost per crop by about num_reuse times, without caching
+    the whole dataset. The number of items per epoch is the same as the number of images (per rank); as with
+    DistributedSampler, the images are padded (repeated) to the same number on every rank.
+    """
+
+    def __init__(self, data: Sequence, transform: Compose, pool_size: int = 4, num_reuse: int = 4) -> None:
+        self.data = data
+        self.pool_size = max(1, int(pool_size))
+        self.num_reuse = max(1, int(num_reuse))
+
+        first_random = transform.get_index_of_first(
+            lambda t: isinstance(t, RandomizableTrait) or not isinstance(t, Transform)
+        )
+        if first_random is None:
+            first_random = len(transform.transforms)
+        self.pre_transform = Compose(transform.transforms[:first_random])
+        self.transform = Compose(transform.transforms[first_random:])
+
+        self.rank, self.world_size = 0, 1
+        if dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+        self.pool: List[List] = []  # [item, remaining uses], persistent per worker
+        self.file_order: List[int] = []
+        self.R: Optional[np.random.RandomState] = None
+
+    def _rank_indices(self) -> List[int]:
+        num_per_rank = int(math.ceil(len(self.data) / self.world_size))
+        total_size = num_per_rank * self.world_size
+        indices = list(range(len(self.data)))
+        if len(indices) > 0:
+            indices = (indices * int(math.ceil(total_size / len(indices))))[:total_size]
+        return indices[self.rank : total_size : self.world_size]
+
+    def __len__(self) -> int:
+        return len(self._rank_indices())
+
+    def _next_volume(self, indices):
+        if len(self.file_order) == 0:
+            self.file_order = self.R.permutation(indices).tolist()
+        item = self.pre_transform(dict(self.data[self.file_order.pop()]))
+        return [item, self.num_reuse]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        if self.R is None:
+            self.R = np.random.RandomState(torch.initial_seed() % (2**32))
+
+        indices = self._rank_indices()[worker_id::num_workers]
+
+        for _ in range(len(indices)):
+            while len(self.pool) < min(self.pool_size, len(indices)):
+                self.pool.append(self._next_volume(indices))
+
+            idx = self.R.randint(len(self.pool))
+            item, remaining = self.pool[idx]
+            if remaining <= 1:
+                self.pool.pop(idx)
+            else:
+                self.pool[idx][1] = remaining - 1
+
+            yield self.transform(copy.deepcopy(item))  # the random transforms may modify the item in place
+
+
+_ArrayRef = namedtuple("_ArrayRef", ["offset", "dtype", "shape", "is_tensor", "meta"])
+
+
+class SharedMemoryCache:
+    """
+    Node-local runtime cache, shared by all ranks and DataLoader workers on the node, to be used as
+    the CacheDataset runtime_cache (instead of a multiprocessing Manager().list proxy).
+    Each cached item is stored in a shared memory folder (/dev/shm by default) as a raw buffer file
+    with a small pickled index (array offsets, dtypes, shapes and meta data). On a cache hit, the arrays
+    are returned as zero-copy (copy-on-write) memory-mapped tensor views, without serializing the volumes.
+    Only the object location is pickled, so it is cheap to broadcast to other ranks.
+
+    If max_bytes is provided, the total size of the cached items is kept within this budget by evicting
+    the least recently used ("lru") or the largest ("largest") items, based on the actual size of each item.
+    The cache hits and misses are counted per process, without locking, and published in a small per process file
+    of the cache folder, so that cache_stats() can sum them over all the processes of the node.
+    """
+
+    def __init__(
+        self,
+        length: int = 0,
+        root_dir: Optional[str] = None,
+        alignment: int = 64,
+        max_bytes: Optional[int] = None,
+        eviction: str = "lru",
+    ) -> None:
+        if eviction not in ("lru", "largest"):
+            raise ValueError("Unsupported eviction: " + str(eviction))
+        if root_dir is None:
+            root_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+        self.cache_dir = os.path.join(root_dir, f"segmenter_cache_{os.getpid()}_{uuid.uuid4().hex[:8]}")
+        self.length = length
+        self.alignment = alignment
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self._write_failed = False
+        self._reset_counters()
+        self._stats_baseline = np.zeros(2, dtype=np.int64)
+        # only the creating process removes the folder
+        weakref.finalize(self, SharedMemoryCache._cleanup, self.cache_dir, os.getpid())
+
+    @staticmethod
+    def _cleanup(cache_dir: str, owner_pid: int) -> None:
+        if os.getpid() == owner_pid:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_write_failed=False, _counts=None, _counts_pid=None, _counts_fd=None)
+        return state
+
+    def _reset_counters(self) -> None:
+        self._counts = np.zeros(2, dtype=np.int64)  # hits, misses of this process
+        self._counts_pid = os.getpid()
+        self._counts_fd: Optional[int] = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _paths(self, idx: int) -> Tuple[str, str]:
+        return os.path.join(self.cache_dir, f"{idx}.bin"), os.path.join(self.cache_dir, f"{idx}.idx")
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, "lock"), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _count(self, hit: bool) -> None:
+        if self._counts_pid != os.getpid():
+            self._reset_counters()  # a new (e.g. forked DataLoader worker) process
+        self._counts[0 if hit else 1] += 1
+        try:
+            if self._counts_fd is None:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                stats_file = os.path.join(self.cache_dir, f"stats.{os.getpid()}")
+                self._counts_fd = os.open(stats_file, os.O_RDWR | os.O_CREAT, 0o644)
+            os.pwrite(self._counts_fd, self._counts.tobytes(), 0)  # a single write, no lock
+        except OSError:
+            pass  # the statistics are informative only
+
+    def _cached_items(self) -> List[Tuple[int, int, float]]:
+        items = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".idx"):
+                try:
+                    idx = int(entry.name[:-4])
+                    data_file, _ = self._paths(idx)
+                    items.append((idx, entry.stat().st_size + os.path.getsize(data_file), entry.stat().st_mtime))
+                except (OSError, ValueError):
+                    continue  # removed concurrently
+        return items
+
+    def _remove(self, idx: int) -> None:
+        for fname in self._paths(idx)[::-1]:  # index file first, to mark the item as missing
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def cache_stats(self, reset: bool = False) -> Dict:
+        """
+        Returns the cache hits and misses (since the last reset) and the current cache size
+        """
+        totals = np.zeros(2, dtype=np.int64)
+        items = []
+        if os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.startswith("stats."):
+                    counts = np.fromfile(entry.path, dtype=np.int64)
+                    if counts.size == 2:
+                        totals += counts
+            items = self._cached_items()
+        hits, misses = (totals - self._stats_baseline).tolist()
+        if reset:
+            self._stats_baseline = totals
+
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / max(1, hits + misses),
+            "items": len(items),
+            "bytes": sum(i[1] for i in items),
+        }
+
+    def _pack(self, obj, buffers: List):
+        if isinstance(obj, (torch.Tensor, np.ndarray)) and not (isinstance(obj, np.ndarray) and obj.dtype.hasobject):
+            is_tensor = isinstance(obj, torch.Tensor)
+            meta = None
+            if isinstance(obj, MetaTensor):
+                meta = (obj.meta, obj.applied_operations)
+            try:
+                arr = np.ascontiguousarray(obj.detach().cpu().numpy() if is_tensor else obj)
+            except TypeError:
+                return obj  # unsupported dtype, e.g. bfloat16, keep it in the index
+            offset = 0
+            if len(buffers) > 0:
+                last_offset, last_arr = buffers[-1]
+                offset = last_offset + last_arr.nbytes
+                offset += -offset % self.alignment
+            buffers.append((offset, arr))
+            return _ArrayRef(offset, arr.dtype.str, arr.shape, is_tensor, meta)
+        if isinstance(obj, dict):
+            return {k: self._pack(v, buffers) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._pack(v, buffers) for v in obj)
+        return obj
+
+    def _unpack(self, obj, mm):
+        if isinstance(obj, _ArrayRef):
+            dtype = np.dtype(obj.dtype)
+            nbytes = int(np.prod(obj.shape)) * dtype.itemsize
+            arr = mm[obj.offset : obj.offset + nbytes] if nbytes > 0 else np.zeros(0, dtype=np.uint8)
+            arr = arr.view(dtype).reshape(obj.shape)
+            if not obj.is_tensor:
+                return arr
+            arr = torch.from_numpy(arr)
+            if obj.meta is not None:
+                arr = MetaTensor(arr, meta=obj.meta[0], applied_operations=obj.meta[1])
+            return arr
+        if isinstance(obj, dict):
+            return {k: self._unpack(v, mm) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._unpack(v, mm) for v in obj)
+        return obj
+
+    def __getitem__(self, idx: int):
+        idx = idx % self.length
+        data_file, index_file = self._paths(idx)
+        try:
+            with open(index_file, "rb") as f:
+                index = f.read()
+            # a new private (copy-on-write) mapping on every access, so in-place changes are never visible to others
+            mm = np.memmap(data_file, dtype=np.uint8, mode="c").view(np.ndarray) if os.path.getsize(data_file) else None
+        except (FileNotFoundError, ValueError):
+            index = None  # not cached yet or evicted
+        self._count(hit=index is not None)
+        if index is not None and self.max_bytes is not None and self.eviction == "lru":
+            try:
+                os.utime(index_file)  # the access time of the lru eviction
+            except FileNotFoundError:
+                pass  # evicted meanwhile, the mapping remains valid
+        if index is None:
+            return None
+
+        return self._unpack(pickle.loads(index), mm)
+
+    def __setitem__(self, idx: int, item) -> None:
+        idx = idx % self.length
+        if self._write_failed:
+            return
+
+        buffers: List = []
+        index = pickle.dumps(self._pack(item, buffers), protocol=pickle.HIGHEST_PROTOCOL)
+        data_file, index_file = self._paths(idx)
+        tmp_suffix = f".{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+
+        try:
+            item_bytes = len(index) + (buffers[-1][0] + buffers[-1][1].nbytes if len(buffers) > 0 else 0)
+            if self.max_bytes is not None and item_bytes > self.max_bytes:
+                return
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(data_file + tmp_suffix, "wb") as f:
+                for offset, arr in buffers:
+                    f.seek(offset)
+                    f.write(memoryview(arr.reshape(-1)).cast("B"))
+            with open(index_file + tmp_suffix, "wb") as f:
+                f.write(index)
+
+            with self._locked() if self.max_bytes is not None else nullcontext():
+                if self.max_bytes is not None:
+                    # the budget check, eviction and rename are one step for the concurrent writers
+                    items = [i for i in self._cached_items() if i[0] != idx]
+                    total_bytes = sum(i[1] for i in items) + item_bytes
+                    # evict the least recently used or the largest items first
+                    items.sort(key=(lambda i: i[2]) if self.eviction == "lru" else (lambda i: -i[1]))
+                    for evict_idx, evict_bytes, _ in items:
+                        if total_bytes <= self.max_bytes:
+                            break
+                        self._remove(evict_idx)
+                        total_bytes -= evict_bytes
+                # rename is atomic, the index file is moved last to indicate a complete item
+                os.replace(data_file + tmp_suffix, data_file)
+                os.replace(index_file + tmp_suffix, index_file)
+        except OSError as e:
+            # e.g. not enough space in /dev/shm, continue without caching
+            self._write_failed = True
+            for fname in (data_file + tmp_suffix, index_file + tmp_suffix):
+                if os.path.exists(fname):
+                    os.remove(fname)
+            warnings.warn(f"SharedMemoryCache unable to write to {self.cache_dir}, disabling caching: {e}")
+
+
+class MultiImageSlidingWindowInferer:
+    """
+    Sliding window inference over several images (of different sizes) at once.
+    The windows of all the input images are packed together into batches of sw_batch_size for the network
+    forward pass, and the outputs are scattered back into the per-image accumulators. This keeps the GPU busy
+    when inferring many small images, where a single image does not have enough windows to fill a batch.
+    As SlidingWindowInfererAdapt, on out of memory errors it retries with the output buffers on the CPU,
+    then with the (padded) inputs on the CPU as well, the network still runs on the device of the inputs.
+    """
+
+    def __init__(
+        self,
+        roi_size: Sequence[int],
+        sw_batch_size: int = 4,
+        overlap: float = 0.625,
+        mode: str = "gaussian",
+        sigma_scale: float = 0.125,
+        cval: float = 0.0,
+    ) -> None:
+        self.roi_size = [int(r) for r in roi_size]
+        self.sw_batch_size = max(1, int(sw_batch_size))
+        self.overlap = overlap
+        self.mode = mode
+        self.sigma_scale = sigma_scale
+        self.cval = cval
+
+    def __call__(self, inputs: Sequence[torch.Tensor], network: Callable) -> List[torch.Tensor]:
+        sw_device = inputs[0].device if len(inputs) > 0 else torch.device("cpu")
+        cpu = torch.device("cpu")
+        placements = [(sw_device, sw_device)]
+        if sw_device.type != "cpu":
+            placements += [(sw_device, cpu), (cpu, cpu)]
+        for level, (input_device, output_device) in enumerate(placements):
+            try:
+                return self._infer([x.to(input_device) for x in inputs], network, sw_device, output_device)
+            except RuntimeError as e:
+                if "OutOfMemoryError" not in str(type(e).__name__) or level == len(placements) - 1:
+                    raise e
+                print(
+                    f"MultiImageSlidingWindowInferer out of memory with inputs on {input_device} "
+                    f"and outputs on {output_device}, retrying with {placements[level + 1]}"
+                )
+            torch.cuda.empty_cache()  # after the except block, which keeps the failed buffers referenced
+
+    def _infer(
+        self, inputs: Sequence[torch.Tensor], network: Callable, sw_device: torch.device, device: torch.device
+    ) -> List[torch.Tensor]:
+        padded, pads, windows = [], [], []
+        for i, x in enumerate(inputs):
+            image_size = x.shape[2:]
+            pad_size = [max(r - s, 0) for r, s in zip(self.roi_size, image_size)]
+            pad = []
+            for p in reversed(pad_size):
+                pad.extend([p // 2, p - p // 2])
+            if any(pad_size):
+                x = F.pad(x, pad=pad, mode="constant", value=self.cval)
+            padded.append(x)
+            pads.append([(p // 2, p // 2 + s) for p, s in zip(pad_size, image_size)])
+
+            padded_size = x.shape[2:]
+            scan_interval = [
+                r if r == s else max(int(r * (1 - self.overlap)), 1) for r, s in zip(self.roi_size, padded_size)
+            ]
+            windows.extend((i, sl) for sl in dense_patch_slices(padded_size, self.roi_size, scan_interval))
+
+        importance_map = compute_importance_map(
+            self.roi_size, mode=self.mode, sigma_scale=self.sigma_scale, device=device
+        ).clamp(min=1e-3)
+        outputs: List[Optional[torch.Tensor]] = [None] * len(padded)
+        counts: List[Optional[torch.Tensor]] = [None] * len(padded)
+
+        for start in range(0, len(windows), self.sw_batch_size):
+            batch_windows = windows[start : start + self.sw_batch_size]
+            win_data = torch.cat([padded[i][(slice(None), slice(None)) + sl] for i, sl in batch_windows])
+            seg = network(win_data.to(sw_device))
+            if isinstance(seg, (list, tuple)):
+                seg = seg[0]
+            seg = seg.to(device)
+
+            for j, (i, sl) in enumerate(batch_windows):
+                if outputs[i] is None:
+                    outputs[i] = torch.zeros((1, seg.shape[1]) + padded[i].shape[2:], dtype=torch.float, device=device)
+                    counts[i] = torch.zeros((1, 1) + padded[i].shape[2:], dtype=torch.float, device=device)
+                outputs[i][(slice(None), slice(None)) + sl] += seg[j : j + 1].float() * importance_map
+                counts[i][(slice(None), slice(None)) + sl] += importance_map
+
+        results = []
+        for out, count, pad in zip(outputs, counts, pads):
+            out /= count
+            results.append(out[(slice(None), slice(None)) + tuple(slice(a, b) for a, b in pad)])
+
+        return results
+
+
+class StreamingArgmaxInferer:
+    """
+    Sliding window inference, which never materializes the full resolution float logits.
+    The windows are processed in the order of their position along the last spatial dim, and are
+    accumulated into a slab of the window depth. As soon as no more windows can contribute to the leading
+    part of the slab, that part is finalized (softmax/argmax or sigmoid/threshold) into the output label map
+    (uint8 or uint16), and the slab is shifted forward. The results are identical to the full accumulation,
+    while the float memory is proportional to the window depth instead of the image depth.
+    """
+
+    def __init__(
+        self,
+        roi_size: Sequence[int],
+        sw_batch_size: int = 1,
+        overlap: float = 0.625,
+        mode: str = "gaussian",
+        sigma_scale: float = 0.125,
+        cval: float = 0.0,
+        sigmoid: bool = False,
+        label_dtype: torch.dtype = torch.uint8,
+    ) -> None:
+        self.roi_size = [int(r) for r in roi_size]
+        self.sw_batch_size = max(1, int(sw_batch_size))
+        self.overlap = overlap
+        self.mode = mode
+        self.sigma_scale = sigma_scale
+        self.cval = cval
+        self.sigmoid = sigmoid
+        self.label_dtype = label_dtype
+
+    def __call__(self, inputs: torch.Tensor, network: Callable):
+        image_size = inputs.shape[2:]
+        pad_size = [max(r - s, 0) for r, s in zip(self.roi_size, image_size)]
+        pad = []
+        for p in reversed(pad_size):
+            pad.extend([p // 2, p - p // 2])
+        x = F.pad(inputs, pad=pad, mode="constant", value=self.cval) if any(pad_size) else inputs
+        padded_size = x.shape[2:]
+        scan_interval = [
+            r if r == s else max(int(r * (1 - self.overlap)), 1) for r, s in zip(self.roi_size, padded_size)
+        ]
+
+        # group the windows by their start along the last dim
+        groups: Dict[int, List] = {}
+        for sl in dense_patch_slices(padded_size, self.roi_size, scan_interval):
+            groups.setdefault(sl[-1].start, []).append(sl)
+
+        device = x.device
+        depth = self.roi_size[-1]
+        importance_map = compute_importance_map(
+            self.roi_size, mode=self.mode, sigma_scale=self.sigma_scale, device=device
+        ).clamp(min=1e-3)
+        acc = count = labels = None
+        base = 0
+
+        def finalize(end):
+            # finalize the [base, end) part of the slab, and shift the slab forward
+            n = end - base
+            logits = acc[..., :n] / count[..., :n]
+            if self.sigmoid:
+                prob = torch.sigmoid(logits)
+                labels[..., base:end] = (prob >= 0.5).to(self.label_dtype)
+            else:
+                prob = torch.softmax(logits, dim=1)
+                labels[..., base:end] = torch.argmax(prob, dim=1, keepdim=True).to(self.label_dtype)
+            acc.copy_(torch.roll(acc, shifts=-n, dims=-1))
+            count.copy_(torch.roll(count, shifts=-n, dims=-1))
+            acc[..., depth - n :] = 0
+            count[..., depth - n :] = 0
+
+        for start in sorted(groups):
+            if acc is not None and start > base:
+                finalize(start)
+            base = start
+            slices = groups[start]
+            for b in range(0, len(slices), self.sw_batch_size):
+                batch_slices = slices[b : b + self.sw_batch_size]
+                win_data = torch.cat([x[(slice(None), slice(None)) + sl] for sl in batch_slices])
+                seg = network(win_data)
+                if isinstance(seg, (list, tuple)):
+                    seg = seg[0]
+
+                if acc is None:
+                    slab_size = tuple(padded_size[:-1]) + (depth,)
+                    acc = torch.zeros((1, seg.shape[1]) + slab_size, dtype=torch.float, device=device)
+                    count = torch.zeros((1, 1) + slab_size, dtype=torch.float, device=device)
+                    label_channels = seg.shape[1] if self.sigmoid else 1
+                    labels = torch.zeros(
+                        (1, label_channels) + tuple(padded_size), dtype=self.label_dtype, device=device
+                    )
+
+                for j, sl in enumerate(batch_slices):
+                    slab_sl = (slice(None), slice(None)) + tuple(sl[:-1]) + (slice(0, depth),)
+                    acc[slab_sl] += seg[j : j + 1].float() * importance_map
+                    count[slab_sl] += importance_map
+
+        finalize(padded_size[-1])
+
+        crop = (slice(None), slice(None)) + tuple(slice(p // 2, p // 2 + s) for p, s in zip(pad_size, image_size))
+        return labels[crop]
+
+
+class AsyncPostTransform:
+    """
+    Runs the post transforms (e.g. Invertd, AsDiscreted, SaveImaged) in a pool of background threads,
+    off the critical path of the inference loop. Calling it submits an item and returns immediately,
+    unless max_pending items are already queued or in progress, in which case it blocks until one completes
+    (back-pressure), so that the memory used by pending predictions remains bounded.
+    The transforms are not thread-safe (e.g. the inverted transforms and the image writers keep state), so each
+    worker thread builds its own with post_transforms_fn. The submitted predictions are moved to the CPU by the
+    caller, which keeps the worker threads off the inference device.
+    Errors raised in the background are re-raised on the next call or in shutdown().
+    """
+
+    def __init__(self, post_transforms_fn: Callable[[], Callable], num_workers: int = 1, max_pending: int = 2) -> None:
+        self.post_transforms_fn = post_transforms_fn
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix="post_transform")
+        self.semaphore = threading.BoundedSemaphore(max(1, max_pending))
+        self.futures: List[Future] = []
+
+    def _run(self, data):
+        try:
+            post_transforms = getattr(self.local, "post_transforms", None)
+            if post_transforms is None:
+                post_transforms = self.local.post_transforms = self.post_transforms_fn()
+            return post_transforms(data)
+        finally:
+            self.semaphore.release()
+
+    def _check_done(self):
+        pending = []
+        for future in self.futures:
+            if future.done():
+                future.result()  # re-raise errors, if any
+            else:
+                pending.append(future)
+        self.futures = pending
+
+    def __call__(self, data) -> None:
+        self._check_done()
+        self.semaphore.acquire()
+        self.futures.append(self.executor.submit(self._run, data))
+
+    def shutdown(self) -> None:
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.futures = []
+            self.executor.shutdown(wait=True)
+
+
+class DeviceMetrics:
+    """
+    Weighted running averages of named values (e.g. loss and per class accuracy), accumulated on the device.
+    append() never synchronizes with the host. report() returns the local averages at most every report_interval
+    seconds: on GPU the copy to the host is started asynchronously and returned by a later call, once it is complete.
+    aggregate() reduces all values across the ranks with a single all-reduce (at the end of the epoch).
+    """
+
+    def __init__(self, device, report_interval: float = 5.0) -> None:
+        self.device = device
+        self.report_interval = report_interval
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.counts: Dict[str, torch.Tensor] = {}
+        self._last_report = 0.0
+        self._pending = None
+
+    def append(self, name: str, value, count=1) -> None:
+        value = torch.as_tensor(value, dtype=torch.float, device=self.device).detach()
+        count = torch.as_tensor(count, dtype=torch.float, device=self.device) * torch.ones_like(value)
+        finite = torch.isfinite(value)
+        count = torch.where(finite, count, torch.zeros_like(count))
+        value = torch.where(finite, value, torch.zeros_like(value)) * count
+        if name in self.sums:
+            self.sums[name] += value
+            self.counts[name] += count
+        else:
+            self.sums[name], self.counts[name] = value, count
+
+    def _flatten(self):
+        names = sorted(self.sums)
+        flat = torch.cat([torch.cat([self.sums[n].flatten(), self.counts[n].flatten()]) for n in names])
+        return names, flat
+
+    def _averages(self, names, flat) -> Dict[str, Any]:
+        """
+        A float for the values appended as scalars (e.g. loss), otherwise an array of their shape (e.g. the
+        per class accuracy, even with a single class)
+        """
+        result, start = {}, 0
+        flat = flat.numpy()
+        for name in names:
+            shape = tuple(self.sums[name].shape)
+            n = self.sums[name].numel()
+            with np.errstate(divide="ignore", invalid="ignore"):
+                avg = flat[start : start + n] / flat[start + n : start + 2 * n]
+            result[name] = float(avg[0]) if len(shape) == 0 else avg.reshape(shape)
+            start += 2 * n
+        return result
+
+    def report(self) -> Optional[Dict[str, Any]]:
+        """
+        The local averages, or None if no new report is available yet (non-blocking)
+        """
+        if self._pending is not None:
+            names, host, event = self._pending
+            if not event.query():
+                return None
+            self._pending = None
+            return self._averages(names, host)
+
+        now = time.time()
+        if len(self.sums) == 0 or now - self._last_report < self.report_interval:
+            return None
+        self._last_report = now
+        names, flat = self._flatten()
+        if not flat.is_cuda:
+            return self._averages(names, flat)
+        host = torch.empty(flat.shape, dtype=flat.dtype, pin_memory=True)
+        host.copy_(flat, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        self._pending = (names, host, event)
+        return None
+
+    def aggregate(self) -> Dict[str, Any]:
+        """
+        The averages across all ranks (a single all-reduce)
+        """
+        if len(self.sums) == 0:
+            return {}
+        names, flat = self._flatten()
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        return self._averages(names, flat.cpu())
+
+
+class StageProfiler:
+    """
+    Opt-in per-iteration stage timing of the training/validation loops (e.g. data wait, transfer, forward,
+    backward, optimizer, metric), aggregated per epoch together with the host RSS and the device peak memory.
+    When enabled, cuda is synchronized at stage boundaries (so that asynchronous kernels are attributed to
+    the right stage), and the stages are optionally saved as Chrome trace events (chrome://tracing or Perfetto).
+    When disabled, stage() is a no-op.
+    """
+
+    train_stages = ("data_wait", "transfer", "forward", "backward", "optimizer", "metric")
+    val_stages = ("data_wait", "transfer", "forward", "post", "metric")
+
+    def __init__(self, enabled: bool = False, device=None, trace_path: Optional[str] = None, pid: int = 0) -> None:
+        self.enabled = enabled
+        self.device = torch.device(device) if device is not None else torch.device("cpu")
+        self.trace_path = trace_path
+        self.pid = pid
+        self.trace_events: List[Dict] = []
+        self.phase = "train"
+        self.stage_times: Dict[str, float] = {}
+        self.start_time = time.time()
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def start_epoch(self, phase: str = "train") -> None:
+        self.phase = phase
+        self.stage_times = {}
+        if self.enabled and self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def add(self, name: str, start: float, end: float) -> None:
+        if not self.enabled:
+            return
+        self.stage_times[name] = self.stage_times.get(name, 0.0) + (end - start)
+        if self.trace_path is not None:
+            self.trace_events.append(
+                {
+                    "name": name,
+                    "cat": self.phase,
+                    "ph": "X",
+                    "ts": (start - self.start_time) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": self.pid,
+                    "tid": self.phase,
+                }
+            )
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        self.synchronize()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.synchronize()
+            self.add(name, start, time.time())
+
+    def epoch_summary(self) -> Dict[str, float]:
+        """
+        Returns the total time (in seconds) of each stage in the current epoch, the host RSS and device peak memory (GB)
+        """
+        stages = self.train_stages if self.phase == "train" else self.val_stages
+        summary = {name: self.stage_times.get(name, 0.0) for name in stages}
+        summary["host_rss_gb"] = psutil.Process().memory_info().rss / 1024**3
+        summary["device_peak_gb"] = (
+            torch.cuda.max_memory_allocated(self.device) / 1024**3 if self.device.type == "cuda" else 0.0
+        )
+        if self.trace_path is not None:
+            ts = (time.time() - self.start_time) * 1e6
+            self.trace_events.append(
+                {
+                    "name": f"{self.phase}_memory_gb",
+                    "ph": "C",
+                    "ts": ts,
+                    "pid": self.pid,
+                    "args": {"host_rss": summary["host_rss_gb"], "device_peak": summary["device_peak_gb"]},
+                }
+            )
+        return summary
+
+    def save_trace(self) -> None:
+        if self.enabled and self.trace_path is not None:
+            with open(self.trace_path, "w") as f:
+                json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f)
+
+
+def loader_prefetch_kwargs(num_workers: int, prefetch_factor: Optional[int] = None) -> Dict[str, int]:
+    """
+    DataLoader prefetch_factor argument, omitted (the torch default) if unset or without workers,
+    torch < 2.0 rejects prefetch_factor=None
+    """
+    if num_workers > 0 and prefetch_factor is not None:
+        return {"prefetch_factor": int(prefetch_factor)}
+    return {}
+
+
 def schedule_validation_epochs(num_epochs, num_epochs_per_validation=None, fraction=0.16) -> list:
     """
     Schedule of epochs to validate (progressively more frequently)
@@ -520,18 +1365,23 @@ class DataTransformBuilder:
         data_root_dir="",
         output_dtype=np.uint8,
         save_mask_mode=None,
+        discrete=False,
     ) -> Compose:
+        if save_mask_mode == "prob" and discrete:
+            raise ValueError(
+                "save_mask_mode prob needs the probabilities, it can not be used with infer#streaming_argmax"
+            )
         ts = []
         if invert and transform is not None:
             # if resample:
             #     ts.append(ToDeviced(keys="pred", device=torch.device("cpu")))
-            ts.append(Invertd(keys="pred", orig_keys="image", transform=transform, nearest_interp=False))
+            ts.append(Invertd(keys="pred", orig_keys="image", transform=transform, nearest_interp=discrete))
 
         if save_mask and output_path is not None:
             ts.append(CopyItemsd(keys="pred", times=1, names="seg"))
-            if save_mask_mode == "prob":
+            if save_mask_mode == "prob" and not discrete:
                 output_dtype = np.float32
-            else:
+            elif not discrete:
                 ts.append(
                     AsDiscreted(keys="seg", argmax=True) if not sigmoid else AsDiscreted(keys="seg", threshold=0.5)
                 )
@@ -567,6 +1417,30 @@ class DataTransformBuilder:
 
         return compose_ts
 
+    def get_cache_key(self, augment=False, resample_label=False) -> str:
+        """
+        Returns a hash of the settings that define the deterministic (cacheable) part of the pipeline
+        """
+        settings = {
+            "augment": augment,
+            "resample_label": resample_label,
+            "image_key": self.image_key,
+            "label_key": self.label_key,
+            "resample": self.resample,
+            "resample_resolution": self.resample_resolution,
+            "normalize_mode": self.normalize_mode,
+            "normalize_params": self.normalize_params,
+            "extra_modalities": self.extra_modalities,
+            "custom_transforms": self.custom_transforms,
+            "class_index": self.class_index,
+            "extra_options": self.extra_options,
+        }
+        if augment:
+            settings.update({"roi_size": self.roi_size, "crop_mode": self.crop_mode, "crop_params": self.crop_params})
+
+        content = json.dumps(settings, sort_keys=True, default=transform_cache_key)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
     def __repr__(self) -> str:
         out: str = f"DataTransformBuilder: with image_key: {self.image_key}, label_key: {self.label_key} \n"
         out += f"roi_size {self.roi_size} resample {self.resample} resample_resolution {self.resample_resolution} \n"
@@ -650,6 +1524,11 @@ class Segmenter:
                     anisotropic_scales=config["anisotropic_scales"],
                     levels=len(config["network"]["blocks_down"]),
                     output_classes=config["output_classes"],
+                    input_channels=config["input_channels"],
+                    dsdepth=config["network"].get("dsdepth", 1),
+                    amp=config["amp"],
+                    channels_last=config["channels_last"],
+                    memory_model=config["memory_model"],
                 )
 
                 config["roi_size"] = roi_size
@@ -860,6 +1739,12 @@ class Segmenter:
         config.setdefault("quick", False)
         config.setdefault("sigmoid", False)
         config.setdefault("cache_rate", None)
+        config.setdefault("disk_cache_dir", None)
+        config.setdefault("runtime_cache_dir", None)
+        config.setdefault("crop_reservoir_size", 0)
+        config.setdefault("crop_reservoir_reuse", 4)
+        config.setdefault("cache_budget_gb", None)
+        config.setdefault("cache_eviction", "lru")
         config.setdefault("cache_class_indices", None)
         config.setdefault("crop_add_background", True)
         config.setdefault("orientation_ras", False)
@@ -883,6 +1768,11 @@ class Segmenter:
         config.setdefault("ckpt_path", None)
         config.setdefault("ckpt_save", True)
         config.setdefault("log_output_file", None)
+        config.setdefault("profile_stages", False)
+        config.setdefault("report_interval", 5.0)
+        config.setdefault("incremental_validation", False)
+        config.setdefault("validation_time_fraction", 0.25)
+        config.setdefault("validation_best_margin", 0.01)
 
         config.setdefault("crop_mode", "ratio")
         config.setdefault("crop_ratios", None)
@@ -890,6 +1780,9 @@ class Segmenter:
         config.setdefault("resample", False)
         config.setdefault("roi_size", [128, 128, 128])
         config.setdefault("num_workers", 4)
+        config.setdefault("prefetch_factor", None)
+        config.setdefault("auto_tune_loader", False)
+        config.setdefault("auto_tune_step_time", None)
         config.setdefault("extra_modalities", {})
         config.setdefault("intensity_bounds", [-250, 250])
         config.setdefault("stop_on_lowacc", True)
@@ -922,6 +1815,7 @@ class Segmenter:
         config.setdefault("auto_scale_batch", False)
         config.setdefault("auto_scale_roi", False)
         config.setdefault("auto_scale_filters", False)
+        config.setdefault("memory_model", False)
 
         if pretrained_ckpt_name is not None:
             config["auto_scale_roi"] = False
@@ -950,7 +1844,7 @@ class Segmenter:
         return config
 
     def config_save_updated(self, save_path=None):
-        if self.global_rank == 0 and self.config["auto_scale_allowed"]:
+        if self.global_rank == 0 and (self.config["auto_scale_allowed"] or self.config["auto_tune_loader"]):
             # reload input config
             config = ConfigParser.load_config_files(self.config_file)
             parser = ConfigParser(config=config)
@@ -960,6 +1854,10 @@ class Segmenter:
             config["batch_size"] = self.config["batch_size"]
             config["roi_size"] = self.config["roi_size"]
             config["num_crops_per_image"] = self.config["num_crops_per_image"]
+            if self.config["auto_tune_loader"]:
+                config["num_workers"] = self.config["num_workers"]
+                config["prefetch_factor"] = self.config["prefetch_factor"]
+                config["auto_tune_loader"] = False  # already tuned
 
             if "init_filters" in self.config["network"]:
                 config["network"]["init_filters"] = self.config["network"]["init_filters"]
@@ -1026,9 +1924,34 @@ class Segmenter:
             )
             self.config["start_epoch"] = int(self.config["start_epoch"]) + 1
 
-    def get_shared_memory_list(self, length=0):
-        mp.current_process().authkey = np.arange(32, dtype=np.uint8).tobytes()
-        shl0 = mp.Manager().list([None] * length)
+    def gather_cache_stats(self, runtime_cache: SharedMemoryCache) -> Dict:
+        """
+        Cache statistics of all the nodes since the last call (each node-local cache is read by its local rank 0),
+        the number of items and bytes are averaged over the nodes. To be called on all ranks.
+        """
+        keys = ("hits", "misses", "items", "bytes")
+        stats = runtime_cache.cache_stats(reset=True) if self.rank == 0 else {}
+        values = torch.tensor([stats.get(k, 0) for k in keys] + [1 if self.rank == 0 else 0], dtype=torch.float64)
+        if self.distributed:
+            values = values.to(device=self.device)
+            dist.all_reduce(values, op=dist.ReduceOp.SUM)
+        hits, misses, items, nbytes, num_nodes = values.cpu().tolist()
+        num_nodes = max(1, num_nodes)
+        return {
+            "hits": int(hits),
+            "misses": int(misses),
+            "hit_rate": hits / max(1, hits + misses),
+            "items": int(items / num_nodes),
+            "bytes": nbytes / num_nodes,
+        }
+
+    def get_shared_memory_list(self, length=0, max_bytes=None):
+        shl0 = SharedMemoryCache(
+            length=length,
+            root_dir=self.config["runtime_cache_dir"],
+            max_bytes=max_bytes,
+            eviction=self.config["cache_eviction"],
+        )
 
         if self.distributed:
             # to support multi-node training, we need check for a local process group
@@ -1068,7 +1991,7 @@ class Segmenter:
 
         return shl
 
-    def get_train_loader(self, data, cache_rate=0, persistent_workers=False):
+    def get_train_loader(self, data, cache_rate=0, persistent_workers=False, cache_max_bytes=None):
         distributed = self.distributed
         num_workers = self.config["num_workers"]
         batch_size = self.config["batch_size"]
@@ -1076,7 +1999,7 @@ class Segmenter:
         train_transform = self.get_data_transform_builder()(augment=True, resample_label=True)
 
         if cache_rate > 0:
-            runtime_cache = self.get_shared_memory_list(length=len(data))
+            runtime_cache = self.get_shared_memory_list(length=len(data), max_bytes=cache_max_bytes)
             train_ds = CacheDataset(
                 data=data,
                 transform=train_transform,
@@ -1084,33 +2007,59 @@ class Segmenter:
                 cache_rate=cache_rate,
                 runtime_cache=runtime_cache,
             )
+        elif self.config["disk_cache_dir"] is not None:
+            train_ds = DiskCacheDataset(
+                data=data,
+                transform=train_transform,
+                cache_dir=self.config["disk_cache_dir"],
+                transform_key=self.get_data_transform_builder().get_cache_key(augment=True, resample_label=True),
+            )
+        elif self.config["crop_reservoir_size"] > 0:
+            train_ds = CropReservoirDataset(
+                data=data,
+                transform=train_transform,
+                pool_size=self.config["crop_reservoir_size"],
+                num_reuse=self.config["crop_reservoir_reuse"],
+            )
         else:
             train_ds = Dataset(data=data, transform=train_transform)
 
-        train_sampler = DistributedSampler(train_ds, shuffle=True) if distributed else None
+        # CropReservoirDataset is an IterableDataset, sharded (and shuffled) internally
+        iterable = isinstance(train_ds, IterableDataset)
+        train_sampler = DistributedSampler(train_ds, shuffle=True) if distributed and not iterable else None
         train_loader = DataLoader(
             train_ds,
             batch_size=batch_size,
-            shuffle=(train_sampler is None),
+            shuffle=(train_sampler is None and not iterable),
             num_workers=num_workers,
             sampler=train_sampler,
             persistent_workers=persistent_workers and num_workers > 0,
             pin_memory=True,
+            **loader_prefetch_kwargs(num_workers, self.config["prefetch_factor"]),
         )
 
         return train_loader
 
-    def get_val_loader(self, data, cache_rate=0, resample_label=False, persistent_workers=False):
-        distributed = self.distributed
+    def get_val_loader(
+        self, data, cache_rate=0, resample_label=False, persistent_workers=False, cache_max_bytes=None, distributed=None
+    ):
+        distributed = self.distributed if distributed is None else distributed
         num_workers = self.config["num_workers"]
 
         val_transform = self.get_data_transform_builder()(augment=False, resample_label=resample_label)
 
         if cache_rate > 0:
-            runtime_cache = self.get_shared_memory_list(length=len(data))
+            runtime_cache = self.get_shared_memory_list(length=len(data), max_bytes=cache_max_bytes)
             val_ds = CacheDataset(
                 data=data, transform=val_transform, copy_cache=False, cache_rate=cache_rate, runtime_cache=runtime_cache
             )
+        elif self.config["disk_cache_dir"] is not None:
+            val_ds = DiskCacheDataset(
+                data=data,
+                transform=val_transform,
+                cache_dir=self.config["disk_cache_dir"],
+                transform_key=self.get_data_transform_builder().get_cache_key(resample_label=resample_label),
+            )
         else:
             val_ds = Dataset(data=data, transform=val_transform)
 
@@ -1127,6 +2076,157 @@ class Segmenter:
 
         return val_loader
 
+    def measure_model_step_time(self, num_iters=3):
+        """
+        Measures the training step time (forward and backward) per sample of roi_size, on the configured device.
+        The model is unwrapped from DistributedDataParallel, so that the step runs locally (no gradient all-reduce)
+        """
+        config = self.config
+        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+        spatial_dims = config["network"].get("spatial_dims", 3)
+        roi_size = list(config["roi_size"])[:spatial_dims]
+        data = torch.randn([1, config["input_channels"]] + roi_size, device=self.device)
+        target = torch.zeros([1, 1] + roi_size, device=self.device)
+
+        model.train()
+        step_times = []
+        for _ in range(num_iters + 1):
+            start_time = time.time()
+            with autocast(enabled=config["amp"]):
+                logits = model(data)
+            loss = self.loss_function(logits, target)
+            loss.backward()
+            if self.device.type == "cuda":
+                torch.cuda.synchronize(self.device)
+            step_times.append(time.time() - start_time)
+        for param in model.parameters():
+            param.grad = None
+
+        return float(np.mean(step_times[1:]))  # first iteration is a warm-up
+
+    def loader_trial(self, dataset, num_workers, prefetch_factor, step_time, num_batches=8):
+        """
+        Returns the throughput (samples per second) of a training data loader setting, with the model step
+        replaced by a stand-in sleeping step_time per sample (the main process is idle while the model runs on GPU)
+        """
+        loader = DataLoader(
+            dataset,
+            batch_size=self.config["batch_size"],
+            shuffle=True,
+            num_workers=num_workers,
+            pin_memory=self.device.type == "cuda",
+            **loader_prefetch_kwargs(num_workers, prefetch_factor),
+        )
+
+        num_samples = 0
+        start_time = None
+        loader_iter = iter(loader)
+        for idx in range(num_batches + 1):
+            try:
+                batch_data = next(loader_iter)
+            except StopIteration:
+                loader_iter = iter(loader)
+                batch_data = next(loader_iter)
+            if idx == 0:
+                start_time = time.time()  # excluding the workers start-up
+                continue
+            batch_size = batch_data["image"].shape[0]
+            time.sleep(step_time * batch_size)  # model stand-in
+            num_samples += batch_size
+
+        throughput = num_samples / max(time.time() - start_time, 1e-8)
+        batch_data = loader_iter = loader = None
+        return throughput
+
+    def auto_tune_loader(self, data, cache_rate=0, num_images=8, num_batches=8, tolerance=0.05):
+        """
+        Tunes num_workers, num_crops_per_image and prefetch_factor of the training data loader, by running a few
+        iterations of the real data transforms (on a subset of data) with a timing stand-in for the model step.
+        The parameters are tuned one at a time (coordinate search), preferring the cheaper setting unless
+        the throughput improves by more than tolerance. The best settings are saved into the config.
+        """
+        config = self.config
+        tuned = None
+
+        # measured on every rank (locally, without gradient sync), rank 0 uses its own
+        step_time = config["auto_tune_step_time"]
+        if step_time is None:
+            step_time = self.measure_model_step_time()
+        step_time = float(step_time)
+
+        if self.global_rank == 0:
+
+            max_workers = max(1, min(psutil.cpu_count(logical=False) or os.cpu_count() or 1, 16))
+            worker_options = sorted({0, *[w for w in (2, 4, 8, 16) if w <= max_workers], max_workers})
+            crop_options = [int(config["num_crops_per_image"])]
+            if config["crop_mode"] == "ratio":
+                crop_options = sorted({*crop_options, 1, 2, 4})
+
+            trial_data = data[:num_images]
+            datasets = {}
+
+            def get_dataset(num_crops):
+                if num_crops not in datasets:
+                    datasets.clear()
+                    config["num_crops_per_image"] = num_crops
+                    self._data_transform_builder = None
+                    datasets[num_crops] = CacheDataset(
+                        data=trial_data,
+                        transform=self.get_data_transform_builder()(augment=True, resample_label=True),
+                        cache_rate=1.0 if cache_rate > 0 else 0.0,
+                        copy_cache=False,
+                        num_workers=None,
+                        progress=False,
+                    )
+                return datasets[num_crops]
+
+            best = {
+                "num_workers": int(config["num_workers"]),
+                "num_crops_per_image": int(config["num_crops_per_image"]),
+                "prefetch_factor": config["prefetch_factor"] or 2,
+            }
+            search = [
+                ("num_workers", worker_options),
+                ("num_crops_per_image", crop_options),
+                ("prefetch_factor", [2, 4, 8]),
+            ]
+
+            best_throughput = 0
+            for name, options in search:
+                if name == "prefetch_factor" and best["num_workers"] == 0:
+                    continue
+                for option in options:
+                    trial = dict(best, **{name: option})
+                    throughput = self.loader_trial(
+                        dataset=get_dataset(trial["num_crops_per_image"]),
+                        num_workers=trial["num_workers"],
+                        prefetch_factor=trial["prefetch_factor"],
+                        step_time=step_time,
+                        num_batches=num_batches,
+                    )
+                    print(f"Auto tune loader {trial} throughput {throughput:.2f} samples/s")
+                    if throughput > best_throughput * (1 + tolerance):  # options are in the order of cost
+                        best, best_throughput = trial, throughput
+            datasets.clear()
+
+            print(
+                f"Auto tune loader selected {best} throughput {best_throughput:.2f} samples/s "
+                f"(model step stand-in {step_time:.3f}s per sample, at most {1.0 / max(step_time, 1e-8):.2f} samples/s)"
+            )
+            tuned = best
+
+        if self.distributed:
+            tuned = [tuned]
+            dist.broadcast_object_list(tuned, src=0)
+            tuned = tuned[0]
+
+        config["num_workers"] = tuned["num_workers"]
+        config["num_crops_per_image"] = tuned["num_crops_per_image"]
+        config["prefetch_factor"] = tuned["prefetch_factor"]
+        self._data_transform_builder = None
+
+        return tuned
+
     def train(self):
         if self.global_rank == 0:
             print("Segmenter train called")
@@ -1180,6 +2280,13 @@ class Segmenter:
             train_cases=len(train_files), validation_cases=len(validation_files)
         )
 
+        cache_max_bytes_train = cache_max_bytes_val = None
+        if config["cache_budget_gb"] is not None:
+            # split the memory budget proportionally to the number of cases
+            cache_budget = int(float(config["cache_budget_gb"]) * 1024**3)
+            cache_max_bytes_train = cache_budget * len(train_files) // max(1, len(train_files) + len(validation_files))
+            cache_max_bytes_val = cache_budget - cache_max_bytes_train
+
         if config["cache_class_indices"] is None:
             config["cache_class_indices"] = cache_rate_train > 0
 
@@ -1206,6 +2313,9 @@ class Segmenter:
         elif num_steps_per_image is None:
             num_steps_per_image = 1
 
+        if config["auto_tune_loader"]:
+            self.auto_tune_loader(data=train_files, cache_rate=cache_rate_train)
+
         num_crops_per_image = int(config["num_crops_per_image"])
         num_epochs_per_saving = max(1, config["num_epochs_per_saving"] // num_crops_per_image)
         num_warmup_epochs = max(3, config["num_warmup_epochs"] // num_crops_per_image)
@@ -1227,10 +2337,19 @@ class Segmenter:
         if self.global_rank == 0:
             print(f"Scheduling validation loops at epochs: {val_schedule_list}")
 
-        train_loader = self.get_train_loader(data=train_files, cache_rate=cache_rate_train, persistent_workers=True)
+        train_loader = self.get_train_loader(
+            data=train_files,
+            cache_rate=cache_rate_train,
+            persistent_workers=True,
+            cache_max_bytes=cache_max_bytes_train,
+        )
 
         val_loader = self.get_val_loader(
-            data=validation_files, cache_rate=cache_rate_val, resample_label=True, persistent_workers=True
+            data=validation_files,
+            cache_rate=cache_rate_val,
+            resample_label=True,
+            persistent_workers=True,
+            cache_max_bytes=cache_max_bytes_val,
         )
 
         optim_name = config.get("optim_name", None)  # experimental
@@ -1275,9 +2394,29 @@ class Segmenter:
                 mlflow.start_run(run_name=f'segresnet - fold{config["fold"]} - train')
 
             csv_path = os.path.join(ckpt_path, "accuracy_history.csv")
-            self.save_history_csv(
-                csv_path=csv_path,
-                header=["epoch", "metric", "loss", "iter", "time", "train_time", "validation_time", "epoch_time"],
+            csv_header = ["epoch", "metric", "loss", "iter", "time", "train_time", "validation_time", "epoch_time"]
+            if config["profile_stages"]:
+                csv_header += ["train_" + k for k in StageProfiler.train_stages + ("host_rss_gb", "device_peak_gb")]
+                csv_header += ["val_" + k for k in StageProfiler.val_stages + ("host_rss_gb", "device_peak_gb")]
+            self.save_history_csv(csv_path=csv_path, header=csv_header)
+
+        profiler = StageProfiler(
+            enabled=config["profile_stages"],
+            device=self.device,
+            trace_path=os.path.join(ckpt_path, "profile_trace.json") if csv_path is not None else None,
+            pid=self.global_rank,
+        )
+        train_profile = val_profile = {}
+
+        incremental = None
+        world_size = dist.get_world_size() if distributed else 1
+        if config["incremental_validation"] and val_loader is not None and len(val_loader.dataset) >= world_size:
+            dataset_indices = range(self.global_rank if distributed else 0, len(val_loader.dataset), world_size)
+            incremental = IncrementalValidation(
+                num_cases=len(dataset_indices),
+                dataset_indices=dataset_indices,
+                time_fraction=config["validation_time_fraction"],
+                best_margin=config["validation_best_margin"],
             )
 
         do_torch_save = (self.global_rank == 0) and ckpt_path is not None and config["ckpt_save"]
@@ -1361,10 +2500,19 @@ class Segmenter:
                     use_cuda=use_cuda,
                     channels_last=channels_last,
                     num_steps_per_image=num_steps_per_image,
+                    profiler=profiler,
+                    report_interval=config["report_interval"],
                 )
+                if profiler.enabled:
+                    train_profile = profiler.epoch_summary()
 
             train_time = time.time() - start_time
 
+            runtime_cache = getattr(train_loader.dataset, "runtime_cache", None)
+            cache_stats = None
+            if isinstance(runtime_cache, SharedMemoryCache) and runtime_cache.max_bytes is not None:
+                cache_stats = self.gather_cache_stats(runtime_cache)
+
             if self.global_rank == 0:
                 print(
                     f"Final training  {report_epoch}/{report_num_epochs - 1} "
@@ -1379,6 +2527,22 @@ class Segmenter:
                     if mlflow_is_imported:
                         mlflow.log_metric("train/loss", train_loss, step=report_epoch)
 
+                if cache_stats is not None:
+                    print(
+                        f"Training cache hit_rate {cache_stats['hit_rate']:.3f} (hits {cache_stats['hits']} "
+                        f"misses {cache_stats['misses']}) cached {cache_stats['items']} items "
+                        f"{cache_stats['bytes'] / 1024**3:.2f}GB of {runtime_cache.max_bytes / 1024**3:.2f}GB "
+                        f"per node"
+                    )
+                    if tb_writer is not None:
+                        tb_writer.add_scalar("train/cache_hit_rate", cache_stats["hit_rate"], report_epoch)
+
+                if profiler.enabled:
+                    print(f"Training profile {report_epoch}: {self.format_profile(train_profile)}")
+                    if tb_writer is not None:
+                        for k, v in train_profile.items():
+                            tb_writer.add_scalar("profile_train/" + k, v, report_epoch)
+
             # validate every num_epochs_per_validation epochs (defaults to 1, every epoch)
             val_acc_mean = -1
             if (
@@ -1392,9 +2556,8 @@ class Segmenter:
                 start_time = time.time()
                 torch.cuda.empty_cache()
 
-                val_loss, val_acc = self.val_epoch(
+                val_kwargs = dict(
                     model=self.model,
-                    val_loader=val_loader,
                     sliding_inferrer=sliding_inferrer,
                     loss_function=loss_function,
                     acc_function=acc_function,
@@ -1407,7 +2570,17 @@ class Segmenter:
                     use_cuda=use_cuda,
                     channels_last=channels_last,
                     calc_val_loss=calc_val_loss,
+                    profiler=profiler,
+                    report_interval=config["report_interval"],
                 )
+                if incremental is not None:
+                    val_loss, val_acc, num_validated = self.incremental_val_epoch(
+                        incremental, val_loader=val_loader, train_time=train_time, best_metric=best_metric, **val_kwargs
+                    )
+                else:
+                    val_loss, val_acc = self.val_epoch(val_loader=val_loader, **val_kwargs)
+                if profiler.enabled:
+                    val_profile = profiler.epoch_summary()
 
                 torch.cuda.empty_cache()
                 validation_time = time.time() - start_time
@@ -1421,8 +2594,18 @@ class Segmenter:
                         f"loss: {val_loss:.4f} acc_avg: {val_acc_mean:.4f} acc: {val_acc} time: {validation_time:.2f}s"
                     )
 
+                    if incremental is not None:
+                        ages = incremental.ages(report_epoch)
+                        print(
+                            f"Incremental validation {num_validated}/{len(validation_files)} cases validated, "
+                            f"cached metric age (rank 0) mean {np.mean(ages):.1f} max {max(ages)} epochs"
+                        )
+
                     if tb_writer is not None:
                         tb_writer.add_scalar("val/acc", val_acc_mean, report_epoch)
+                        if incremental is not None:
+                            tb_writer.add_scalar("val/num_validated", num_validated, report_epoch)
+                            tb_writer.add_scalar("val/max_metric_age", max(ages), report_epoch)
                         if mlflow_is_imported:
                             mlflow.log_metric("val/acc", val_acc_mean, step=report_epoch)
 
@@ -1436,6 +2619,13 @@ class Segmenter:
                         if calc_val_loss:
                             tb_writer.add_scalar("val/loss", val_loss, report_epoch)
 
+                        for k, v in val_profile.items():
+                            tb_writer.add_scalar("profile_val/" + k, v, report_epoch)
+
+                    if profiler.enabled:
+                        print(f"Validation profile {report_epoch}: {self.format_profile(val_profile)}")
+                        profiler.save_trace()
+
                     timing_dict = dict(
                         time="{:.2f} hr".format((time.time() - pre_loop_time) / 3600),
                         train_time="{:.2f}s".format(train_time),
@@ -1469,6 +2659,8 @@ class Segmenter:
                             loss="{:.4f}".format(train_loss),
                             iter=report_epoch * len(train_loader.dataset),
                             **timing_dict,
+                            **{"train_" + k: "{:.3f}".format(v) for k, v in train_profile.items()},
+                            **{"val_" + k: "{:.3f}".format(v) for k, v in val_profile.items()},
                         )
 
                 # sanity check
@@ -1554,6 +2746,8 @@ class Segmenter:
                         f"Unable to validate at the original res since no model checkpoints found {best_ckpt_path}, {intermediate_ckpt_path}"
                     )
 
+        profiler.save_trace()
+
         if tb_writer is not None:
             tb_writer.flush()
             tb_writer.close()
@@ -1700,35 +2894,87 @@ class Segmenter:
             warnings.warn("No testing_files files found!")
             return
 
-        inf_loader = self.get_val_loader(data=testing_files, resample_label=False)
+        if self.distributed:
+            # each rank infers its own shard, balanced by the number of voxels (instead of DistributedSampler,
+            # which balances the number of cases only and pads the last ones with duplicates)
+            testing_files = partition_by_voxels(testing_files, dist.get_world_size())[dist.get_rank()]
+
+        # the cases are recorded once their prediction is completely saved
+        completed_cases = CompletedCases(output_path, self.global_rank)
+        if self.config["infer"].get("resume", False):
+            num_files = len(testing_files)
+            testing_files = completed_cases.pending(testing_files)
+            print(f"rank {self.global_rank} resuming, skipping {num_files - len(testing_files)} saved cases")
+
+        inf_loader = self.get_val_loader(data=testing_files, resample_label=False, distributed=False)
         inf_transform = inf_loader.dataset.transform
 
-        post_transforms = DataTransformBuilder.get_postprocess_transform(
-            save_mask=True,
-            invert=True,
-            transform=inf_transform,
-            sigmoid=self.config["sigmoid"],
-            output_path=output_path,
-            resample=self.config["resample"],
-            data_root_dir=self.config["data_file_base_dir"],
-            output_dtype=np.uint8 if self.config["output_classes"] < 255 else np.uint16,
-            save_mask_mode=self.config.get("save_mask_mode", None),
-        )
+        streaming_argmax = self.config["infer"].get("streaming_argmax", False)
+        sliding_inferrer = self.get_streaming_inferrer() if streaming_argmax else self.sliding_inferrer
+
+        def record_completed(data):
+            completed_cases.add(data["image"].meta[ImageMetaKey.FILENAME_OR_OBJ])
+            return data
+
+        def get_post_transforms(transform=inf_transform):
+            post_transforms = DataTransformBuilder.get_postprocess_transform(
+                save_mask=True,
+                invert=True,
+                transform=transform,
+                sigmoid=self.config["sigmoid"],
+                output_path=output_path,
+                resample=self.config["resample"],
+                data_root_dir=self.config["data_file_base_dir"],
+                output_dtype=np.uint8 if self.config["output_classes"] < 255 else np.uint16,
+                save_mask_mode=self.config.get("save_mask_mode", None),
+                discrete=streaming_argmax,
+            )
+            return Compose([post_transforms, record_completed])
+
+        post_num_workers = int(self.config["infer"].get("post_num_workers", 0))
+        if post_num_workers > 0:
+            # a private copy of the (inverted) transforms per worker thread
+            post_transforms = AsyncPostTransform(
+                lambda: get_post_transforms(transform=copy.deepcopy(inf_transform)),
+                num_workers=post_num_workers,
+                max_pending=int(self.config["infer"].get("post_queue_depth", 2)),
+            )
+        else:
+            post_transforms = get_post_transforms()
 
         start_time = time.time()
-        self.val_epoch(
-            model=self.model,
-            val_loader=inf_loader,
-            sliding_inferrer=self.sliding_inferrer,
-            rank=self.rank,
-            global_rank=self.global_rank,
-            sigmoid=self.config["sigmoid"],
-            use_amp=self.config["amp"],
-            use_cuda=self.config["cuda"],
-            post_transforms=post_transforms,
-            channels_last=self.config["channels_last"],
-            calc_val_loss=self.config["calc_val_loss"],
-        )
+        sw_num_images = int(self.config["infer"].get("sw_num_images", 1))
+        if sw_num_images > 1 and not streaming_argmax:
+            self.batched_infer_epoch(
+                model=self.model,
+                inf_loader=inf_loader,
+                post_transforms=post_transforms,
+                num_images=sw_num_images,
+                sw_batch_size=self.config["infer"].get("sw_batch_size", None),
+                rank=self.rank,
+                global_rank=self.global_rank,
+                sigmoid=self.config["sigmoid"],
+                use_amp=self.config["amp"],
+                use_cuda=self.config["cuda"],
+                channels_last=self.config["channels_last"],
+            )
+        else:
+            self.val_epoch(
+                model=self.model,
+                val_loader=inf_loader,
+                sliding_inferrer=sliding_inferrer,
+                rank=self.rank,
+                global_rank=self.global_rank,
+                sigmoid=self.config["sigmoid"],
+                use_amp=self.config["amp"],
+                use_cuda=self.config["cuda"],
+                post_transforms=post_transforms,
+                channels_last=self.config["channels_last"],
+                calc_val_loss=self.config["calc_val_loss"],
+            )
+
+        if isinstance(post_transforms, AsyncPostTransform):
+            post_transforms.shutdown()  # wait for all pending outputs to be saved
 
         if self.global_rank == 0:
             print(f"Inference complete, time {time.time() - start_time:.2f}s")
@@ -1755,21 +3001,28 @@ class Segmenter:
         memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
         data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=self.device)
 
-        with autocast(enabled=self.config["amp"]):
-            logits = self.sliding_inferrer(inputs=data, network=self.model)
+        streaming_argmax = infer_config.get("streaming_argmax", False)
+        if streaming_argmax:
+            # returns a label map, without the full resolution logits
+            with autocast(enabled=self.config["amp"]):
+                pred = self.get_streaming_inferrer()(inputs=data, network=self.model)
+            data = None
+        else:
+            with autocast(enabled=self.config["amp"]):
+                logits = self.sliding_inferrer(inputs=data, network=self.model)
 
-        data = None
+            data = None
 
-        try:
-            pred = self.logits2pred(logits, sigmoid=sigmoid)
-        except RuntimeError as e:
-            if not logits.is_cuda:
-                raise e
-            print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape}")
-            logits = logits.cpu()
-            pred = self.logits2pred(logits, sigmoid=sigmoid)
+            try:
+                pred = self.logits2pred(logits, sigmoid=sigmoid)
+            except RuntimeError as e:
+                if not logits.is_cuda:
+                    raise e
+                print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape}")
+                logits = logits.cpu()
+                pred = self.logits2pred(logits, sigmoid=sigmoid)
 
-        logits = None
+            logits = None
 
         if not invert_on_gpu:
             pred = pred.cpu()  # invert on cpu (default)
@@ -1784,6 +3037,7 @@ class Segmenter:
             data_root_dir=self.config["data_file_base_dir"],
             output_dtype=np.uint8 if self.config["output_classes"] < 255 else np.uint16,
             save_mask_mode=self.config.get("save_mask_mode", None),
+            discrete=streaming_argmax,
         )
 
         batch_data["pred"] = convert_to_dst_type(pred, batch_data["image"], dtype=pred.dtype, device=pred.device)[
@@ -1814,19 +3068,24 @@ class Segmenter:
         use_cuda=True,
         channels_last=False,
         num_steps_per_image=1,
+        profiler=None,
+        report_interval=5.0,
     ):
         model.train()
         device = torch.device(rank) if use_cuda else torch.device("cpu")
         memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
+        if profiler is None:
+            profiler = StageProfiler(enabled=False)
+        profiler.start_epoch("train")
 
-        run_loss = CumulativeAverage()
-        run_acc = CumulativeAverage()
+        run_metrics = DeviceMetrics(device=device, report_interval=report_interval)
 
-        start_time = time.time()
-        avg_loss = avg_acc = 0
+        start_time = iter_end_time = time.time()
         for idx, batch_data in enumerate(train_loader):
-            data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device)
-            target = batch_data["label"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device)
+            profiler.add("data_wait", iter_end_time, time.time())
+            with profiler.stage("transfer"):
+                data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device)
+                target = batch_data["label"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device)
 
             data_list = data.chunk(num_steps_per_image) if num_steps_per_image > 1 else [data]
             target_list = target.chunk(num_steps_per_image) if num_steps_per_image > 1 else [target]
@@ -1839,15 +3098,19 @@ class Segmenter:
                 for param in model.parameters():
                     param.grad = None
 
-                with autocast(enabled=use_amp):
-                    logits = model(data)
+                with profiler.stage("forward"):
+                    with autocast(enabled=use_amp):
+                        logits = model(data)
+                    loss = loss_function(logits, target)
 
-                loss = loss_function(logits, target)
-                grad_scaler.scale(loss).backward()
-                grad_scaler.step(optimizer)
-                grad_scaler.update()
+                with profiler.stage("backward"):
+                    grad_scaler.scale(loss).backward()
 
-                with torch.no_grad():
+                with profiler.stage("optimizer"):
+                    grad_scaler.step(optimizer)
+                    grad_scaler.update()
+
+                with profiler.stage("metric"), torch.no_grad():
                     pred = self.logits2pred(logits, sigmoid=sigmoid, skip_softmax=True)
                     acc = acc_function(pred, target)
 
@@ -1855,18 +3118,17 @@ class Segmenter:
                 if isinstance(acc, (list, tuple)):
                     acc, batch_size_adjusted = acc
 
-                run_loss.append(loss, count=batch_size)
-                run_acc.append(acc, count=batch_size_adjusted)
-
-            avg_loss = run_loss.aggregate()
-            avg_acc = run_acc.aggregate()
+                run_metrics.append("loss", loss, count=batch_size)
+                run_metrics.append("acc", acc, count=batch_size_adjusted)
 
-            if global_rank == 0:
+            report = run_metrics.report() if global_rank == 0 else None
+            if report is not None:
                 print(
                     f"Epoch {epoch}/{num_epochs} {idx}/{len(train_loader)} "
-                    f"loss: {avg_loss:.4f} acc {avg_acc}  time {time.time() - start_time:.2f}s "
+                    f"loss: {report['loss']:.4f} acc {report['acc']}  time {time.time() - start_time:.2f}s "
                 )
                 start_time = time.time()
+            iter_end_time = time.time()
 
         # optimizer.zero_grad(set_to_none=True)
         for param in model.parameters():
@@ -1878,7 +3140,8 @@ class Segmenter:
         target_list = None
         batch_data = None
 
-        return avg_loss, avg_acc
+        result = run_metrics.aggregate()
+        return result.get("loss", 0), result.get("acc", 0)
 
     @torch.no_grad()
     def val_epoch(
@@ -1898,17 +3161,21 @@ class Segmenter:
         post_transforms=None,
         channels_last=False,
         calc_val_loss=False,
+        profiler=None,
+        case_metrics=None,
+        report_interval=5.0,
     ):
         model.eval()
         device = torch.device(rank) if use_cuda else torch.device("cpu")
         memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
         distributed = dist.is_initialized()
+        if profiler is None:
+            profiler = StageProfiler(enabled=False)
+        profiler.start_epoch("val")
 
-        run_loss = CumulativeAverage()
-        run_acc = CumulativeAverage()
-        run_loss.append(torch.tensor(0, device=device), count=0)
+        run_metrics = DeviceMetrics(device=device, report_interval=report_interval)
+        run_metrics.append("loss", 0, count=0)
 
-        avg_loss = avg_acc = 0
         start_time = time.time()
 
         # In DDP, each replica has a subset of data, but if total data length is not evenly divisible by num_replicas, then some replicas has 1 extra repeated item.
@@ -1918,26 +3185,33 @@ class Segmenter:
         if dist.is_initialized and isinstance(sampler, DistributedSampler) and not sampler.drop_last:
             nonrepeated_data_length = len(range(sampler.rank, len(sampler.dataset), sampler.num_replicas))
 
+        iter_end_time = time.time()
         for idx, batch_data in enumerate(val_loader):
-            data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device)
+            profiler.add("data_wait", iter_end_time, time.time())
+            with profiler.stage("transfer"):
+                data = batch_data["image"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device)
             filename = batch_data["image"].meta[ImageMetaKey.FILENAME_OR_OBJ]
             batch_size = data.shape[0]
 
-            with autocast(enabled=use_amp):
+            with profiler.stage("forward"), autocast(enabled=use_amp):
                 logits = sliding_inferrer(inputs=data, network=model)
 
             data = None
+            post_start_time = time.time()
 
             if post_transforms:
 
-                try:
-                    pred = self.logits2pred(logits, sigmoid=sigmoid)
-                except RuntimeError as e:
-                    if not logits.is_cuda:
-                        raise e
-                    print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape} {filename}")
-                    logits = logits.cpu()
-                    pred = self.logits2pred(logits, sigmoid=sigmoid)
+                if isinstance(sliding_inferrer, StreamingArgmaxInferer):
+                    pred = logits  # already a label map
+                else:
+                    try:
+                        pred = self.logits2pred(logits, sigmoid=sigmoid)
+                    except RuntimeError as e:
+                        if not logits.is_cuda:
+                            raise e
+                        print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape} {filename}")
+                        logits = logits.cpu()
+                        pred = self.logits2pred(logits, sigmoid=sigmoid)
 
                 if not calc_val_loss:
                     logits = None
@@ -1947,15 +3221,22 @@ class Segmenter:
                 )[0]
                 pred = None
 
-                try:
-                    # inverting on gpu can OOM due inverse resampling or un-cropping
-                    pred = torch.stack([post_transforms(x)["pred"] for x in decollate_batch(batch_data)])
-                except RuntimeError as e:
-                    if not batch_data["pred"].is_cuda:
-                        raise e
-                    print(f"post_transforms failed on GPU pred retrying on CPU {batch_data['pred'].shape}")
+                if isinstance(post_transforms, AsyncPostTransform):
+                    # no metrics to compute, post-process in background (results are not needed here)
                     batch_data["pred"] = batch_data["pred"].cpu()
-                    pred = torch.stack([post_transforms(x)["pred"] for x in decollate_batch(batch_data)])
+                    for x in decollate_batch(batch_data):
+                        post_transforms(x)
+                    logits = None
+                else:
+                    try:
+                        # inverting on gpu can OOM due inverse resampling or un-cropping
+                        pred = torch.stack([post_transforms(x)["pred"] for x in decollate_batch(batch_data)])
+                    except RuntimeError as e:
+                        if not batch_data["pred"].is_cuda:
+                            raise e
+                        print(f"post_transforms failed on GPU pred retrying on CPU {batch_data['pred'].shape}")
+                        batch_data["pred"] = batch_data["pred"].cpu()
+                        pred = torch.stack([post_transforms(x)["pred"] for x in decollate_batch(batch_data)])
 
                 batch_data["pred"] = None
                 if logits is not None and pred.shape != logits.shape:
@@ -1963,14 +3244,21 @@ class Segmenter:
             else:
                 pred = self.logits2pred(logits, sigmoid=sigmoid, skip_softmax=True)
 
+            if profiler.enabled:
+                profiler.synchronize()
+                profiler.add("post", post_start_time, time.time())
+
             if "label" in batch_data and loss_function is not None and acc_function is not None:
+                metric_start_time = time.time()
                 loss = acc = None
                 target = batch_data["label"].as_subclass(torch.Tensor)
 
+                case_loss = torch.zeros(2, dtype=torch.float, device=device)  # loss sum and count of the case
                 if calc_val_loss:
                     if logits is not None:
                         loss = loss_function(logits, target.to(device=logits.device))
-                        run_loss.append(loss.to(device=device), count=batch_size)
+                        run_metrics.append("loss", loss.to(device=device), count=batch_size)
+                        case_loss[0], case_loss[1] = loss.detach().float() * batch_size, batch_size
                         logits = None
 
                 with torch.no_grad():
@@ -1990,33 +3278,37 @@ class Segmenter:
                     acc = acc.detach().clone()
 
                 if idx < nonrepeated_data_length:
-                    run_acc.append(acc.to(device=device), count=batch_size_adjusted)
+                    run_metrics.append("acc", acc.to(device=device), count=batch_size_adjusted)
+                    if case_metrics is not None:
+                        count = torch.as_tensor(batch_size_adjusted, dtype=torch.float, device=device)
+                        count = count * torch.ones_like(acc, dtype=torch.float, device=device)
+                        case_metrics.append(torch.cat([acc.to(device=device) * count, count, case_loss]))
                 else:
-                    run_acc.append(torch.zeros_like(acc, device=device), count=torch.zeros_like(batch_size_adjusted))
+                    run_metrics.append("acc", torch.zeros_like(acc, device=device), count=0)
 
-                avg_loss = loss.cpu() if loss is not None else 0
-                avg_acc = acc.cpu().numpy() if acc is not None else 0
                 pred, target = None, None
+                profiler.add("metric", metric_start_time, time.time())
 
-                if global_rank == 0:
+                report = run_metrics.report() if global_rank == 0 else None
+                if report is not None:
                     print(
-                        f"Val {epoch}/{num_epochs} {idx}/{len(val_loader)}  loss: {avg_loss:.4f} "
-                        f"acc {avg_acc}  time {time.time() - start_time:.2f}s {filename}"
+                        f"Val {epoch}/{num_epochs} {idx}/{len(val_loader)}  loss: {report['loss']:.4f} "
+                        f"acc {report.get('acc')}  time {time.time() - start_time:.2f}s {filename}"
                     )
 
             else:
                 if global_rank == 0:
                     print(f"Val {epoch}/{num_epochs} {idx}/{len(val_loader)} time {time.time() - start_time:.2f}s")
 
-            start_time = time.time()
+            start_time = iter_end_time = time.time()
 
         pred = target = data = batch_data = None
 
         if distributed:
             dist.barrier()
 
-        avg_loss = run_loss.aggregate()
-        avg_acc = run_acc.aggregate()
+        result = run_metrics.aggregate()
+        avg_loss, avg_acc = result.get("loss", 0), result.get("acc", 0)
 
         if np.any(avg_acc < 0):
             dist.barrier()
@@ -2024,6 +3316,147 @@ class Segmenter:
 
         return avg_loss, avg_acc
 
+    def incremental_val_epoch(self, incremental, val_loader, train_time=0, best_metric=-1, epoch=0, **kwargs):
+        """
+        Validation of the oldest cases fitting into the time budget (see IncrementalValidation), and of all
+        the stale cases if the cached metric may become the best. Returns the loss and the metric of all cases
+        (both from the cache) and the number of cases validated.
+        """
+        device = torch.device(self.rank) if self.config["cuda"] else torch.device("cpu")
+        distributed = dist.is_initialized()
+        cases = incremental.select(train_time)
+        num_validated = 0
+
+        while True:
+            if len(cases) == 0:
+                cases = incremental.select(0)  # every rank validates at least one case
+            start_time = time.time()
+            case_metrics = []
+            self.val_epoch(
+                val_loader=incremental.loader(val_loader, cases), epoch=epoch, case_metrics=case_metrics, **kwargs
+            )
+            for case, value in zip(cases, case_metrics):
+                incremental.update(case, value, epoch)
+            incremental.update_time(len(cases), time.time() - start_time)
+            num_validated += len(cases)
+
+            metric = incremental.metric(torch.zeros(0, device=device))
+            num_stale = torch.tensor(float(len(incremental.stale(epoch))), device=device)
+            if distributed:
+                dist.all_reduce(metric, op=dist.ReduceOp.SUM)
+                dist.all_reduce(num_stale, op=dist.ReduceOp.SUM)
+            # per case values: metric sums and counts, then the loss sum and count (see val_epoch)
+            val_loss = float(metric[-2] / metric[-1].clamp(min=1))
+            num_classes = (metric.shape[0] - 2) // 2
+            val_acc = metric[:num_classes] / metric[num_classes:-2].clamp(min=1)
+
+            full_pass = torch.tensor(0.0, device=device)
+            if num_stale > 0 and incremental.may_become_best(float(val_acc.mean()), best_metric):
+                full_pass += 1.0
+            if distributed:
+                dist.broadcast(full_pass, src=0)  # rank 0 holds the best metric
+            if full_pass == 0:
+                break
+            cases = incremental.stale(epoch)
+
+        if distributed:
+            num_validated = torch.tensor(num_validated, device=device)
+            dist.all_reduce(num_validated, op=dist.ReduceOp.SUM)
+            num_validated = int(num_validated)
+
+        return val_loss, val_acc.cpu().numpy(), num_validated
+
+    def get_streaming_inferrer(self):
+        sw = self.sliding_inferrer
+        return StreamingArgmaxInferer(
+            roi_size=getattr(sw, "roi_size", self.config["roi_size"]),
+            sw_batch_size=getattr(sw, "sw_batch_size", 1),
+            overlap=getattr(sw, "overlap", 0.625),
+            mode=getattr(sw, "mode", "gaussian"),
+            sigma_scale=getattr(sw, "sigma_scale", 0.125),
+            cval=getattr(sw, "cval", 0.0),
+            sigmoid=self.config["sigmoid"],
+            label_dtype=torch.uint8 if self.config["output_classes"] < 255 else torch.int16,
+        )
+
+    @torch.no_grad()
+    def batched_infer_epoch(
+        self,
+        model,
+        inf_loader,
+        post_transforms,
+        num_images=4,
+        sw_batch_size=None,
+        rank=0,
+        global_rank=0,
+        sigmoid=False,
+        use_amp=True,
+        use_cuda=True,
+        channels_last=False,
+    ):
+        """
+        Inference of all images in the loader, running the sliding window over num_images images at once
+        (see MultiImageSlidingWindowInferer), while the loader workers prefetch the next images.
+        sw_batch_size defaults to the one of the configured sliding window inferer.
+        """
+        model.eval()
+        device = torch.device(rank) if use_cuda else torch.device("cpu")
+        memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
+
+        sw = self.sliding_inferrer
+        inferrer = MultiImageSlidingWindowInferer(
+            roi_size=getattr(sw, "roi_size", self.config["roi_size"]),
+            sw_batch_size=sw_batch_size if sw_batch_size is not None else getattr(sw, "sw_batch_size", 1),
+            overlap=getattr(sw, "overlap", 0.625),
+            mode=getattr(sw, "mode", "gaussian"),
+            sigma_scale=getattr(sw, "sigma_scale", 0.125),
+            cval=getattr(sw, "cval", 0.0),
+        )
+
+        queue = []
+        start_time = time.time()
+        for idx, batch_data in enumerate(inf_loader):
+            queue.append(batch_data)
+            if len(queue) < num_images and idx < len(inf_loader) - 1:
+                continue
+
+            data = [b["image"].as_subclass(torch.Tensor).to(memory_format=memory_format, device=device) for b in queue]
+            with autocast(enabled=use_amp):
+                logits_list = inferrer(inputs=data, network=model)
+            data = None
+
+            for b, logits in zip(queue, logits_list):
+                try:
+                    pred = self.logits2pred(logits, sigmoid=sigmoid)
+                except RuntimeError as e:
+                    if not logits.is_cuda:
+                        raise e
+                    print(f"logits2pred failed on GPU pred retrying on CPU {logits.shape}")
+                    pred = self.logits2pred(logits.cpu(), sigmoid=sigmoid)
+
+                b["pred"] = convert_to_dst_type(pred, b["image"], dtype=pred.dtype, device=pred.device)[0]
+                pred = None
+                if isinstance(post_transforms, AsyncPostTransform):
+                    b["pred"] = b["pred"].cpu()
+                try:
+                    for x in decollate_batch(b):
+                        post_transforms(x)
+                except RuntimeError as e:
+                    if not b["pred"].is_cuda:
+                        raise e
+                    print(f"post_transforms failed on GPU pred retrying on CPU {b['pred'].shape}")
+                    b["pred"] = b["pred"].cpu()
+                    for x in decollate_batch(b):
+                        post_transforms(x)
+
+            if global_rank == 0:
+                print(
+                    f"Inference {idx + 1}/{len(inf_loader)} batch of {len(queue)} images "
+                    f"time {time.time() - start_time:.2f}s"
+                )
+            queue, logits_list = [], None
+            start_time = time.time()
+
     def logits2pred(self, logits, sigmoid=False, dim=1, skip_softmax=False):
         if isinstance(logits, (list, tuple)):
             logits = logits[0]
@@ -2052,6 +3485,12 @@ class Segmenter:
         cache_rate = config["cache_rate"]
         avail_memory = None
 
+        if config["cache_budget_gb"] is not None:
+            # all cases are cacheable, within the memory budget
+            if self.global_rank == 0:
+                print(f"Using cache_budget_gb={config['cache_budget_gb']} with {config['cache_eviction']} eviction")
+            return 1.0, 1.0
+
         total_cases = train_cases + validation_cases
 
         image_size_mm_90 = config.get("image_size_mm_90", None)
@@ -2119,6 +3558,9 @@ class Segmenter:
                     wrtr = csv.writer(myfile, delimiter="\t")
                     wrtr.writerow(list(kwargs.values()))
 
+    def format_profile(self, profile):
+        return " ".join(f"{k} {v:.2f}{'GB' if k.endswith('_gb') else 's'}" for k, v in profile.items())
+
     def save_progress_yaml(self, progress_path=None, ckpt=None, **report):
         if ckpt is not None:
             report["model"] = ckpt
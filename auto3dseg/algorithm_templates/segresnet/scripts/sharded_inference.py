@@ -0,0 +1,96 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# the same module is in the segresnet, dints and swinunetr templates (each template is copied on its own)
+
+import glob
+import os
+import threading
+from typing import Dict, List, Sequence, Set
+
+import numpy as np
+
+from monai.utils import ensure_tuple, optional_import
+
+nib, has_nib = optional_import("nibabel")
+
+
+def estimate_num_voxels(image_file) -> int:
+    """
+    Estimated number of voxels of an image, from the header of nifti images (otherwise the file size)
+    """
+    image_file = ensure_tuple(image_file)[0]
+    if has_nib:
+        try:
+            return int(np.prod(nib.load(image_file).header.get_data_shape()[:3]))
+        except Exception:
+            pass
+    return os.path.getsize(image_file) if os.path.exists(image_file) else 1
+
+
+def partition_by_voxels(files: Sequence[Dict], num_shards: int) -> List[List[Dict]]:
+    """
+    Partitions the datalist into num_shards with balanced total numbers of voxels (greedy, largest cases first).
+    The partition is deterministic, so every process computes the same shards independently.
+    """
+    num_voxels = [estimate_num_voxels(f["image"]) for f in files]
+    shards, loads = [[] for _ in range(num_shards)], [0] * num_shards
+    for i in sorted(range(len(files)), key=lambda i: (-num_voxels[i], i)):
+        s = int(np.argmin(loads))
+        shards[s].append(i)
+        loads[s] += num_voxels[i]
+    return [[files[i] for i in sorted(shard)] for shard in shards]
+
+
+class CompletedCases:
+    """
+    Manifest of the cases whose prediction is completely saved, to resume an interrupted inference.
+    A case is appended to output_path/completed_cases_<shard_id>.txt (one file per shard, one line per case)
+    only after its post transforms (and SaveImaged) have returned, so a prediction file left incomplete by an
+    interruption is not counted, and its case is inferred again. The manifests of all shards are read, so that
+    a resumed run may use another number of shards.
+    """
+
+    def __init__(self, output_path: str, shard_id: int = 0) -> None:
+        self.output_path = output_path
+        self.manifest = os.path.join(output_path, f"completed_cases_{shard_id}.txt")
+        self.lock = threading.Lock()  # post transforms may run in background threads
+
+    @staticmethod
+    def case_name(image_file) -> str:
+        if isinstance(image_file, dict):
+            image_file = image_file["image"]
+        return os.path.abspath(str(ensure_tuple(image_file)[0]))
+
+    def load(self) -> Set[str]:
+        completed = set()
+        for manifest in glob.glob(os.path.join(self.output_path, "completed_cases_*.txt")):
+            with open(manifest) as f:
+                # an incomplete last line (interrupted while writing) is ignored
+                completed.update(line[:-1] for line in f if line.endswith("\n"))
+        return completed
+
+    def pending(self, files: Sequence[Dict]) -> List[Dict]:
+        """The cases of files without a completely saved prediction"""
+        completed = self.load()
+        return [f for f in files if self.case_name(f) not in completed]
+
+    def add(self, image_file) -> None:
+        with self.lock:
+            os.makedirs(self.output_path, exist_ok=True)
+            with open(self.manifest, "a+") as f:
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != "\n":
+                        f.write("\n")  # terminates the incomplete line of an interrupted run
+                f.write(self.case_name(image_file) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
@@ -64,6 +64,305 @@ def get_gpu_mem_size():
     return gpu_mem
 
 
+# memory model of SegResNetDS training (bytes), see estimate_segresnetds_memory
+mem_saved_per_block = 4  # tensors saved for backward by each SegResBlock (norm1 input, act1/conv1 output, act2 output)
+mem_loss_per_class = 6  # float32 tensors per output class of DiceCELoss (float logits, softmax, log_softmax, one-hot..)
+mem_param_bytes = 16  # float32 weights, gradients and 2 AdamW states per parameter
+mem_overhead_gb = 1.0  # cuda context and library handles (outside the caching allocator)
+mem_fragmentation = 1.1
+
+
+def segresnetds_scales(spacing=None, levels=5, anisotropic_scales=False):
+    """
+    Downsampling factors of each encoder level of SegResNetDS (the same as its resolution based scales)
+    """
+    if not anisotropic_scales or spacing is None:
+        return [(1, 1, 1)] + [(2, 2, 2)] * (levels - 1)
+    res = np.array(spacing, dtype=float)
+    nl = np.floor(np.log2(np.max(res) / res)).astype(np.int32)
+    scales = [tuple(np.where(2**i >= 2**nl, 1, 2)) for i in range(max(nl))]
+    scales = (scales + [(2, 2, 2)] * (levels - 1))[: levels - 1]
+    return [(1, 1, 1)] + [tuple(int(x) for x in sc) for sc in scales]
+
+
+def estimate_segresnetds_memory(
+    roi_size,
+    init_filters=32,
+    levels=5,
+    blocks_down=None,
+    batch_size=1,
+    input_channels=1,
+    output_classes=2,
+    dsdepth=4,
+    amp=True,
+    channels_last=True,
+    spacing=None,
+    anisotropic_scales=False,
+):
+    """
+    Estimates the peak GPU memory (in Gb) of a SegResNetDS training step (forward, DiceCE deep supervision loss,
+    backward and AdamW step) for a given crop, from the tensors which each layer keeps for the backward pass.
+    It only uses the network configuration (no GPU or network instantiation required),
+    and should be validated against measure_segresnetds_memory on the target GPU.
+
+    Returns a dict with the parameters, activations, loss, transient and total memory in Gb, and the allocator
+    memory (total without mem_overhead_gb, comparable to the memory reserved by the caching allocator).
+    """
+    if blocks_down is None:
+        blocks_down = blocks_down_for_levels(levels)
+    levels = len(blocks_down)
+    act_bytes = 2 if amp else 4
+
+    numel = float(np.prod(roi_size))
+    channels, sizes, params = [], [], 0.0
+    for i, sc in enumerate(segresnetds_scales(spacing=spacing, levels=levels, anisotropic_scales=anisotropic_scales)):
+        numel /= float(np.prod(sc))
+        c = init_filters * 2**i
+        channels.append(c)
+        sizes.append(c * numel)
+        params += blocks_down[i] * 2 * 27 * c * c  # two 3x3x3 convs per block
+        params += 27 * (input_channels if i == 0 else channels[i - 1]) * c  # conv_init or downsample conv
+    for i in range(levels - 1):
+        params += 8 * channels[i + 1] * channels[i] + 2 * 27 * channels[i] ** 2  # upsample and one block per level
+
+    # encoder: blocks and the level output (skip connection and input of the next level)
+    activations = sum(size * (mem_saved_per_block * b + 1) for size, b in zip(sizes, blocks_down))
+    # decoder: upsampled level (one block) and its output (input of the head and of the next upsample)
+    activations += sum(size * (mem_saved_per_block + 1) for size in sizes[:-1])
+    activations += input_channels * float(np.prod(roi_size))  # input crop
+    activations *= act_bytes * batch_size
+
+    # deep supervision heads, and the float32 loss tensors of each output resolution
+    loss = sum(sizes[i] / channels[i] for i in range(min(dsdepth, levels)))
+    loss *= output_classes * mem_loss_per_class * 4 * batch_size
+
+    # the backward pass of the largest layer, plus the layout copies of cudnn for non channels-last tensors
+    transient = 3 * sizes[0] * act_bytes * batch_size
+    if not channels_last:
+        transient += 2 * sizes[0] * act_bytes * batch_size
+
+    gb = 1024**3
+    allocator = (params * mem_param_bytes + activations + loss + transient) * mem_fragmentation / gb
+    return {
+        "params": params * mem_param_bytes / gb,
+        "activations": activations / gb,
+        "loss": loss / gb,
+        "transient": transient / gb,
+        "allocator": allocator,
+        "total": allocator + mem_overhead_gb,
+    }
+
+
+def measure_segresnetds_memory(
+    roi_size,
+    init_filters=32,
+    levels=5,
+    blocks_down=None,
+    batch_size=1,
+    input_channels=1,
+    output_classes=2,
+    dsdepth=4,
+    amp=True,
+    channels_last=True,
+    spacing=None,
+    anisotropic_scales=False,
+    norm="INSTANCE",
+    num_steps=2,
+):
+    """
+    Measures the peak GPU memory of SegResNetDS training steps (in Gb), to validate estimate_segresnetds_memory.
+    Returns None if CUDA is not available, otherwise a dict of
+        reserved: the raw peak memory reserved by the caching allocator (including the allocator fragmentation),
+            to compare with the "allocator" estimate
+        context: the device memory used outside of the caching allocator (CUDA context and libraries), from
+            torch.cuda.mem_get_info, which also counts the other processes on the device (use an idle GPU)
+        total: reserved + context, to compare with the "total" estimate (which includes mem_overhead_gb)
+    """
+    if not torch.cuda.is_available():
+        return None
+
+    from monai.losses import DeepSupervisionLoss, DiceCELoss
+    from monai.networks.nets import SegResNetDS
+
+    if blocks_down is None:
+        blocks_down = blocks_down_for_levels(levels)
+    device = torch.device("cuda")
+    memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
+    model = SegResNetDS(
+        init_filters=init_filters,
+        blocks_down=blocks_down,
+        norm=norm,
+        in_channels=input_channels,
+        out_channels=output_classes,
+        dsdepth=dsdepth,
+        resolution=spacing if anisotropic_scales else None,
+    ).to(device=device, memory_format=memory_format)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    loss_function = DeepSupervisionLoss(DiceCELoss(softmax=True, to_onehot_y=True, batch=True))
+    scaler = torch.cuda.amp.GradScaler(enabled=amp)
+
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    data = torch.randn((batch_size, input_channels, *roi_size), device=device).to(memory_format=memory_format)
+    target = torch.randint(0, output_classes, (batch_size, 1, *roi_size), device=device)
+    for _ in range(num_steps):
+        optimizer.zero_grad(set_to_none=True)
+        with torch.autocast(device_type="cuda", enabled=amp):
+            loss = loss_function(model(data), target)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    peak = torch.cuda.max_memory_reserved(device) / 1024**3
+    # after the steps, the cuDNN and cuBLAS handles and workspaces outside the allocator are created
+    free, total = torch.cuda.mem_get_info(device)
+    context = (total - free - torch.cuda.memory_reserved(device)) / 1024**3
+
+    model = optimizer = data = target = loss = None
+    torch.cuda.empty_cache()
+    return {"reserved": peak, "context": context, "total": peak + context}
+
+
+def factor_roi_size(roi_size, levels=None, spacing=None, anisotropic_scales=False, levels_limit=5, verbose=True):
+    """
+    Number of network levels for the roi_size (if not provided), and the roi_size made divisible by the levels
+    """
+    if not anisotropic_scales:
+        if levels is None:
+            levels = np.floor(np.log2(roi_size))
+            if verbose:
+                print(f"levels 1 {levels}")
+            levels = min(min(levels), levels_limit)  # limit to 5
+            if verbose:
+                print(f"levels 2' {levels}")
+
+        factor = 2 ** (levels - 1)
+        roi_size = factor * np.maximum(2, np.floor(roi_size / factor))
+        if verbose:
+            print(f"roi_size factored {roi_size}")
+
+    else:
+        extra_levels = np.floor(np.log2(np.max(spacing) / spacing))
+        extra_levels = max(extra_levels) - extra_levels
+
+        if levels is None:
+            # calc levels
+            levels = np.floor(np.log2(roi_size))
+            if verbose:
+                print(f"levels 1 aniso {levels} extra_levels {extra_levels}")
+            levels = min(min(levels + extra_levels), levels_limit)  # limit to 5
+            if verbose:
+                print(f"levels 2 {levels}")
+
+        factor = 2 ** (np.maximum(1, levels - extra_levels) - 1)
+        roi_size = factor * np.maximum(2, np.floor(roi_size / factor))
+        if verbose:
+            print(f"roi_size factored {roi_size} factor {factor} extra_levels {extra_levels}")
+
+    return roi_size, levels
+
+
+def blocks_down_for_levels(levels):
+    """
+    SegResNetDS encoder blocks for the number of levels
+    """
+    return {1: [2], 2: [1, 3], 3: [1, 2, 4], 4: [1, 2, 2, 4]}.get(int(levels), [1, 2, 2, 4, 4])
+
+
+def plan_network_settings(
+    image_size,
+    gpu_mem=16,
+    auto_scale_roi=False,
+    auto_scale_batch=False,
+    auto_scale_filters=False,
+    spacing=None,
+    output_classes=2,
+    levels=None,
+    anisotropic_scales=False,
+    levels_limit=5,
+    input_channels=1,
+    dsdepth=4,
+    amp=True,
+    channels_last=True,
+    memory_fraction=0.9,
+    max_init_filters=64,
+    max_batch_size=32,
+    verbose=True,
+):
+    """
+    Picks the largest roi_size, then init_filters, then batch_size (of those allowed to scale),
+    whose estimate_segresnetds_memory fits into memory_fraction of gpu_mem (Gb). The default roi_size is
+    reduced if it does not fit (e.g. for many output classes).
+    """
+    init_filters_default, batch_size_default, init_filters, batch_size = 32, 1, 32, 1
+    budget = gpu_mem * memory_fraction
+
+    def fit(roi, filters=32, batch=1):
+        roi, lv = factor_roi_size(
+            np.array(roi, dtype=float),
+            levels,
+            spacing=spacing,
+            anisotropic_scales=anisotropic_scales,
+            levels_limit=levels_limit,
+            verbose=False,
+        )
+        mem = estimate_segresnetds_memory(
+            roi,
+            init_filters=filters,
+            blocks_down=blocks_down_for_levels(lv),
+            batch_size=batch,
+            input_channels=input_channels,
+            output_classes=output_classes,
+            dsdepth=dsdepth,
+            amp=amp,
+            channels_last=channels_last,
+            spacing=spacing,
+            anisotropic_scales=anisotropic_scales,
+        )["total"]
+        return roi, lv, mem
+
+    roi_size = np.minimum(np.array(roi_size_default, dtype=float), image_size)
+    roi_fit, levels_fit, mem = fit(roi_size)
+    while mem > budget and np.any(roi_size > 16):  # reduce roi
+        roi_size = np.minimum(np.maximum(roi_size / 1.15, 16), image_size)
+        roi_fit, levels_fit, mem = fit(roi_size)
+    if mem > budget and verbose:
+        print(f"Warning: given output_classes {output_classes}, unable to fit any ROI on the gpu {gpu_mem} Gb!")
+
+    if auto_scale_roi:
+        while True:
+            roi_next = np.minimum(roi_size * 1.15, image_size)
+            if roi_next.prod() == roi_size.prod():
+                break
+            roi_next_fit, levels_next, mem_next = fit(roi_next)
+            if mem_next > budget:
+                break
+            roi_size, roi_fit, levels_fit, mem = roi_next, roi_next_fit, levels_next, mem_next
+
+    if auto_scale_filters:
+        while init_filters + 8 <= max_init_filters and fit(roi_size, init_filters + 8)[2] <= budget:
+            init_filters += 8
+
+    if auto_scale_batch:
+        while batch_size < max_batch_size and fit(roi_size, init_filters, batch_size + 1)[2] <= budget:
+            batch_size += 1
+
+    levels = int(levels_fit)
+    roi_size = roi_fit.astype(int).tolist()
+    mem = fit(roi_size, init_filters, batch_size)[2]
+
+    if verbose:
+        print(
+            f"Suggested network parameters (memory model, estimated {mem:.2f} of {gpu_mem:.2f} Gb): \n"
+            f"Batch size {batch_size_default} => {batch_size} \n"
+            f"ROI size {roi_size_default} => {roi_size} \n"
+            f"init_filters {init_filters_default} => {init_filters} \n"
+            f"aniso: {anisotropic_scales} image_size: {image_size} spacing: {spacing} levels: {levels} \n"
+            f"amp: {amp} channels_last: {channels_last} output_classes: {output_classes} \n"
+        )
+
+    return roi_size, levels, init_filters, batch_size
+
+
 def auto_adjust_network_settings(
     auto_scale_roi=False,
     auto_scale_batch=False,
@@ -75,6 +374,11 @@ def auto_adjust_network_settings(
     anisotropic_scales=False,
     levels_limit=5,
     gpu_mem=None,
+    memory_model=False,
+    input_channels=1,
+    dsdepth=4,
+    amp=True,
+    channels_last=True,
 ):
     global_rank = 0
     if dist.is_available() and dist.is_initialized():
@@ -83,6 +387,31 @@ def auto_adjust_network_settings(
     else:
         print(f"auto_adjust_network_settings no distributed global_rank {global_rank}")
 
+    if memory_model:
+        if image_size_mm is None or spacing is None:
+            raise ValueError("image_size_mm or spacing is not provided, network params may be inaccuracy")
+        if gpu_mem is None:
+            gpu_mem = get_gpu_mem_size()
+        if not (auto_scale_batch or auto_scale_roi or auto_scale_filters):
+            gpu_mem = 16
+        return plan_network_settings(
+            image_size=np.floor(np.array(image_size_mm) / np.array(spacing)),
+            gpu_mem=gpu_mem,
+            auto_scale_roi=auto_scale_roi,
+            auto_scale_batch=auto_scale_batch,
+            auto_scale_filters=auto_scale_filters,
+            spacing=spacing,
+            output_classes=output_classes or 2,
+            levels=levels,
+            anisotropic_scales=anisotropic_scales,
+            levels_limit=levels_limit,
+            input_channels=input_channels,
+            dsdepth=dsdepth,
+            amp=amp,
+            channels_last=channels_last,
+            verbose=global_rank == 0,
+        )
+
     batch_size_default = 1
     init_filters_default = 32
 
@@ -150,37 +479,14 @@ def auto_adjust_network_settings(
             print(f"increasing roi result 1 {roi_size}")
 
     # adjust number of network downsize levels
-    if not anisotropic_scales:
-        if levels is None:
-            levels = np.floor(np.log2(roi_size))
-            if global_rank == 0:
-                print(f"levels 1 {levels}")
-            levels = min(min(levels), levels_limit)  # limit to 5
-            if global_rank == 0:
-                print(f"levels 2' {levels}")
-
-        factor = 2 ** (levels - 1)
-        roi_size = factor * np.maximum(2, np.floor(roi_size / factor))
-        if global_rank == 0:
-            print(f"roi_size factored {roi_size}")
-
-    else:
-        extra_levels = np.floor(np.log2(np.max(spacing) / spacing))
-        extra_levels = max(extra_levels) - extra_levels
-
-        if levels is None:
-            # calc levels
-            levels = np.floor(np.log2(roi_size))
-            if global_rank == 0:
-                print(f"levels 1 aniso {levels} extra_levels {extra_levels}")
-            levels = min(min(levels + extra_levels), levels_limit)  # limit to 5
-            if global_rank == 0:
-                print(f"levels 2 {levels}")
-
-        factor = 2 ** (np.maximum(1, levels - extra_levels) - 1)
-        roi_size = factor * np.maximum(2, np.floor(roi_size / factor))
-        if global_rank == 0:
-            print(f"roi_size factored {roi_size} factor {factor} extra_levels {extra_levels}")
+    roi_size, levels = factor_roi_size(
+        roi_size,
+        levels=levels,
+        spacing=spacing,
+        anisotropic_scales=anisotropic_scales,
+        levels_limit=levels_limit,
+        verbose=global_rank == 0,
+    )
 
     # optionally adjust initial filters (above 32)
     if auto_scale_filters and roi_size.prod() < base_numel * gpu_factor:
@@ -14,6 +14,9 @@ from __future__ import annotations
 import copy
 import csv
 import gc
+import hashlib
+import inspect
+import json
 import logging
 import multiprocessing as mp
 import os
@@ -41,7 +44,15 @@ from monai.apps.auto3dseg.transforms import EnsureSameShaped
 from monai.auto3dseg.utils import datafold_read
 from monai.bundle.config_parser import ConfigParser
 from monai.config import KeysCollection
-from monai.data import CacheDataset, DataLoader, Dataset, DistributedSampler, decollate_batch, list_data_collate
+from monai.data import (
+    CacheDataset,
+    DataLoader,
+    Dataset,
+    DistributedSampler,
+    PersistentDataset,
+    decollate_batch,
+    list_data_collate,
+)
 from monai.inferers import SlidingWindowInfererAdapt
 from monai.losses import DeepSupervisionLoss
 from monai.metrics import CumulativeAverage, DiceHelper
@@ -123,6 +134,79 @@ class LabelEmbedClassIndex(MapTransform):
         return d
 
 
+_file_hash_memo: Dict[Tuple, str] = {}
+
+
+def file_content_hashing(item, chunk_size: int = 1 << 24) -> bytes:
+    """
+    Hash a datalist item by the content of the files it references (rather than by file names only),
+    so that a cache entry is invalidated whenever a source image changes on disk.
+    The per-file digests are memoized by (path, size, mtime) to read each file at most once per process.
+    """
+
+    def _hash_value(v):
+        if isinstance(v, (list, tuple)):
+            return [_hash_value(x) for x in v]
+        if isinstance(v, dict):
+            return {k: _hash_value(x) for k, x in sorted(v.items())}
+        if isinstance(v, str) and os.path.isfile(v):
+            st = os.stat(v)
+            memo_key = (os.path.abspath(v), st.st_size, st.st_mtime_ns)
+            if memo_key not in _file_hash_memo:
+                h = hashlib.sha256()
+                with open(v, "rb") as f:
+                    for chunk in iter(lambda: f.read(chunk_size), b""):
+                        h.update(chunk)
+                _file_hash_memo[memo_key] = h.hexdigest()
+            return _file_hash_memo[memo_key]
+        return v
+
+    item = {k: v for k, v in item.items() if k != "fold"} if isinstance(item, dict) else item
+    content = json.dumps(_hash_value(item), sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest().encode("utf-8")
+
+
+def transform_cache_key(x) -> Dict:
+    """
+    JSON serializable description of a transform object for the cache keys: its class name and public attributes
+    (e.g. the constructor arguments), the nested objects are described by their class name only
+    """
+    attrs = {k: v for k, v in getattr(x, "__dict__", {}).items() if not k.startswith("_")}
+    attrs = json.loads(json.dumps(attrs, sort_keys=True, skipkeys=True, default=lambda y: y.__class__.__name__))
+    return {"class": x.__class__.__name__, "attrs": attrs}
+
+
+class DiskCacheDataset(PersistentDataset):
+    """
+    PersistentDataset variant used as a content-addressed disk cache of the deterministic part of the
+    transform pipeline (everything before the first random transform).
+    The cache key is the hash of the source files content plus the provided transform_key (e.g. from
+    DataTransformBuilder.get_cache_key), hence the same cache_dir can be shared across folds, validation
+    and inference runs and restarts. The entries are not shared with the other templates (segresnet, and the
+    shared_cache_dir of dints and swinunetr), which resample and normalize differently.
+    Cached items are stored as uncompressed torch files, and loaded memory-mapped (if supported by the torch version)
+    to avoid copying whole volumes on read.
+    """
+
+    def __init__(self, data: Sequence, transform: Callable, cache_dir: str, transform_key: str = "", **kwargs):
+        kwargs.setdefault("hash_func", file_content_hashing)
+        if "track_meta" in inspect.signature(PersistentDataset.__init__).parameters:
+            # keep MetaTensors with the applied operations, required to invert predictions
+            kwargs.setdefault("track_meta", True)
+            kwargs.setdefault("weights_only", False)
+        super().__init__(data=data, transform=transform, cache_dir=cache_dir, **kwargs)
+        self.transform_hash = transform_key
+
+    def _cachecheck(self, item_transformed):
+        hashfile = Path(self.cache_dir) / f"{self.hash_func(item_transformed).decode('utf-8')}{self.transform_hash}.pt"
+        if hashfile.is_file():
+            try:
+                return torch.load(hashfile, mmap=True, weights_only=False)
+            except (TypeError, RuntimeError):
+                pass  # mmap is not supported by the torch version or by the file, use the default loading
+        return super()._cachecheck(item_transformed)
+
+
 def schedule_validation_epochs(num_epochs, num_epochs_per_validation=None, fraction=0.16) -> list:
     """
     Schedule of epochs to validate (progressively more frequently)
@@ -162,11 +246,13 @@ class DataTransformBuilder:
         crop_params: Optional[dict] = None,
         extra_modalities: Optional[dict] = None,
         custom_transforms=None,
+        class_index=None,
         debug: bool = False,
         rank: int = 0,
         **kwargs,
     ) -> None:
         self.roi_size, self.image_key, self.label_key = roi_size, image_key, label_key
+        self.class_index = class_index
 
         self.resample, self.resample_resolution = resample, resample_resolution
         self.normalize_mode = normalize_mode
@@ -450,6 +536,31 @@ class DataTransformBuilder:
 
         return compose_ts
 
+    def get_cache_key(self, augment=False, resample_label=False) -> str:
+        """
+        Returns a hash of the settings that define the deterministic (cacheable) part of the pipeline
+        """
+        settings = {
+            "builder": "segresnet2d",  # the 2D pipeline differs from segresnet for the same settings
+            "augment": augment,
+            "resample_label": resample_label,
+            "image_key": self.image_key,
+            "label_key": self.label_key,
+            "resample": self.resample,
+            "resample_resolution": self.resample_resolution,
+            "normalize_mode": self.normalize_mode,
+            "normalize_params": self.normalize_params,
+            "extra_modalities": self.extra_modalities,
+            "custom_transforms": self.custom_transforms,
+            "class_index": self.class_index,
+            "extra_options": self.extra_options,
+        }
+        if augment:
+            settings.update({"roi_size": self.roi_size, "crop_mode": self.crop_mode, "crop_params": self.crop_params})
+
+        content = json.dumps(settings, sort_keys=True, default=transform_cache_key)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()[:16]
+
     def __repr__(self) -> str:
         out: str = f"DataTransformBuilder: with image_key: {self.image_key}, label_key: {self.label_key} \n"
         out += f"roi_size {self.roi_size} resample {self.resample} resample_resolution {self.resample_resolution} \n"
@@ -609,6 +720,7 @@ class Segmenter:
                 },
                 extra_modalities=config["extra_modalities"],
                 custom_transforms=custom_transforms,
+                class_index=config["class_index"],
                 crop_foreground=config.get("crop_foreground", True),
                 debug=config["debug"],
             )
@@ -723,6 +835,7 @@ class Segmenter:
         config.setdefault("quick", False)
         config.setdefault("sigmoid", False)
         config.setdefault("cache_rate", None)
+        config.setdefault("disk_cache_dir", None)
         config.setdefault("cache_class_indices", None)
 
         config.setdefault("channels_last", True)
@@ -942,6 +1055,13 @@ class Segmenter:
                 cache_rate=cache_rate,
                 runtime_cache=runtime_cache,
             )
+        elif self.config["disk_cache_dir"] is not None:
+            train_ds = DiskCacheDataset(
+                data=data,
+                transform=train_transform,
+                cache_dir=self.config["disk_cache_dir"],
+                transform_key=self.get_data_transform_builder().get_cache_key(augment=True, resample_label=True),
+            )
         else:
             train_ds = Dataset(data=data, transform=train_transform)
 
@@ -969,6 +1089,13 @@ class Segmenter:
             val_ds = CacheDataset(
                 data=data, transform=val_transform, copy_cache=False, cache_rate=cache_rate, runtime_cache=runtime_cache
             )
+        elif self.config["disk_cache_dir"] is not None:
+            val_ds = DiskCacheDataset(
+                data=data,
+                transform=val_transform,
+                cache_dir=self.config["disk_cache_dir"],
+                transform_key=self.get_data_transform_builder().get_cache_key(resample_label=resample_label),
+            )
         else:
             val_ds = Dataset(data=data, transform=val_transform)
 
@@ -31,7 +31,7 @@ from torch.nn.parallel import DistributedDataParallel
 from monai.apps.auto3dseg.transforms import EnsureSameShaped
 from monai.bundle.config_parser import ConfigParser
 from monai.config import KeysCollection
-from monai.inferers import SlidingWindowInfererAdapt
+from monai.inferers import SlidingWindowInferer, SlidingWindowInfererAdapt
 
 # from monai.optimizers.lr_scheduler import WarmupCosineSchedule
 from monai.transforms import (
@@ -110,6 +110,89 @@ class WrappedModel2D(torch.nn.Module):
         return x
 
 
+class SliceInferer2D:
+    """
+    Native 2D inference of 3D volumes (B, C, H, W, D). The volume is streamed through the 2D network in slabs of
+    slice_batch_size axial slices, each slice is processed exactly once along the depth, (with the in-plane sliding
+    window of roi_size[:2]) and the slab results are written directly into the output volume.
+    Unlike the 3D sliding window of WrappedModel2D, there are no overlapping or padded windows along the depth,
+    and no permuted copies of the full windows. The (slice, window) pairs of a slab are batched slice_batch_size
+    at a time through the network.
+    On out of memory errors, as SlidingWindowInfererAdapt, the slab is retried with the network batch halved
+    (down to 1), then with the slab output on the CPU, and the reduced settings are kept for the next slabs.
+    """
+
+    def __init__(
+        self,
+        roi_size: Sequence[int],
+        slice_batch_size: int = 16,
+        overlap: float = 0.625,
+        mode: str = "gaussian",
+    ) -> None:
+        self.slice_batch_size = max(1, int(slice_batch_size))
+        self.inferer = SlidingWindowInferer(
+            roi_size=list(roi_size)[:2],
+            sw_batch_size=self.slice_batch_size,
+            overlap=overlap,
+            mode=mode,
+            cache_roi_weight_map=True,
+            progress=False,
+        )
+
+    @staticmethod
+    def get_net2d(network):
+        # the 2D network of the (possibly DDP wrapped) WrappedModel2D, it is called directly without DDP in eval mode
+        if isinstance(network, DistributedDataParallel):
+            network = network.module
+        if isinstance(network, WrappedModel2D):
+            return network.net, network.memory_format
+        return network, torch.preserve_format
+
+    def __call__(self, inputs: torch.Tensor, network: Callable) -> torch.Tensor:
+        net, memory_format = self.get_net2d(network)
+
+        def net2d(x):
+            x = net(x.to(memory_format=memory_format))
+            return x[0] if isinstance(x, (list, tuple)) else x  # only the full resolution output
+
+        output = None
+        depth = inputs.shape[-1]
+        for b in range(inputs.shape[0]):
+            for start in range(0, depth, self.slice_batch_size):
+                end = min(start + self.slice_batch_size, depth)
+                slab = inputs[b, ..., start:end].permute(3, 0, 1, 2)  # (slices, C, H, W)
+                logits = self.infer_slab(slab, net2d)
+                if output is None:
+                    shape = (inputs.shape[0], logits.shape[1], *inputs.shape[2:])
+                    try:
+                        output = torch.empty(shape, dtype=logits.dtype, device=logits.device)
+                    except RuntimeError:  # not enough GPU memory for the output volume, use CPU
+                        output = torch.empty(shape, dtype=logits.dtype, device="cpu")
+                output[b, ..., start:end] = logits.permute(1, 2, 3, 0)
+                slab = logits = None
+
+        return output
+
+    def infer_slab(self, slab: torch.Tensor, net2d: Callable) -> torch.Tensor:
+        while True:
+            try:
+                return self.inferer(inputs=slab, network=net2d, sw_device=slab.device)
+            except RuntimeError as e:
+                if "OutOfMemoryError" not in str(type(e).__name__):
+                    raise e
+                if self.inferer.sw_batch_size > 1:
+                    self.inferer.sw_batch_size = max(1, self.inferer.sw_batch_size // 2)
+                elif slab.is_cuda and self.inferer.device != torch.device("cpu"):
+                    self.inferer.device = torch.device("cpu")
+                else:
+                    raise e
+                print(
+                    f"SliceInferer2D out of memory, retrying with sw_batch_size {self.inferer.sw_batch_size} "
+                    f"and output on {self.inferer.device or slab.device}"
+                )
+            torch.cuda.empty_cache()  # after the except block, which keeps the failed buffers referenced
+
+
 class DataTransformBuilder2D(DataTransformBuilder):
     def get_resample_transforms(self, resample_label=True):
         ts = self.get_custom("resample_transforms")
@@ -207,6 +290,13 @@ class Segmenter2D(Segmenter):
 
         if config.get("sliding_inferrer") is not None:
             self.sliding_inferrer = ConfigParser(config["sliding_inferrer"]).get_parsed_content()
+        elif config.setdefault("slice_batch_size", 16) > 0:
+            self.sliding_inferrer = SliceInferer2D(
+                roi_size=config["roi_size"],
+                slice_batch_size=config["slice_batch_size"],
+                overlap=0.625,
+                mode="gaussian",
+            )
         else:
             self.sliding_inferrer = SlidingWindowInfererAdapt(
                 roi_size=config["roi_size"],
@@ -0,0 +1,140 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import uuid
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from monai import transforms
+from monai.bundle import ConfigParser
+
+# the leading deterministic stages stored on disk, shared by the templates with the same
+# (orientation, spacing, intensity normalization) settings, the template specific transforms (padding, random crops
+# and augmentations) are applied on top
+CANONICAL_STAGES = (
+    "loadimage",
+    "ensurechannelfirst",
+    "scaleintensityrange",
+    "normalizeintensity",
+    "cropforeground",
+    "orientation",
+    "spacing",
+    "casttotype",
+)
+# options which do not change the stored images
+IGNORED_OPTIONS = ("allow_missing_keys", "image_only", "dtype", "reader", "ensure_channel_first")
+
+_file_hash_memo: Dict[Tuple, str] = {}
+
+
+def file_digest(filename: str, chunk_size: int = 1 << 24) -> str:
+    """
+    Digest of the content of a file, memoized by (path, size, mtime) to read each file at most once per process
+    """
+    st = os.stat(filename)
+    memo_key = (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        h = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        _file_hash_memo[memo_key] = h.hexdigest()
+    return _file_hash_memo[memo_key]
+
+
+def describe_stages(parser: ConfigParser, id: str) -> Optional[List]:
+    """
+    Describes the transform config id as a list of (stage, options), or None if it is not a canonical stage
+    """
+    config = parser[id]
+    if not isinstance(config, dict) or not isinstance(config.get("_target_"), str):
+        return None
+    name = config["_target_"].split(".")[-1].lower()
+    if name == "compose":
+        stages = [describe_stages(parser, f"{id}#transforms#{i}") for i in range(len(config["transforms"]))]
+        return None if any(s is None for s in stages) else sum(stages, [])
+    name = name[:-1] if name.endswith("d") else name
+    if name not in CANONICAL_STAGES:
+        return None
+    if name in ("loadimage", "ensurechannelfirst"):
+        return [[name]]  # the source files are part of the item key
+    options = {k: parser.get_parsed_content(f"{id}#{k}") for k in config if not k.startswith("_")}
+    if name != "casttotype":
+        options = {k: v for k, v in options.items() if k not in IGNORED_OPTIONS}
+    return [[name, options]]
+
+
+class DecodedStore(transforms.Transform):
+    """
+    Applies the canonical stages to a datalist item, or loads their output from cache_dir. The stored files are
+    named by the digests of the source files and by the description of the stages (stages_key), hence shared
+    across folds, training and validation, restarts and the algorithm templates using the same stages
+    (e.g. dints and swinunetr). Only the keys are stored, the other items of the datalist are kept as they are.
+    """
+
+    def __init__(self, transform, cache_dir: str, stages_key: str, keys: Sequence[str] = ("image", "label")) -> None:
+        self.transform = transform
+        self.cache_dir = cache_dir
+        self.stages_key = stages_key
+        self.keys = tuple(keys)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def filename(self, data) -> str:
+        digests = {k: file_digest(data[k]) for k in self.keys if isinstance(data.get(k), str)}
+        item_key = hashlib.sha256(json.dumps(digests, sort_keys=True).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{item_key}_{self.stages_key}.pt")
+
+    def __call__(self, data):
+        filename = self.filename(data)
+        stored = None
+        if os.path.isfile(filename):
+            try:
+                stored = torch.load(filename, weights_only=False)
+            except Exception:
+                stored = None  # incomplete or corrupted, stored again
+        if stored is None:
+            output = self.transform(dict(data))
+            stored = {k: output[k] for k in self.keys if k in output}
+            temp_filename = f"{filename}.{uuid.uuid4().hex}.temp"
+            torch.save(stored, temp_filename)
+            os.replace(temp_filename, filename)  # atomic, concurrent writers store the same content
+        return {**data, **stored}
+
+
+def shared_decoded_transform(parser: ConfigParser, id: str, transform, cache_dir: Optional[str], keys=None):
+    """
+    Replaces the leading canonical stages of the instantiated Compose transform (of the config id) by a DecodedStore
+    in cache_dir. Returns the transform unchanged if cache_dir is None or if there are no canonical stages.
+    """
+    if not cache_dir:
+        return transform
+
+    stages, num_stages = [], 0
+    for i in range(len(parser[id]["transforms"])):
+        stage = describe_stages(parser, f"{id}#transforms#{i}")
+        if stage is None:
+            break
+        stages += stage
+        num_stages = i + 1
+    if num_stages == 0:
+        return transform
+
+    keys = keys or [parser.get_parsed_content("image_key"), parser.get_parsed_content("label_key")]
+    stages_key = json.dumps(stages, sort_keys=True, default=str)
+    stages_key = hashlib.sha256(stages_key.encode("utf-8")).hexdigest()[:16]
+    store = DecodedStore(
+        transforms.Compose(transform.transforms[:num_stages]), cache_dir=cache_dir, stages_key=stages_key, keys=keys
+    )
+    return transforms.Compose([store, *transform.transforms[num_stages:]])
@@ -9,6 +9,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
 import os
 
 import fire
@@ -21,8 +23,17 @@ from monai.bundle import ConfigParser
 from monai.inferers import sliding_window_inference
 
 
+def is_oom_error(e):
+    return isinstance(e, RuntimeError) and any(x in str(e).lower() for x in ("out of memory", "cudnn", "cublas"))
+
+
 class DummyRunnerSwinUNETR(object):
-    def __init__(self, output_path, data_stats_file, device_id: int = 0):
+    def __init__(self, output_path, data_stats_file, device_id: int = 0, dry_run: bool = False):
+        """
+        Args:
+            dry_run: estimate the memory usage by tracing the network on the meta device (without GPU),
+                instead of running training/validation iterations.
+        """
         config_file = []
         config_file.append(os.path.join(output_path, "configs", "hyper_parameters.yaml"))
         config_file.append(os.path.join(output_path, "configs", "network.yaml"))
@@ -32,7 +43,11 @@ class DummyRunnerSwinUNETR(object):
         parser = ConfigParser()
         parser.read_config(config_file)
 
-        self.device = torch.device("cuda:{0:d}".format(device_id))
+        self.dry_run = dry_run or not torch.cuda.is_available()
+        if self.dry_run:
+            self.device = torch.device("meta")
+        else:
+            self.device = torch.device("cuda:{0:d}".format(device_id))
 
         self.input_channels = parser.get_parsed_content("input_channels")
         self.roi_size = parser.get_parsed_content("roi_size")
@@ -55,8 +70,6 @@ class DummyRunnerSwinUNETR(object):
         optimizer_part = parser.get_parsed_content("optimizer", instantiate=False)
         self.optimizer = optimizer_part.instantiate(params=self.model.parameters())
 
-        train_transforms = parser.get_parsed_content("transforms_train")
-
         with open(data_stats_file) as f_data_stat:
             data_stat = yaml.full_load(f_data_stat)
 
@@ -73,13 +86,209 @@ class DummyRunnerSwinUNETR(object):
         self.max_shape = [int(np.ceil(image_size_mm[_l] / pixdim[_l])) for _l in range(3)]
         print("max_shape", self.max_shape)
 
-    def run(self, num_images_per_batch, num_sw_batch_size, validation_data_device):
-        scaler = GradScaler()
+        # the search result only depends on the network, the input/output sizes and the device
+        self.config_hash = hashlib.sha256(
+            json.dumps(
+                [
+                    parser.get("network"),
+                    self.input_channels,
+                    self.output_classes,
+                    self.softmax,
+                    self.roi_size,
+                    self.roi_size_valid,
+                    self.overlap_ratio,
+                    self.max_shape,
+                    self.dry_run,
+                ],
+                sort_keys=True,
+                default=str,
+            ).encode("utf-8")
+        ).hexdigest()[:16]
+
+        self.scaler = GradScaler(enabled=not self.dry_run)
+        self._traced = {}
+
+    def train_step(self, num_images_per_batch, num_crops_per_image=1):
+        self.model.train()
+
+        inputs = torch.rand(
+            (
+                num_images_per_batch * num_crops_per_image,
+                self.input_channels,
+                self.roi_size[0],
+                self.roi_size[1],
+                self.roi_size[2],
+            )
+        )
+        labels = torch.randint(
+            size=(
+                num_images_per_batch * num_crops_per_image,
+                self.label_channels,
+                self.roi_size[0],
+                self.roi_size[1],
+                self.roi_size[2],
+            ),
+            high=self.output_classes if self.softmax else 2,
+        ).type(torch.float32)
+        inputs, labels = inputs.to(self.device), labels.to(self.device)
+
+        for param in self.model.parameters():
+            param.grad = None
+
+        with autocast():
+            outputs = self.model(inputs)
+            loss = self.loss_function(outputs.float(), labels)
+
+        self.scaler.scale(loss).backward()
+        self.scaler.unscale_(self.optimizer)
+        torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+
+    @torch.no_grad()
+    def validation_step(self, num_sw_batch_size, validation_data_device):
+        self.model.eval()
+
+        val_images = torch.rand((1, self.input_channels, self.max_shape[0], self.max_shape[1], self.max_shape[2]))
+
+        if validation_data_device == "gpu":
+            val_images = val_images.to(self.device)
+
+        with autocast():
+            sliding_window_inference(
+                val_images,
+                self.roi_size_valid,
+                num_sw_batch_size,
+                self.model,
+                mode="gaussian",
+                overlap=self.overlap_ratio,
+                sw_device=self.device,
+            )
 
+    def trace_network(self, roi_size, training):
+        """
+        Traces a forward pass of the network (batch size of 1) on the meta device, and returns the bytes of the
+        activations saved for backward (training), and the largest input + output bytes of a single layer (inference).
+        """
+        key = (tuple(roi_size), training)
+        if key not in self._traced:
+            saved_bytes, layer_bytes = [0], [0]
+
+            def pack_hook(t):
+                saved_bytes[0] += t.numel() * t.element_size()
+                return t
+
+            def forward_hook(module, inputs, output):
+                if len(list(module.children())) == 0:
+                    tensors = [x for x in list(inputs) + [output] if isinstance(x, torch.Tensor)]
+                    layer_bytes[0] = max(layer_bytes[0], sum(x.numel() * x.element_size() for x in tensors))
+
+            handle = torch.nn.modules.module.register_module_forward_hook(forward_hook)
+            try:
+                x = torch.rand((1, self.input_channels, *roi_size), device=self.device)
+                self.model.train(training)
+                with torch.set_grad_enabled(training), torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+                    self.model(x)
+            finally:
+                handle.remove()
+            self._traced[key] = (saved_bytes[0], layer_bytes[0])
+        return self._traced[key]
+
+    def estimate_memory(self, num_images_per_batch=None, num_sw_batch_size=None, validation_data_device="gpu"):
+        """
+        Dry-run estimate (in bytes) of the peak device memory of a training iteration (num_images_per_batch),
+        or of a sliding window validation (num_sw_batch_size), from a traced forward pass (in float32, hence
+        conservative with amp). Activations scale linearly with the number of samples.
+        """
+        param_bytes = sum(p.numel() * p.element_size() for p in self.model.parameters())
+        output_voxel_bytes = self.output_classes * 4
+
+        if num_images_per_batch is not None:
+            saved_bytes, _ = self.trace_network(self.roi_size, training=True)
+            output_bytes = int(np.prod(self.roi_size)) * output_voxel_bytes
+            # parameters, gradients and optimizer states, activations and loss (softmax, one-hot, focal) terms
+            return 4 * param_bytes + num_images_per_batch * (saved_bytes + 4 * output_bytes)
+
+        _, layer_bytes = self.trace_network(self.roi_size_valid, training=False)
+        window_bytes = int(np.prod(self.roi_size_valid)) * (self.input_channels * 4 + 2 * output_voxel_bytes)
+        total = param_bytes + num_sw_batch_size * (layer_bytes + window_bytes)
+        if validation_data_device == "gpu":
+            # input image, output and count maps aggregated on the device
+            total += int(np.prod(self.max_shape)) * (self.input_channels * 4 + output_voxel_bytes + 4)
+        return total
+
+    def fits(self, memory_bytes, num_images_per_batch=None, num_sw_batch_size=None, validation_data_device="gpu"):
+        """
+        Returns True if a training iteration (num_images_per_batch) or a sliding window validation (num_sw_batch_size)
+        fits into memory_bytes, either estimated (dry_run) or by running it once on the GPU.
+        """
+        if self.dry_run:
+            return self.estimate_memory(num_images_per_batch, num_sw_batch_size, validation_data_device) <= memory_bytes
+
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(self.device)
+        try:
+            if num_images_per_batch is not None:
+                self.train_step(num_images_per_batch)
+            else:
+                self.validation_step(num_sw_batch_size, validation_data_device)
+        except RuntimeError as e:
+            if not is_oom_error(e):
+                raise e
+            print("[info] OOM")
+            return False
+        finally:
+            for param in self.model.parameters():
+                param.grad = None
+            torch.cuda.empty_cache()
+        return torch.cuda.max_memory_allocated(self.device) <= memory_bytes
+
+    def search(self, memory_gb, range_num_images_per_batch=(1, 20), range_num_sw_batch_size=(1, 40)):
+        """
+        Binary search of the largest num_images_per_batch (training), and the largest num_sw_batch_size
+        (validation, with the image on gpu or cpu) fitting into memory_gb, with the network built once.
+        Returns the best setting and its value (negative if successful), as the former optuna objective.
+        """
+        memory_bytes = int(float(memory_gb) * 1024**3)
+
+        def largest(predicate, low, high):
+            if not predicate(low):
+                return 0
+            while low < high:
+                mid = (low + high + 1) // 2
+                if predicate(mid):
+                    low = mid
+                else:
+                    high = mid - 1
+            return low
+
+        num_images_per_batch = largest(
+            lambda n: self.fits(memory_bytes, num_images_per_batch=n), *range_num_images_per_batch
+        )
+        print("[info] num_images_per_batch", num_images_per_batch)
+
+        best_sw, best_device, best_factor = 0, "cpu", 1.0
+        for validation_data_device, device_factor in (("gpu", 2.0), ("cpu", 1.0)):
+            num_sw_batch_size = largest(
+                lambda n: self.fits(memory_bytes, num_sw_batch_size=n, validation_data_device=validation_data_device),
+                *range_num_sw_batch_size,
+            )
+            print("[info] validation_data_device", validation_data_device, "num_sw_batch_size", num_sw_batch_size)
+            if num_sw_batch_size * device_factor > best_sw * best_factor:
+                best_sw, best_device, best_factor = num_sw_batch_size, validation_data_device, device_factor
+
+        value = float(num_images_per_batch) * float(best_sw) * best_factor
+        return {
+            "num_images_per_batch": num_images_per_batch,
+            "num_sw_batch_size": best_sw,
+            "validation_data_device": best_device,
+            "value": -value if value > 0 else 1,
+        }
+
+    def run(self, num_images_per_batch, num_sw_batch_size, validation_data_device):
         num_epochs = 2
         num_iterations = 6
         num_iterations_validation = 1
-        num_crops_per_image = 1
 
         validation_data_device = validation_data_device.lower()
         if validation_data_device != "cpu" and validation_data_device != "gpu":
@@ -93,70 +302,16 @@ class DummyRunnerSwinUNETR(object):
             # training
             print("------  training  ------")
 
-            self.model.train()
-
             for _j in range(num_iterations):
                 print("iteration", _j + 1)
-
-                inputs = torch.rand(
-                    (
-                        num_images_per_batch * num_crops_per_image,
-                        self.input_channels,
-                        self.roi_size[0],
-                        self.roi_size[1],
-                        self.roi_size[2],
-                    )
-                )
-                labels = torch.randint(
-                    size=(
-                        num_images_per_batch * num_crops_per_image,
-                        self.label_channels,
-                        self.roi_size[0],
-                        self.roi_size[1],
-                        self.roi_size[2],
-                    ),
-                    high=self.output_classes if self.softmax else 2,
-                ).type(torch.float32)
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-
-                for param in self.model.parameters():
-                    param.grad = None
-
-                with autocast():
-                    outputs = self.model(inputs)
-                    loss = self.loss_function(outputs.float(), labels)
-
-                scaler.scale(loss).backward()
-                scaler.unscale_(self.optimizer)
-                torch.nn.utils.clip_grad_norm_(self.model.parameters(), 0.5)
-                scaler.step(self.optimizer)
-                scaler.update()
+                self.train_step(num_images_per_batch)
 
             # validation
             print("------  validation  ------")
             torch.cuda.empty_cache()
-            self.model.eval()
-            with torch.no_grad():
-                for _k in range(num_iterations_validation):
-                    print("validation iteration", _k + 1)
-
-                    val_images = torch.rand(
-                        (1, self.input_channels, self.max_shape[0], self.max_shape[1], self.max_shape[2])
-                    )
-
-                    if validation_data_device == "gpu":
-                        val_images = val_images.to(self.device)
-
-                    with autocast():
-                        val_outputs = sliding_window_inference(
-                            val_images,
-                            self.roi_size_valid,
-                            num_sw_batch_size,
-                            self.model,
-                            mode="gaussian",
-                            overlap=self.overlap_ratio,
-                            sw_device=self.device,
-                        )
+            for _k in range(num_iterations_validation):
+                print("validation iteration", _k + 1)
+                self.validation_step(num_sw_batch_size, validation_data_device)
 
             torch.cuda.empty_cache()
 
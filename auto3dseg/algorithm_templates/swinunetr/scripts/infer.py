@@ -30,8 +30,10 @@ from monai.utils.misc import ensure_tuple
 
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 if __package__ in (None, ""):
+    from sharded_inference import CompletedCases, partition_by_voxels
     from train import CONFIG, pre_operation
 else:
+    from .sharded_inference import CompletedCases, partition_by_voxels
     from .train import CONFIG, pre_operation
 
 
@@ -64,6 +66,8 @@ class InferClass:
         ckpt_name = parser.get_parsed_content("infer")["ckpt_name"]
         data_list_key = parser.get_parsed_content("infer")["data_list_key"]
         output_path = parser.get_parsed_content("infer")["output_path"]
+        self.output_path = output_path
+        self.completed_cases = CompletedCases(output_path)
 
         if not os.path.exists(output_path):
             os.makedirs(output_path, exist_ok=True)
@@ -77,16 +81,13 @@ class InferClass:
         )
         self.infer_files = testing_files
 
-        self.infer_loader = None
-        if self.fast:
-            infer_ds = monai.data.Dataset(data=self.infer_files, transform=self.infer_transforms)
-            self.infer_loader = ThreadDataLoader(infer_ds, num_workers=8, batch_size=1, shuffle=False)
+        self.infer_loader = self.get_infer_loader(self.infer_files) if self.fast else None
 
-        try:
-            device = f"cuda:{dist.get_rank()}"
-        except BaseException:
-            device = f"cuda:0"
-        self.device = device
+        if torch.cuda.is_available():
+            local_rank = int(os.environ.get("LOCAL_RANK", dist.get_rank() if dist.is_initialized() else 0))
+            self.device = f"cuda:{local_rank % torch.cuda.device_count()}"
+        else:
+            self.device = "cpu"
 
         self.model = parser.get_parsed_content("network")
         self.model = self.model.to(self.device)
@@ -130,6 +131,30 @@ class InferClass:
 
         return
 
+    def get_infer_loader(self, infer_files):
+        infer_ds = monai.data.Dataset(data=infer_files, transform=self.infer_transforms)
+        return ThreadDataLoader(infer_ds, num_workers=8, batch_size=1, shuffle=False)
+
+    def shard(self, shard_id=0, num_shards=1, resume=False):
+        """
+        Restricts the inference to the shard_id-th of num_shards partitions of the testing datalist (balanced by
+        the estimated number of voxels), and with resume, to the cases without a completely saved prediction
+        (recorded in the manifest of the completed cases, see CompletedCases).
+        """
+        infer_files = (
+            partition_by_voxels(self.infer_files, num_shards)[shard_id] if num_shards > 1 else self.infer_files
+        )
+        self.completed_cases = CompletedCases(self.output_path, shard_id)
+        if resume:
+            infer_files = self.completed_cases.pending(infer_files)
+        logger.debug(
+            f"Shard {shard_id} of {num_shards}: {len(infer_files)} cases to infer"
+            f" ({len(self.infer_files) - len(infer_files)} in other shards or already saved)."
+        )
+        self.infer_files = infer_files
+        if self.fast:
+            self.infer_loader = self.get_infer_loader(self.infer_files)
+
     @torch.no_grad()
     def infer(self, image_file, save_mask=False):
         """Infer a single image_file. If save_mask is true, save the argmax prediction to disk. If false,
@@ -176,13 +201,16 @@ class InferClass:
         for _i in range(len(self.infer_files)):
             infer_filename = self.infer_files[_i]
             _ = self.infer(infer_filename, save_mask)
+            if save_mask:
+                self.completed_cases.add(infer_filename)
         return
 
     @torch.no_grad()
     def batch_infer(self):
         self.model.eval()
         with torch.no_grad():
-            for d in self.infer_loader:
+            # batch_size 1 and no shuffling, the batches follow infer_files
+            for infer_filename, d in zip(self.infer_files, self.infer_loader):
                 torch.cuda.empty_cache()
                 device_list_input = [self.device, self.device, "cpu"]
                 device_list_output = [self.device, "cpu", "cpu"]
@@ -210,11 +238,13 @@ class InferClass:
                         break
                 if not finished:
                     raise RuntimeError("Batch infer not finished due to OOM.")
+                self.completed_cases.add(infer_filename)
         return
 
 
-def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
+def run_shard(shard_id, num_shards, config_file, resume, override):
     infer_instance = InferClass(config_file, **override)
+    infer_instance.shard(shard_id, num_shards, resume)
     if infer_instance.fast:
         logger.debug("Using fast mode.")
         infer_instance.batch_infer()
@@ -224,6 +254,34 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
     return
 
 
+def run_worker(rank, num_shards, config_file, resume, override):
+    # same environment as torchrun, for the device selection and the rank 0 only configuration update
+    os.environ.update({"RANK": str(rank), "LOCAL_RANK": str(rank), "WORLD_SIZE": str(num_shards)})
+    if not torch.cuda.is_available():
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_shards))
+    run_shard(rank, num_shards, config_file, resume, override)
+
+
+def run(config_file: Optional[Union[str, Sequence[str]]] = None, num_shards: int = 1, resume: bool = False, **override):
+    """
+    Args:
+        num_shards: number of local inference processes (one per GPU round-robin, or sharing the CPU threads).
+            The testing datalist is partitioned into shards balanced by the estimated number of voxels.
+            When launched with torchrun, each of the WORLD_SIZE processes infers its own shard instead.
+        resume: skip the cases whose predictions are completely saved (recorded in the completed cases manifest
+            of the output path, see CompletedCases).
+    """
+    world_size = int(os.environ.get("WORLD_SIZE", 1))
+    if world_size > 1 or num_shards <= 1:
+        run_shard(int(os.environ.get("RANK", 0)), world_size, config_file, resume, override)
+    else:
+        torch.multiprocessing.spawn(
+            run_worker, nprocs=num_shards, args=(num_shards, config_file, resume, override), join=True
+        )
+
+    return
+
+
 if __name__ == "__main__":
     from monai.utils import optional_import
 
@@ -52,8 +52,12 @@ from monai.utils.misc import ensure_tuple
 
 if __package__ in (None, ""):
     from algo import auto_scale
+    from decoded_store import shared_decoded_transform
+    from incremental_validation import IncrementalValidation
 else:
     from .algo import auto_scale
+    from .decoded_store import shared_decoded_transform
+    from .incremental_validation import IncrementalValidation
 
 CONFIG = {
     "version": 1,
@@ -189,8 +193,11 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
     pretrained_path = parser.get_parsed_content("pretrained_path")
 
     if not valid_at_orig_resolution_only:
+        shared_cache_dir = parser.get_parsed_content("shared_cache_dir", default=None)
         train_transforms = parser.get_parsed_content("transforms_train")
+        train_transforms = shared_decoded_transform(parser, "transforms_train", train_transforms, shared_cache_dir)
         val_transforms = parser.get_parsed_content("transforms_validate")
+        val_transforms = shared_decoded_transform(parser, "transforms_validate", val_transforms, shared_cache_dir)
 
     if valid_at_orig_resolution_at_last or valid_at_orig_resolution_only:
         infer_transforms = parser.get_parsed_content("transforms_infer")
@@ -419,6 +426,15 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
     val_devices_input = {}
     val_devices_output = {}
 
+    incremental = None
+    incremental_validation = parser.get_parsed_content("incremental_validation", default=False)
+    if incremental_validation and not valid_at_orig_resolution_only:
+        incremental = IncrementalValidation(
+            num_cases=len(val_loader.dataset),
+            time_fraction=parser.get_parsed_content("validation_time_fraction", default=0.25),
+            best_margin=parser.get_parsed_content("validation_best_margin", default=0.01),
+        )
+
     if es:
         stop_train = torch.tensor(False).to(device)
 
@@ -462,6 +478,7 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
                     logger.debug(f"Learning rate is set to {lr}")
 
                 model.train()
+                round_start_time = time.time()
                 epoch_loss = 0
                 loss_torch = torch.zeros(2, dtype=torch.float, device=device)
                 step = 0
@@ -559,79 +576,119 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
                         if (_round + 1) % (target_num_epochs_per_validation // num_epochs_per_validation) != 0:
                             continue
 
+                train_time = time.time() - round_start_time
                 model.eval()
                 with torch.no_grad():
                     # for metric, index 2*c is the dice for class c, and 2*c + 1 is the not-nan counts for class c
                     metric = torch.zeros(metric_dim * 2, dtype=torch.float, device=device)
 
-                    _index = 0
-                    for val_data in val_loader:
-                        try:
-                            val_filename = val_data["image_meta_dict"]["filename_or_obj"][0]
-                        except BaseException:
-                            val_filename = val_data["image"].meta["filename_or_obj"][0]
-                        if sw_input_on_cpu:
-                            device_list_input = ["cpu"]
-                            device_list_output = ["cpu"]
-                        elif val_filename not in val_devices_input or val_filename not in val_devices_output:
-                            device_list_input = [device, device, "cpu"]
-                            device_list_output = [device, "cpu", "cpu"]
-                        elif val_filename in val_devices_input and val_filename in val_devices_output:
-                            device_list_input = [val_devices_input[val_filename]]
-                            device_list_output = [val_devices_output[val_filename]]
-
-                        for _device_in, _device_out in zip(device_list_input, device_list_output):
+                    val_indices = None if incremental is None else incremental.select(train_time)
+                    num_validated = 0
+
+                    while True:
+                        val_start_time = time.time()
+                        _index = 0
+                        for val_data in (
+                            val_loader if val_indices is None else incremental.loader(val_loader, val_indices)
+                        ):
                             try:
-                                val_outputs = None
-                                val_devices_input[val_filename] = _device_in
-                                val_devices_output[val_filename] = _device_out
-                                with autocast(enabled=amp):
-                                    val_outputs = sliding_window_inference(
-                                        inputs=val_data["image"].to(_device_in),
-                                        roi_size=roi_size_valid,
-                                        sw_batch_size=num_sw_batch_size,
-                                        predictor=model,
-                                        mode="gaussian",
-                                        overlap=overlap_ratio,
-                                        sw_device=device,
-                                        device=_device_out,
-                                    )
+                                val_filename = val_data["image_meta_dict"]["filename_or_obj"][0]
+                            except BaseException:
+                                val_filename = val_data["image"].meta["filename_or_obj"][0]
+                            if sw_input_on_cpu:
+                                device_list_input = ["cpu"]
+                                device_list_output = ["cpu"]
+                            elif val_filename not in val_devices_input or val_filename not in val_devices_output:
+                                device_list_input = [device, device, "cpu"]
+                                device_list_output = [device, "cpu", "cpu"]
+                            elif val_filename in val_devices_input and val_filename in val_devices_output:
+                                device_list_input = [val_devices_input[val_filename]]
+                                device_list_output = [val_devices_output[val_filename]]
+
+                            for _device_in, _device_out in zip(device_list_input, device_list_output):
                                 try:
-                                    val_outputs = post_pred(val_outputs[0, ...])
-                                except BaseException:
-                                    val_outputs = post_pred(val_outputs[0, ...].to("cpu"))
-                                finished = True
-
-                            except RuntimeError as e:
-                                if not any(x in str(e).lower() for x in ("memory", "cuda", "cudnn")):
-                                    raise e
-                                finished = False
+                                    val_outputs = None
+                                    val_devices_input[val_filename] = _device_in
+                                    val_devices_output[val_filename] = _device_out
+                                    with autocast(enabled=amp):
+                                        val_outputs = sliding_window_inference(
+                                            inputs=val_data["image"].to(_device_in),
+                                            roi_size=roi_size_valid,
+                                            sw_batch_size=num_sw_batch_size,
+                                            predictor=model,
+                                            mode="gaussian",
+                                            overlap=overlap_ratio,
+                                            sw_device=device,
+                                            device=_device_out,
+                                        )
+                                    try:
+                                        val_outputs = post_pred(val_outputs[0, ...])
+                                    except BaseException:
+                                        val_outputs = post_pred(val_outputs[0, ...].to("cpu"))
+                                    finished = True
+
+                                except RuntimeError as e:
+                                    if not any(x in str(e).lower() for x in ("memory", "cuda", "cudnn")):
+                                        raise e
+                                    finished = False
+
+                                if finished:
+                                    break
 
                             if finished:
-                                break
-
-                        if finished:
-                            val_outputs = val_outputs[None, ...]
-                            value = compute_dice(
-                                y_pred=val_outputs,
-                                y=val_data["label"].to(val_outputs.device),
-                                include_background=not softmax,
-                                num_classes=output_classes,
-                            ).to(device)
-                        else:
-                            # During training, allow validation OOM for some big data to avoid crush.
-                            logger.debug(f"{val_filename} is skipped due to OOM, using NaN dice values")
-                            value = torch.full((1, metric_dim), float("nan")).to(device)
-
-                        logger.debug(f"{_index + 1} / {len(val_loader)}/ {val_filename}: {value}")
-
-                        for _c in range(metric_dim):
-                            val0 = torch.nan_to_num(value[0, _c], nan=0.0)
-                            val1 = 1.0 - torch.isnan(value[0, _c]).float()
-                            metric[2 * _c] += val0
-                            metric[2 * _c + 1] += val1
+                                val_outputs = val_outputs[None, ...]
+                                value = compute_dice(
+                                    y_pred=val_outputs,
+                                    y=val_data["label"].to(val_outputs.device),
+                                    include_background=not softmax,
+                                    num_classes=output_classes,
+                                ).to(device)
+                            else:
+                                # During training, allow validation OOM for some big data to avoid crush.
+                                logger.debug(f"{val_filename} is skipped due to OOM, using NaN dice values")
+                                value = torch.full((1, metric_dim), float("nan")).to(device)
+
+                            logger.debug(f"{_index + 1} / {len(val_loader)}/ {val_filename}: {value}")
+
+                            case_metric = torch.zeros_like(metric)
+                            for _c in range(metric_dim):
+                                val0 = torch.nan_to_num(value[0, _c], nan=0.0)
+                                val1 = 1.0 - torch.isnan(value[0, _c]).float()
+                                case_metric[2 * _c] += val0
+                                case_metric[2 * _c + 1] += val1
+                            metric += case_metric
+                            if incremental is not None:
+                                incremental.update(val_indices[_index], case_metric, epoch)
+
+                            _index += 1
+
+                        num_validated += _index
+                        if incremental is None:
+                            break
 
-                        _index += 1
+                        # the metric of all cases (cached), validate the stale cases if the model may become the best
+                        incremental.update_time(_index, time.time() - val_start_time)
+                        metric = incremental.metric(metric)
+                        full_pass = torch.tensor(0.0, device=device)
+                        reduced = metric.clone()
+                        num_stale = torch.tensor(float(len(incremental.stale(epoch))), device=device)
+                        if torch.cuda.device_count() > 1:
+                            dist.all_reduce(reduced, op=torch.distributed.ReduceOp.SUM)
+                            dist.all_reduce(num_stale, op=torch.distributed.ReduceOp.SUM)
+                        if torch.cuda.device_count() == 1 or dist.get_rank() == 0:
+                            reduced = reduced.tolist()
+                            avg_cached = 0
+                            for _c in range(metric_dim):
+                                avg_cached += reduced[2 * _c] / max(reduced[2 * _c + 1], 1.0)
+                            avg_cached = avg_cached / float(metric_dim)
+                            if num_stale > 0 and incremental.may_become_best(avg_cached, best_metric):
+                                full_pass += 1.0
+                        if torch.cuda.device_count() > 1:
+                            dist.broadcast(full_pass, src=0)
+                        if full_pass > 0:
+                            val_indices = incremental.stale(epoch)
+                            continue
+                        break
 
                     if torch.cuda.device_count() > 1:
                         dist.barrier()
@@ -663,6 +720,15 @@ def run(config_file: Optional[Union[str, Sequence[str]]] = None, **override):
                         writer.add_scalar("val/acc", avg_metric, epoch)
                         mlflow.log_metric("val/acc", avg_metric, step=epoch)
 
+                        if incremental is not None:
+                            ages = incremental.ages(epoch)
+                            logger.debug(
+                                f"incremental validation: {num_validated}/{incremental.num_cases} cases validated, "
+                                f"cached metric age mean {np.mean(ages):.1f} max {max(ages)} epochs"
+                            )
+                            writer.add_scalar("val/num_validated", num_validated, epoch)
+                            writer.add_scalar("val/max_metric_age", max(ages), epoch)
+
                         if avg_metric > best_metric:
                             best_metric = avg_metric
                             best_metric_epoch = epoch
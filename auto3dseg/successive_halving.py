@@ -0,0 +1,173 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Successive halving scheduler for the training of the algorithm templates generated by BundleGen.
+
+All the (algorithm, fold) runs of a work directory are trained with a small number of epochs, then
+only the best 1/eta of the runs of each fold (by their best validation metric, read from progress.yaml or
+accuracy_history.csv) are promoted to the next budget (eta times more epochs), warm-started from their own
+checkpoint, until max_epochs. The runs which are not promoted are kept with their current score, so that the
+ensemble can still use them. e.g.
+
+    python auto3dseg/successive_halving.py run --work_dir ./work_dir --min_epochs 20 --max_epochs 300 --eta 3
+"""
+
+import csv
+import math
+import os
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import fire
+
+from monai.apps.auto3dseg.utils import import_bundle_algo_history
+from monai.auto3dseg.utils import algo_to_pickle
+from monai.bundle.config_parser import ConfigParser
+from monai.utils.enums import AlgoKeys
+
+# config overrides (in configs/hyper_parameters.yaml) to continue the training from the checkpoint of a run
+warm_start_override = {
+    "segresnet": {"finetune#enabled": True, "continue": True},
+    "segresnet2d": {"finetune#enabled": True, "continue": True},
+    "dints": {"finetune#activate_finetune": True},
+    "swinunetr": {"finetune#activate": True},
+}
+# config sections removed when warm-starting, so that the training schedule is kept (the dints fine-tuning
+# overwrites the learning rate with ConstantLR 0.001 and disables early stopping)
+warm_start_remove = {"dints": ("finetune", "overwrite")}
+# templates restarting their epoch counter (and schedule) from a checkpoint, they train the epochs added by each
+# rung instead of the cumulative budget
+incremental_templates = ("dints", "swinunetr")
+
+
+def get_budgets(min_epochs: int, max_epochs: int, eta: int = 3) -> List[int]:
+    """
+    Numbers of epochs of the successive rungs, min_epochs * eta**i up to (and including) max_epochs
+    """
+    budgets = []
+    budget = max(1, int(min_epochs))
+    while budget < max_epochs:
+        budgets.append(budget)
+        budget *= eta
+    return budgets + [int(max_epochs)]
+
+
+def rung_epochs(budgets: List[int], rung: int, template: str) -> int:
+    """
+    Number of epochs to train a run of template at a rung, the increment over the previous rung for the
+    incremental templates (warm-started without their epoch counter), otherwise the cumulative budget
+    """
+    if rung > 0 and template in incremental_templates:
+        return budgets[rung] - budgets[rung - 1]
+    return budgets[rung]
+
+
+def select_top(scores: Dict[str, float], folds: Dict[str, int], eta: int = 3) -> List[str]:
+    """
+    Names of the best ceil(n / eta) runs of each fold (runs of different folds have different validation sets)
+    """
+    runs_per_fold = defaultdict(list)
+    for name in scores:
+        runs_per_fold[folds[name]].append(name)
+    selected = []
+    for names in runs_per_fold.values():
+        names = sorted(names, key=lambda n: scores[n], reverse=True)
+        selected += names[: max(1, math.ceil(len(names) / eta))]
+    return selected
+
+
+def read_score(algo, fold: int) -> float:
+    """
+    Best validation metric of a run, from its progress.yaml, otherwise from its accuracy_history.csv
+    """
+    try:
+        return float(algo.get_score())
+    except Exception:
+        pass
+
+    csv_path = os.path.join(algo.output_path, "model_fold" + str(fold), "accuracy_history.csv")
+    if not os.path.isfile(csv_path):
+        csv_path = os.path.join(algo.output_path, "model", "accuracy_history.csv")
+    scores = [-1.0]
+    if os.path.isfile(csv_path):
+        with open(csv_path) as f:
+            for row in csv.DictReader(f, delimiter="\t"):
+                try:
+                    scores.append(float(row["metric"]))
+                except (KeyError, TypeError, ValueError):
+                    continue  # repeated header or incomplete row
+    return max(scores)
+
+
+def enable_warm_start(algo, template: str) -> None:
+    """
+    Sets the fine-tuning options of the run configuration, to continue from its checkpoint
+    """
+    config_file = os.path.join(algo.output_path, "configs", "hyper_parameters.yaml")
+    parser = ConfigParser(globals=False)
+    parser.read_config(config_file)
+    for key, value in warm_start_override.get(template, {}).items():
+        parser[key] = value
+    if template in warm_start_remove:
+        section, key = warm_start_remove[template]
+        content = parser.get(section)
+        content.pop(key, None)
+        parser[section] = content
+    ConfigParser.export_config_file(parser.get(), config_file, fmt="yaml", default_flow_style=None)
+
+
+def run(
+    work_dir: str = "./work_dir",
+    min_epochs: int = 20,
+    max_epochs: int = 300,
+    eta: int = 3,
+    train_params: Optional[Dict] = None,
+    algos: Optional[List[str]] = None,
+):
+    """
+    Args:
+        work_dir: the working directory of the bundles generated by BundleGen (or AutoRunner).
+        min_epochs: the number of epochs of the first rung (all the runs).
+        max_epochs: the number of epochs of the last rung.
+        eta: the reduction factor, the best 1/eta runs of each fold are promoted to eta times more epochs.
+        train_params: other training parameters of all runs (e.g. num_epochs_per_validation).
+        algos: optional names of the runs to schedule (e.g. ["dints_0", "segresnet_0"]), defaults to all.
+    """
+    history = import_bundle_algo_history(work_dir, only_trained=False)
+    runs = {h[AlgoKeys.ID]: h[AlgoKeys.ALGO] for h in history if algos is None or h[AlgoKeys.ID] in algos}
+    folds = {name: int(name.rsplit("_", 1)[-1]) for name in runs}  # BundleGen names the runs <template>_<fold>
+    scores: Dict[str, float] = {}
+
+    budgets = get_budgets(min_epochs, max_epochs, eta)
+    promoted = list(runs)
+    for rung, num_epochs in enumerate(budgets):
+        print(f"rung {rung}: training {promoted} for {num_epochs} epochs")
+        for name in promoted:
+            algo, template = runs[name], name.split("_")[0]
+            if rung > 0:
+                enable_warm_start(algo, template)
+            params = dict(train_params or {})
+            params["num_epochs"] = rung_epochs(budgets, rung, template)
+            algo.train(params)
+            scores[name] = read_score(algo, folds[name])
+            algo_to_pickle(algo, template_path=algo.template_path, **{str(AlgoKeys.SCORE): scores[name]})
+            print(f"rung {rung}: {name} score {scores[name]:.4f}")
+
+        if rung < len(budgets) - 1:
+            promoted = select_top({name: scores[name] for name in promoted}, folds, eta)
+
+    print("final scores: " + ", ".join(f"{name} {score:.4f}" for name, score in sorted(scores.items())))
+    return scores
+
+
+if __name__ == "__main__":
+    fire.Fire()
@@ -0,0 +1,315 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Inference benchmark of the algorithm templates on synthetic volumes.
+
+Each template is generated (with randomly initialized weights), and every testing volume is inferred and saved
+by the template's own inference entry point, InferClass.infer (e.g. Segmenter.infer_image of segresnet, the
+InferencePlanner of dints), so that the timings cover the code of the template. The time per volume is split into
+the network forward passes (timed by hooks on the network) and the rest (load, transforms, sliding window
+stitching, inversion and saving). Every template runs in a separate process, to report its own peak RSS.
+The templates which are not generated for the synthetic data (e.g. segresnet2d with isotropic spacing) are reported
+as skipped. The results are printed and saved as JSON, e.g.
+
+    python auto3dseg/tests/benchmark_infer.py run --sim_dim "(96,96,64)" --num_classes 3 --num_images 4
+"""
+
+import json
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import shutil
+import sys
+import time
+
+import fire
+import nibabel as nib
+import numpy as np
+import torch
+
+from monai.apps.auto3dseg import BundleGen, DataAnalyzer
+from monai.bundle.config_parser import ConfigParser
+from monai.data import create_test_image_3d
+from monai.utils import ensure_tuple
+from monai.utils.enums import AlgoKeys
+
+algo_templates = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "algorithm_templates"))
+all_templates = ["segresnet", "segresnet2d", "dints", "swinunetr"]
+
+# run all templates on cpu, and save the masks
+cpu_override = {
+    "segresnet": {"cuda": False, "amp": False, "infer#save_mask": True},
+    "segresnet2d": {"cuda": False, "amp": False, "infer#save_mask": True},
+    "dints": {
+        "training#amp": False,
+        "training_network#arch_ckpt": "$torch.load(@training_network#arch_ckpt_path, "
+        "map_location=torch.device('cpu'), weights_only=False)",
+        "training_network#dints_space#device": "$torch.device('cpu')",
+    },
+    "swinunetr": {"amp": False},
+}
+network_keys = {"dints": "training_network#network", "swinunetr": "network"}
+
+
+def create_sim_datalist(work_dir, sim_dim, num_classes, num_images, spacing=(1.0, 1.0, 1.0)):
+    """
+    Create synthetic images/labels and a datalist with the training and testing keys.
+    """
+    dataroot = os.path.join(work_dir, "sim_dataroot")
+    os.makedirs(dataroot, exist_ok=True)
+    affine = np.diag(list(spacing) + [1.0])
+
+    datalist = {"training": [], "testing": []}
+    for i in range(max(2, num_images)):
+        im, seg = create_test_image_3d(
+            sim_dim[0], sim_dim[1], sim_dim[2], rad_max=max(int(min(sim_dim) / 4), 2), num_seg_classes=num_classes - 1
+        )
+        image, label = f"image_{i:03d}.nii.gz", f"label_{i:03d}.nii.gz"
+        nib.save(nib.Nifti1Image(im, affine=affine), os.path.join(dataroot, image))
+        nib.save(nib.Nifti1Image(seg.astype(np.uint8), affine=affine), os.path.join(dataroot, label))
+        datalist["training"].append({"fold": i % 2, "image": image, "label": label})
+        if i < num_images:
+            datalist["testing"].append({"image": image})
+
+    datalist_file = os.path.join(work_dir, "sim_datalist.json")
+    ConfigParser.export_config_file(datalist, datalist_file)
+
+    return dataroot, datalist_file
+
+
+def generate_bundles(work_dir, dataroot, datalist_file, templates, modality):
+    data_src_cfg = {"modality": modality, "datalist": datalist_file, "dataroot": dataroot}
+    data_src_cfg_file = os.path.join(work_dir, "input.yaml")
+    ConfigParser.export_config_file(data_src_cfg, data_src_cfg_file, fmt="yaml")
+
+    datastats_file = os.path.join(work_dir, "datastats.yaml")
+    analyser = DataAnalyzer(datalist_file, dataroot, output_path=datastats_file, device="cpu")
+    analyser.get_all_case_stats()
+
+    bundle_generator = BundleGen(
+        algo_path=work_dir,
+        templates_path_or_url=algo_templates,
+        algos=templates,
+        data_stats_filename=datastats_file,
+        data_src_cfg_name=data_src_cfg_file,
+    )
+    bundle_generator.generate(work_dir, num_fold=1)
+    return bundle_generator.get_history()
+
+
+def save_random_checkpoint(bundle_dir, template):
+    """
+    dints and swinunetr require a checkpoint to infer, save a randomly initialized one
+    """
+    if template not in network_keys:
+        return
+
+    config_dir = os.path.join(bundle_dir, "configs")
+    config_files = [
+        os.path.join(config_dir, f) for f in sorted(os.listdir(config_dir)) if f.endswith(".yaml") and "search" not in f
+    ]
+    parser = ConfigParser()
+    parser.read_config(config_files)
+    parser.update(pairs=cpu_override[template])
+
+    if template == "dints" and not os.path.isfile(parser.get_parsed_content("training_network#arch_ckpt_path")):
+        # no architecture search, decode the architecture of an untrained search space
+        from monai.networks.nets import TopologySearch
+
+        dints_space = TopologySearch(channel_mul=0.5, num_blocks=12, num_depths=4, use_downsample=True, device="cpu")
+        node_a, code_a, code_c, code_a_max = dints_space.decode()
+        torch.save(
+            {"code_a": code_a, "code_a_max": code_a_max, "code_c": code_c, "node_a": node_a},
+            parser.get_parsed_content("training_network#arch_ckpt_path"),
+        )
+
+    ckpt_name = parser.get_parsed_content("infer#ckpt_name")
+    os.makedirs(os.path.dirname(ckpt_name), exist_ok=True)
+    torch.save(parser.get_parsed_content(network_keys[template]).state_dict(), ckpt_name)
+
+
+def get_network(template, inferer):
+    """
+    The network of a template InferClass, unwrapped down to the module which runs the forward passes
+    """
+    model = inferer.segmenter.model if template.startswith("segresnet") else inferer.model
+    model = getattr(model, "module", model)  # DistributedDataParallel
+    return getattr(model, "net", model)  # WrappedModel2D of segresnet2d, whose slice inferer calls the 2D net
+
+
+def infer_case(template, inferer, image_file):
+    """
+    Infers and saves image_file with the inference entry point of the template (as used by the ensembles)
+    """
+    if template.startswith("segresnet"):
+        return inferer.infer(dict(image_file))  # saved with infer#save_mask
+    return inferer.infer(dict(image_file), save_mask=True)
+
+
+@torch.no_grad()
+def benchmark_template(template, bundle_dir, testing_files, num_warmup=1, num_threads=None):
+    if num_threads is not None:
+        torch.set_num_threads(int(num_threads))
+    sys.path.insert(0, os.path.join(bundle_dir, "scripts"))
+    from monai.apps.auto3dseg import BundleAlgo
+
+    algo = BundleAlgo(template_path=bundle_dir)
+    algo.output_path = bundle_dir
+    save_random_checkpoint(bundle_dir, template)
+    inferer = algo.get_inferer(**cpu_override.get(template, {}))
+
+    network = get_network(template, inferer)
+    forward_start, network_time = [0.0], [0.0]
+
+    def start_forward(*args):
+        forward_start[0] = time.time()
+
+    def end_forward(*args):
+        network_time[0] += time.time() - forward_start[0]
+
+    network.register_forward_pre_hook(start_forward)
+    network.register_forward_hook(end_forward)
+
+    stage_times = {"network": [], "other": []}
+    files = [testing_files[0]] * num_warmup + list(testing_files)
+    start_time = None
+    for i, image_file in enumerate(files):
+        if i == num_warmup:
+            start_time = time.time()
+        case_start, network_time[0] = time.time(), 0.0
+        infer_case(template, inferer, image_file)
+        if i >= num_warmup:
+            stage_times["network"].append(network_time[0])
+            stage_times["other"].append(time.time() - case_start - network_time[0])
+
+    total_time = time.time() - start_time
+    return {
+        "stages": {k: float(np.mean(v)) for k, v in stage_times.items()},
+        "time_per_volume": total_time / max(1, len(testing_files)),
+        "volumes_per_hour": 3600.0 * len(testing_files) / max(total_time, 1e-8),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "network_parameters": sum(p.numel() for p in network.parameters()),
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def _benchmark_worker(queue, *args):
+    try:
+        queue.put(benchmark_template(*args))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def wait_result(process, queue, timeout, poll_interval=5.0):
+    """
+    Result of a benchmark process, or an error if it exits (e.g. crashes) without a result or times out
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return queue.get(timeout=poll_interval)
+        except queue_module.Empty:
+            if not process.is_alive():
+                try:
+                    return queue.get(timeout=poll_interval)  # put just before exiting
+                except queue_module.Empty:
+                    return {"error": f"process exited with code {process.exitcode} without a result"}
+    process.kill()
+    return {"error": f"timed out after {timeout}s"}
+
+
+def run(
+    work_dir="./tmp_benchmark_work_dir",
+    templates=None,
+    sim_dim=(96, 96, 64),
+    num_classes=3,
+    num_images=4,
+    spacing=(1.0, 1.0, 1.0),
+    num_warmup=1,
+    modality="CT",
+    output_file=None,
+    num_threads=None,
+    timeout=3600,
+):
+    """
+    Args:
+        work_dir: working directory for the synthetic data and the generated bundles (removed at the end).
+        templates: the algorithm templates to benchmark, defaults to all.
+        sim_dim: the size of the synthetic volumes.
+        num_classes: the number of classes (including the background) of the synthetic labels.
+        num_images: the number of volumes to infer per template.
+        spacing: the voxel spacing of the synthetic volumes, segresnet2d is only generated for anisotropic
+            spacing, e.g. (1.0, 1.0, 5.0), otherwise it is reported as skipped.
+        num_warmup: the number of warm-up inferences (not included in the timings).
+        modality: the modality of the synthetic data (CT or MRI).
+        output_file: path of the output JSON file, defaults to benchmark_infer.json in the current folder.
+        num_threads: optional number of torch cpu threads (of each template process).
+        timeout: maximum time in seconds of the benchmark of a template.
+    """
+    templates = all_templates if templates is None else list(ensure_tuple(templates))
+    output_file = output_file or os.path.abspath("benchmark_infer.json")
+    work_dir = os.path.abspath(work_dir)
+    if os.path.isdir(work_dir):
+        shutil.rmtree(work_dir)
+    os.makedirs(work_dir)
+
+    dataroot, datalist_file = create_sim_datalist(work_dir, sim_dim, num_classes, num_images, spacing)
+    testing_files = [
+        {"image": os.path.join(dataroot, d["image"])} for d in ConfigParser.load_config_file(datalist_file)["testing"]
+    ]
+    history = generate_bundles(work_dir, dataroot, datalist_file, templates, modality)
+    generated = {algo_dict[AlgoKeys.ID].split("_")[0] for algo_dict in history}
+
+    results = {
+        "config": {
+            "sim_dim": list(sim_dim),
+            "num_classes": num_classes,
+            "num_images": num_images,
+            "spacing": list(spacing),
+            "modality": modality,
+            "num_threads": num_threads,  # None: the torch default, see the num_threads of each template
+        },
+        "templates": {},
+    }
+
+    ctx = multiprocessing.get_context("spawn")
+    for algo_dict in history:
+        name = algo_dict[AlgoKeys.ID]
+        template = name.split("_")[0]
+        queue = ctx.Queue()
+        p = ctx.Process(
+            target=_benchmark_worker,
+            args=(queue, template, algo_dict[AlgoKeys.ALGO].output_path, testing_files, num_warmup, num_threads),
+        )
+        p.start()
+        results["templates"][template] = wait_result(p, queue, timeout)
+        p.join(timeout=10)
+        if p.is_alive():
+            p.kill()
+        print(f"{template}: {json.dumps(results['templates'][template])}")
+
+    for template in templates:
+        if template not in generated:
+            # e.g. segresnet2d is only generated for anisotropic spacing
+            results["templates"][template] = {"skipped": "not generated by BundleGen for the synthetic data"}
+            print(f"{template}: skipped, not generated by BundleGen for the synthetic data (spacing {list(spacing)})")
+
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Saved benchmark results to {output_file}")
+
+    shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    fire.Fire()
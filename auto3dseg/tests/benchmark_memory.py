@@ -0,0 +1,108 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Validation of the SegResNetDS training memory model of the segresnet template (estimate_segresnetds_memory),
+which auto_adjust_network_settings uses to pick roi_size, init_filters and batch_size.
+
+For each configuration of the grid, the estimated allocator memory (without mem_overhead_gb) is compared with the
+raw peak memory reserved by the caching allocator (torch.cuda.max_memory_reserved) during a few training steps on
+the GPU, and the estimated total with the reserved memory plus the measured CUDA context (see
+measure_segresnetds_memory, run it on an idle GPU). The measurement is skipped without CUDA, the estimates are
+always printed. The results are saved as JSON, and the error table as markdown (for the README), e.g.
+
+    python auto3dseg/tests/benchmark_memory.py run --output_classes "(2,16,105)" --batch_sizes "(1,2)"
+"""
+
+import itertools
+import json
+import os
+import sys
+
+import fire
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "algorithm_templates", "segresnet", "scripts"))
+from utils import estimate_segresnetds_memory, measure_segresnetds_memory  # noqa: E402
+
+roi_sizes = [(96, 96, 96), (128, 128, 128), (160, 160, 128), (224, 224, 144)]
+
+
+def run(
+    output_classes=(2, 16, 105),
+    batch_sizes=(1, 2),
+    init_filters=(32,),
+    amp=(True, False),
+    channels_last=(True, False),
+    output_file="benchmark_memory.json",
+    table_file="benchmark_memory.md",
+):
+    results = []
+    grid = itertools.product(roi_sizes, output_classes, batch_sizes, init_filters, amp, channels_last)
+    for roi_size, classes, batch_size, filters, use_amp, use_channels_last in grid:
+        params = {
+            "roi_size": list(roi_size),
+            "output_classes": classes,
+            "batch_size": batch_size,
+            "init_filters": filters,
+            "amp": use_amp,
+            "channels_last": use_channels_last,
+        }
+        estimate = estimate_segresnetds_memory(**params)
+        try:
+            measured = measure_segresnetds_memory(**params)
+        except torch.cuda.OutOfMemoryError:
+            measured = "out of memory"
+            torch.cuda.empty_cache()
+
+        result = {**params, "estimate": estimate, "measured": measured}
+        if isinstance(measured, dict):
+            result["relative_error"] = (estimate["allocator"] - measured["reserved"]) / measured["reserved"]
+            result["relative_error_total"] = (estimate["total"] - measured["total"]) / measured["total"]
+        results.append(result)
+        print(
+            f"{params} estimated {estimate['allocator']:.2f} Gb (total {estimate['total']:.2f} Gb) "
+            f"measured {measured} error {result.get('relative_error', float('nan')):.3f}"
+        )
+
+    errors = [abs(r["relative_error"]) for r in results if "relative_error" in r]
+    if errors:
+        print(f"mean absolute relative error {sum(errors) / len(errors):.3f} max {max(errors):.3f}")
+
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    if errors:
+        with open(table_file, "w") as f:
+            f.write(error_table(results))
+    return results
+
+
+def error_table(results):
+    """Markdown table of the measured configurations: estimated and measured memory (Gb) and relative errors"""
+    lines = [
+        "| roi_size | classes | batch | filters | amp | channels_last | estimated | reserved | error "
+        "| estimated total | measured total | error total |",
+        "|" + " --- |" * 12,
+    ]
+    for r in results:
+        if "relative_error" not in r:
+            continue
+        est, meas = r["estimate"], r["measured"]
+        lines.append(
+            f"| {r['roi_size']} | {r['output_classes']} | {r['batch_size']} | {r['init_filters']} | {r['amp']} "
+            f"| {r['channels_last']} | {est['allocator']:.2f} | {meas['reserved']:.2f} | {r['relative_error']:+.3f} "
+            f"| {est['total']:.2f} | {meas['total']:.2f} | {r['relative_error_total']:+.3f} |"
+        )
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    fire.Fire()
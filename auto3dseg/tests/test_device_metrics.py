@@ -0,0 +1,64 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+from monai.metrics import DiceHelper
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "algorithm_templates", "segresnet", "scripts"))
+from segmenter import DeviceMetrics  # noqa: E402
+
+
+class TestDeviceMetrics(unittest.TestCase):
+    def _run(self, num_classes, sigmoid):
+        acc_function = DiceHelper(sigmoid=sigmoid)
+        metrics = DeviceMetrics(device=torch.device("cpu"), report_interval=0)
+        for _ in range(3):
+            if sigmoid:
+                pred = (torch.rand(2, num_classes, 8, 8, 8) > 0.5).float()
+                target = (torch.rand(2, num_classes, 8, 8, 8) > 0.5).float()
+            else:
+                pred = torch.randint(0, num_classes, (2, 1, 8, 8, 8)).float()
+                pred = torch.cat([pred == c for c in range(num_classes)], dim=1).float()
+                target = torch.randint(0, num_classes, (2, 1, 8, 8, 8))
+            acc, not_nans = acc_function(pred, target)
+            metrics.append("loss", torch.rand(()), count=2)
+            metrics.append("acc", acc, count=not_nans)
+        return metrics.aggregate()
+
+    def test_single_class(self):
+        result = self._run(num_classes=1, sigmoid=True)
+        self.assertIsInstance(result["loss"], float)
+        self.assertIsInstance(result["acc"], np.ndarray)
+        self.assertEqual(result["acc"].shape, (1,))
+        self.assertEqual(len(result["acc"]), 1)
+
+    def test_multi_class(self):
+        result = self._run(num_classes=3, sigmoid=False)
+        self.assertIsInstance(result["loss"], float)
+        self.assertEqual(result["acc"].shape, (2,))  # without background
+        self.assertFalse(np.any(result["acc"] < 0))
+
+    def test_report(self):
+        metrics = DeviceMetrics(device=torch.device("cpu"), report_interval=0)
+        metrics.append("acc", torch.tensor([0.5]), count=1)
+        metrics.append("acc", torch.tensor([1.0]), count=3)
+        report = metrics.report()
+        np.testing.assert_allclose(report["acc"], [0.875])
+
+
+if __name__ == "__main__":
+    unittest.main()
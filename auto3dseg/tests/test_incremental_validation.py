@@ -0,0 +1,55 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import filecmp
+import os
+import sys
+import unittest
+
+import torch
+
+templates_dir = os.path.join(os.path.dirname(__file__), "..", "algorithm_templates")
+sys.path.insert(0, os.path.join(templates_dir, "dints", "scripts"))
+from incremental_validation import IncrementalValidation  # noqa: E402
+
+
+class TestIncrementalValidation(unittest.TestCase):
+    def test_same_module_in_templates(self):
+        reference = os.path.join(templates_dir, "dints", "scripts", "incremental_validation.py")
+        for template in ("segresnet", "swinunetr"):
+            copy = os.path.join(templates_dir, template, "scripts", "incremental_validation.py")
+            self.assertTrue(filecmp.cmp(reference, copy, shallow=False), f"{copy} differs from {reference}")
+
+    def test_rotating_cases(self):
+        incremental = IncrementalValidation(num_cases=4, time_fraction=0.5, dataset_indices=[1, 3, 5, 7])
+        self.assertEqual(incremental.select(10.0), [0, 1, 2, 3])  # all cases until every case is cached
+        for case in range(4):
+            incremental.update(case, torch.tensor([float(case), 1.0]), epoch=0)
+        incremental.update_time(4, 4.0)
+
+        cases = incremental.select(4.0)  # 2 seconds of validation, 1 second per case
+        self.assertEqual(cases, [0, 1])
+        self.assertEqual(list(incremental.loader(torch.utils.data.DataLoader(range(8)), cases).sampler), [1, 3])
+        for case in cases:
+            incremental.update(case, torch.tensor([10.0, 1.0]), epoch=1)
+
+        self.assertEqual(incremental.stale(1), [2, 3])
+        self.assertEqual(incremental.select(4.0), [2, 3])
+        self.assertEqual(incremental.metric(torch.zeros(2)).tolist(), [25.0, 4.0])
+        self.assertEqual(sorted(incremental.ages(1)), [0, 0, 1, 1])
+
+    def test_dataset_indices_length(self):
+        with self.assertRaises(ValueError):
+            IncrementalValidation(num_cases=3, dataset_indices=[0, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
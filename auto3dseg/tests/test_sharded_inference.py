@@ -0,0 +1,61 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import filecmp
+import os
+import sys
+import tempfile
+import unittest
+
+templates_dir = os.path.join(os.path.dirname(__file__), "..", "algorithm_templates")
+sys.path.insert(0, os.path.join(templates_dir, "dints", "scripts"))
+from sharded_inference import CompletedCases, partition_by_voxels  # noqa: E402
+
+
+class TestShardedInference(unittest.TestCase):
+    def test_same_module_in_templates(self):
+        reference = os.path.join(templates_dir, "dints", "scripts", "sharded_inference.py")
+        for template in ("segresnet", "swinunetr"):
+            copy = os.path.join(templates_dir, template, "scripts", "sharded_inference.py")
+            self.assertTrue(filecmp.cmp(reference, copy, shallow=False), f"{copy} differs from {reference}")
+
+    def test_partition_by_voxels(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            files = []
+            for i, size in enumerate([800, 100, 400, 300, 200, 100]):
+                image = os.path.join(tempdir, f"image_{i}.bin")  # not nifti, estimated by the file size
+                with open(image, "wb") as f:
+                    f.write(b"\0" * size)
+                files.append({"image": image})
+
+            shards = partition_by_voxels(files, 2)
+            self.assertEqual(sorted(f["image"] for s in shards for f in s), sorted(f["image"] for f in files))
+            loads = [sum(os.path.getsize(f["image"]) for f in s) for s in shards]
+            self.assertEqual(sorted(loads), [900, 1000])
+            self.assertEqual(shards, partition_by_voxels(files, 2))  # deterministic
+
+    def test_completed_cases(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            files = [{"image": os.path.join(tempdir, f"image_{i}.nii.gz")} for i in range(4)]
+            CompletedCases(tempdir, shard_id=0).add(files[0]["image"])
+            CompletedCases(tempdir, shard_id=1).add(files[2])
+            with open(os.path.join(tempdir, "completed_cases_1.txt"), "a") as f:
+                f.write(CompletedCases.case_name(files[3]))  # interrupted while writing the line
+
+            pending = CompletedCases(tempdir, shard_id=0).pending(files)
+            self.assertEqual(pending, [files[1], files[3]])
+
+            CompletedCases(tempdir, shard_id=1).add(files[1])  # after the incomplete line
+            self.assertEqual(CompletedCases(tempdir).pending(files), [files[3]])
+
+
+if __name__ == "__main__":
+    unittest.main()
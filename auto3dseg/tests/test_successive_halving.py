@@ -0,0 +1,47 @@
+# Copyright (c) MONAI Consortium
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from successive_halving import get_budgets, rung_epochs, select_top  # noqa: E402
+
+
+class TestSuccessiveHalving(unittest.TestCase):
+    def test_get_budgets(self):
+        self.assertEqual(get_budgets(20, 300, 3), [20, 60, 180, 300])
+        self.assertEqual(get_budgets(20, 180, 3), [20, 60, 180])
+        self.assertEqual(get_budgets(10, 40, 2), [10, 20, 40])
+        self.assertEqual(get_budgets(50, 30, 3), [30])  # a single rung
+        self.assertEqual(get_budgets(0, 3, 3), [1, 3])
+
+    def test_rung_epochs(self):
+        budgets = get_budgets(20, 300, 3)
+        for template in ("segresnet", "segresnet2d"):
+            self.assertEqual([rung_epochs(budgets, r, template) for r in range(len(budgets))], budgets)
+        for template in ("dints", "swinunetr"):
+            epochs = [rung_epochs(budgets, r, template) for r in range(len(budgets))]
+            self.assertEqual(epochs, [20, 40, 120, 120])
+            self.assertEqual(sum(epochs), budgets[-1])
+
+    def test_select_top(self):
+        scores = {"dints_0": 0.8, "segresnet_0": 0.9, "swinunetr_0": 0.7, "dints_1": 0.5, "segresnet_1": 0.6}
+        folds = {"dints_0": 0, "segresnet_0": 0, "swinunetr_0": 0, "dints_1": 1, "segresnet_1": 1}
+        self.assertEqual(select_top(scores, folds, eta=3), ["segresnet_0", "segresnet_1"])
+        self.assertEqual(sorted(select_top(scores, folds, eta=2)), ["dints_0", "segresnet_0", "segresnet_1"])
+        # at least one run per fold
+        self.assertEqual(select_top({"dints_0": 0.1}, {"dints_0": 0}, eta=3), ["dints_0"])
+
+
+if __name__ == "__main__":
+    unittest.main()